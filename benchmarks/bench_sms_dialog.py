@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+'''
+Usage:
+    bench_sms_dialog [--corpus-size <n>] [--repeat <n>] [--only <name>]... [--output <file>] [--baseline <file>] [--update-baseline] [--threshold <pct>] [--fail-on-regression]
+    bench_sms_dialog --list
+
+Options:
+    --corpus-size <n>       number of messages (or list records) per corpus [default: 200]
+    --repeat <n>            timing runs per benchmark; the median is reported [default: 7]
+    --only <name>           run only benchmarks whose name starts with <name>
+    --output <file>         where to save this run's results [default: benchmarks/results/sms_dialog.json]
+    --baseline <file>       pinned results to compare against [default: benchmarks/results/sms_dialog_baseline.json]
+    --update-baseline       after this run, save its results as the new baseline
+    --threshold <pct>       slowdown, in percent, reported as a regression [default: 10]
+    --fail-on-regression    exit with status 1 if any benchmark regressed
+'''
+
+#
+# Offline microbenchmarks for the SMS dialog engine: message parsing, command dispatch,
+# list generation and help text. Nothing here touches the database, S3, SQS or Twilio;
+# any attempt to look up a service fails loudly.
+#
+
+import os
+import sys
+import json
+import uuid
+import random
+import timeit
+import datetime
+import platform
+import statistics
+
+import docopt
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bx_transforms
+from bx_transforms import (parse_sms_message_body,
+                           compile_help_string,
+                           render_job_line,
+                           filter_job_tag,
+                           DialogEngine,
+                           SMSDialogContext,
+                           SMS_DIALOG_ENGINE,
+                           SMS_SYSTEM_COMMAND_SPECS,
+                           SMS_GENERATOR_COMMAND_SPECS,
+                           SMS_PREFIX_COMMAND_SPECS,
+                           ABBREVIATIONS)
+from bx_services import CourierIdentity
+from bxcommon import ListOutputResponder
+
+
+RANDOM_SEED = 1123
+BOROUGH_FILTERS = ['bx', 'bk', 'mn', 'qn', 'si']
+
+
+class OfflineServiceRegistry(object):
+    '''Stands in for the service registry. The benchmarks only exercise code
+    which needs no services; anything which does is a bug in the benchmark.
+    '''
+
+    def lookup(self, service_object_name):
+        raise Exception('benchmark attempted to use the "%s" service; benchmarks must run offline.' % service_object_name)
+
+
+def make_job_tags(rng, count):
+    # same shape as generate_job_tag(), but reproducible from run to run
+    tags = []
+    for i in range(count):
+        borough = BOROUGH_FILTERS[i % len(BOROUGH_FILTERS)]
+        tags.append('%s-%s-%s' % (bx_transforms.SYSTEM_ID, borough, uuid.UUID(int=rng.getrandbits(128))))
+    return tags
+
+
+def make_message_corpus(rng, job_tags, count):
+    '''A mix of inbound message bodies in roughly the proportions couriers send
+    them: list commands (with and without selectors, filters and modifiers), job
+    commands addressed by tag, duty and help commands, and prefix commands.
+    '''
+    generators = list(SMS_GENERATOR_COMMAND_SPECS.keys())
+    tag_commands = [c for c, spec in SMS_SYSTEM_COMMAND_SPECS.items() if spec.tag_required]
+    plain_commands = [c for c, spec in SMS_SYSTEM_COMMAND_SPECS.items() if not spec.tag_required]
+
+    templates = [
+        (30, lambda: rng.choice(generators)),
+        (15, lambda: '%s.%d' % (rng.choice(generators), rng.randint(1, 20))),
+        (5, lambda: '%s.-%d' % (rng.choice(generators), rng.randint(1, 5))),
+        (10, lambda: '%s.%d-%d dt' % ('opn', 1, rng.randint(2, 6))),
+        (5, lambda: 'opn?%s' % rng.choice(BOROUGH_FILTERS)),
+        (5, lambda: 'opn?%s.1 bid' % rng.choice(BOROUGH_FILTERS)),
+        (15, lambda: '%s %s' % (rng.choice(job_tags), rng.choice(tag_commands))),
+        (8, lambda: rng.choice(plain_commands)),
+        (3, lambda: '#%s' % rng.choice(list(ABBREVIATIONS.keys()))),
+        (2, lambda: '$m%d:opn.1-3 dt' % rng.randint(1, 9)),
+        (2, lambda: '@dispatch running ten minutes late on pickup'),
+    ]
+
+    weighted = []
+    for weight, template in templates:
+        weighted.extend([template] * weight)
+
+    return [rng.choice(weighted)() for i in range(count)]
+
+
+def noop_reply(*args, **kwargs):
+    return 'ok'
+
+
+def build_dispatch_only_engine():
+    '''A DialogEngine with the production dispatch tables' keys, but handlers which
+    do nothing, so that reply_command() timings measure dispatch alone.
+    '''
+    engine = DialogEngine()
+    for spec in SMS_SYSTEM_COMMAND_SPECS.values():
+        engine.register_cmd_spec(spec, noop_reply)
+    for spec in SMS_GENERATOR_COMMAND_SPECS.values():
+        engine.register_generator_cmd(spec, noop_reply)
+    for spec in SMS_PREFIX_COMMAND_SPECS.values():
+        engine.register_prefix_cmd(spec, noop_reply)
+    return engine
+
+
+def build_dialog_context():
+    courier = CourierIdentity(id=str(uuid.UUID(int=RANDOM_SEED)),
+                              first_name='Bench',
+                              last_name='Mark',
+                              mobile_number='9175550100',
+                              email='bench@example.com',
+                              duty_status=1,
+                              handle='bench')
+    return SMSDialogContext(courier=courier, source_number=courier.mobile_number, message='', unit_of_work=None)
+
+
+def build_benchmarks(corpus_size):
+    rng = random.Random(RANDOM_SEED)
+    job_tags = make_job_tags(rng, corpus_size)
+    messages = make_message_corpus(rng, job_tags, corpus_size)
+    parsed_messages = [parse_sms_message_body(m) for m in messages]
+
+    service_registry = OfflineServiceRegistry()
+    dlg_context = build_dialog_context()
+    dispatch_engine = build_dispatch_only_engine()
+
+    # handlers which need no services, run through the production engine
+    offline_messages = ['hlp', '911', '#etrm', '#bsty', '?']
+    parsed_offline_messages = [parse_sms_message_body(m) for m in offline_messages]
+
+    responder = ListOutputResponder(SMS_GENERATOR_COMMAND_SPECS['opn'], parse_sms_message_body)
+
+    def generate(command_string):
+        cmd_object = parse_sms_message_body(command_string).cmd_object
+
+        def run():
+            return responder.generate(command_object=cmd_object,
+                                      record_list=job_tags,
+                                      render_callback=render_job_line,
+                                      filter_callback=filter_job_tag,
+                                      dialog_context=dlg_context,
+                                      dialog_engine=dispatch_engine,
+                                      service_registry=service_registry)
+        return run
+
+    def parse_corpus():
+        for message in messages:
+            parse_sms_message_body(message)
+
+    def dispatch_corpus():
+        for command_input in parsed_messages:
+            dispatch_engine.reply_command(command_input, dlg_context, service_registry)
+
+    def reply_offline_commands():
+        for command_input in parsed_offline_messages:
+            SMS_DIALOG_ENGINE.reply_command(command_input, dlg_context, service_registry)
+
+    # (name, callable, operations per call)
+    return [
+        ('parse_sms_message_body', parse_corpus, len(messages)),
+        ('reply_command.dispatch', dispatch_corpus, len(parsed_messages)),
+        ('reply_command.offline_handlers', reply_offline_commands, len(parsed_offline_messages)),
+        ('generate.full_list', generate('opn'), 1),
+        ('generate.index', generate('opn.%d' % (corpus_size // 2)), 1),
+        ('generate.negative_index', generate('opn.-3'), 1),
+        ('generate.range', generate('opn.1-5'), 1),
+        ('generate.filter', generate('opn?bk'), 1),
+        ('generate.filter_index', generate('opn?bk.2'), 1),
+        ('generate.index_chained', generate('opn.3 dt'), 1),
+        ('generate.range_chained', generate('opn.1-5 dt'), 1),
+        ('compile_help_string', compile_help_string, 1),
+    ]
+
+
+def time_benchmark(func, operations, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    samples = [t / (number * operations) for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        'median_us': statistics.median(samples) * 1e6,
+        'min_us': min(samples) * 1e6,
+        'loops': number,
+        'operations_per_loop': operations
+    }
+
+
+def load_results(filename):
+    if not filename or not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_results(filename, results):
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+
+
+def main(args):
+    corpus_size = int(args['--corpus-size'])
+    benchmarks = build_benchmarks(corpus_size)
+
+    if args['--list']:
+        for name, _, _ in benchmarks:
+            print(name)
+        return 0
+
+    if args['--only']:
+        benchmarks = [b for b in benchmarks if any(b[0].startswith(prefix) for prefix in args['--only'])]
+
+    # the baseline only moves when asked to, so that slowdowns spread over several
+    # runs still add up to a regression, and a flagged regression stays flagged
+    output_filename = args['--output']
+    baseline_filename = args['--baseline']
+    baseline = load_results(baseline_filename)
+    baseline_timings = (baseline or {}).get('benchmarks', {})
+    threshold = float(args['--threshold'])
+
+    results = {
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'corpus_size': corpus_size,
+        'benchmarks': {}
+    }
+
+    regressions = []
+    print('%-34s %12s %12s %10s' % ('benchmark', 'median (us)', 'min (us)', 'change'))
+    for name, func, operations in benchmarks:
+        timing = time_benchmark(func, operations, int(args['--repeat']))
+        results['benchmarks'][name] = timing
+
+        change = ''
+        previous = baseline_timings.get(name)
+        if previous and previous['median_us'] > 0:
+            pct = (timing['median_us'] - previous['median_us']) / previous['median_us'] * 100
+            change = '%+.1f%%' % pct
+            if pct > threshold:
+                change += ' !'
+                regressions.append(name)
+
+        print('%-34s %12.2f %12.2f %10s' % (name, timing['median_us'], timing['min_us'], change))
+
+    save_results(output_filename, results)
+    print('\nresults saved to %s' % output_filename)
+
+    if args['--update-baseline']:
+        if args['--only'] and baseline:
+            # a partial run replaces only the benchmarks it ran
+            baseline['benchmarks'].update(results['benchmarks'])
+            results = dict(results, benchmarks=baseline['benchmarks'])
+        save_results(baseline_filename, results)
+        print('baseline updated: %s' % baseline_filename)
+    elif baseline is None:
+        print('no baseline at %s; run with --update-baseline to pin one' % baseline_filename)
+
+    if regressions:
+        print('%d benchmark(s) slower than the baseline by more than %s%%: %s' % (len(regressions), threshold, ', '.join(regressions)))
+        if args['--fail-on-regression']:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    sys.exit(main(args))
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+'''
+Usage:
+    bid-scheduler --config <configfile>
+'''
+
+import sys
+import docopt
+from snap import snap, common
+
+
+def main(args):
+    configfile = args['<configfile>']
+    yaml_config = common.read_config_file(configfile)
+
+    project_dir = common.load_config_var(yaml_config['globals']['project_home'])
+    sys.path.append(project_dir)
+
+    service_tbl = snap.initialize_services(yaml_config)
+    service_registry = common.ServiceObjectRegistry(service_tbl)
+
+    # imported after the project directory is on the path
+    from bx_eventhandlers import BiddingWindowScheduler
+
+    scheduler_config = yaml_config.get('scheduler') or {}
+    scheduler = BiddingWindowScheduler(service_registry,
+                                       resync_interval_seconds=scheduler_config.get('resync_interval_seconds'),
+                                       idle_window_recheck_seconds=scheduler_config.get('idle_window_recheck_seconds'),
+                                       error_backoff_seconds=scheduler_config.get('error_backoff_seconds'),
+                                       max_error_backoff_seconds=scheduler_config.get('max_error_backoff_seconds'))
+    scheduler.run()
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    main(args)
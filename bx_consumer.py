@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from snap import snap, common
+import bxmetrics
+import bxlogging
+
+
+SQS_MAX_BATCH_SIZE = 10
+ALLOWED_WORKER_MODES = ['thread', 'process']
+
+# Process-mode workers are forked from the consumer and inherit this table,
+# so neither the YAML config nor the service registry has to be pickled.
+WORKER_CONTEXT = {}
+WORKER_CONTEXT_LOCK = threading.Lock()
+
+log = bxlogging.get_logger(__name__)
+
+
+def worker_service_registry():
+    '''Return the service registry for the current worker process, building it
+    from the YAML config the first time it is needed. The registry is tied to
+    the PID that built it; a forked child never reuses its parent's clients,
+    sockets or database engine, but builds its own.
+    '''
+    if WORKER_CONTEXT.get('registry_pid') != os.getpid():
+        with WORKER_CONTEXT_LOCK:
+            if WORKER_CONTEXT.get('registry_pid') != os.getpid():
+                service_tbl = snap.initialize_services(WORKER_CONTEXT['yaml_config'])
+                WORKER_CONTEXT['service_registry'] = common.ServiceObjectRegistry(service_tbl)
+                WORKER_CONTEXT['registry_pid'] = os.getpid()
+                log.info('initialized service registry for worker process', pid=os.getpid())
+
+    return WORKER_CONTEXT['service_registry']
+
+
+def init_worker(worker_init_func=None):
+    service_registry = worker_service_registry()
+    if worker_init_func:
+        worker_init_func(service_registry)
+    return os.getpid()
+
+
+def run_handler(handler_func, message):
+    handler_func(message, message['ReceiptHandle'], worker_service_registry())
+
+
+class QueueConsumer(object):
+    '''Long-polls an SQS queue in batches and hands each message to a fixed-size
+    pool of workers (threads or processes). A message is deleted from the queue
+    only after its handler returns without raising; failed messages become
+    visible again once their visibility timeout expires.
+
+    While a handler runs, a heartbeat thread keeps extending its message's
+    visibility timeout, so that a slow handler (a broadcast to every courier, say)
+    is not redelivered to another worker before it has finished.
+    '''
+
+    def __init__(self, sqs_client, queue_url, handler_func, yaml_config, **kwargs):
+        self.sqs = sqs_client
+        self.queue_url = queue_url
+        self.handler_func = handler_func
+        self.yaml_config = yaml_config
+        self.worker_mode = kwargs.get('worker_mode') or 'process'
+        if self.worker_mode not in ALLOWED_WORKER_MODES:
+            raise Exception('Invalid worker mode %s. Allowed modes are %s.' % (self.worker_mode, ALLOWED_WORKER_MODES))
+
+        self.num_workers = int(kwargs.get('num_workers') or 4)
+        self.batch_size = min(int(kwargs.get('max_msgs_per_cycle') or SQS_MAX_BATCH_SIZE), SQS_MAX_BATCH_SIZE)
+        # 0 is valid here (short polling), so only a missing value takes the default
+        wait_time_seconds = kwargs.get('wait_time_seconds')
+        self.wait_time_seconds = int(20 if wait_time_seconds is None else wait_time_seconds)
+        self.visibility_timeout_seconds = int(kwargs.get('visibility_timeout_seconds') or 30)
+        # must be comfortably shorter than the visibility timeout, which each heartbeat restarts
+        self.heartbeat_interval_seconds = float(kwargs.get('heartbeat_interval_seconds') or
+                                                self.visibility_timeout_seconds / 3.0)
+        if self.heartbeat_interval_seconds >= self.visibility_timeout_seconds:
+            raise Exception('Heartbeat interval (%s seconds) must be shorter than the visibility timeout (%s seconds).' %
+                            (self.heartbeat_interval_seconds, self.visibility_timeout_seconds))
+        self.verbose = kwargs.get('verbose', False)
+        self.metrics_port = kwargs.get('metrics_port')
+        self.handler_name = getattr(handler_func, '__name__', str(handler_func))
+        # optional; called with each worker's service registry once it is built, to check it
+        self.worker_init_func = kwargs.get('worker_init_func')
+        self.executor = None
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.heartbeat_thread = None
+        self.stopping = threading.Event()
+        self.metrics_server = None
+
+    def start(self):
+        WORKER_CONTEXT['yaml_config'] = self.yaml_config
+        if self.metrics_port:
+            self.metrics_server = bxmetrics.start_metrics_server(self.metrics_port)
+
+        # In process mode each worker builds its own registry after the fork; the
+        # consumer process itself never builds one. Thread workers share a single
+        # registry, built once here.
+        if self.worker_mode == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=self.num_workers)
+        else:
+            worker_service_registry()
+            self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+
+        # start every worker (and build its services) now, rather than on the first inbound message;
+        # a worker which cannot start stops the consumer here
+        for future in [self.executor.submit(init_worker, self.worker_init_func) for i in range(self.num_workers)]:
+            future.result()
+        log.info('started workers', num_workers=self.num_workers, worker_mode=self.worker_mode)
+
+        self.stopping.clear()
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat, name='visibility-heartbeat', daemon=True)
+        self.heartbeat_thread.start()
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        # stopped after the workers, so that the messages they finish on the way out stay hidden
+        self.stopping.set()
+        if self.heartbeat_thread:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server = None
+
+    def receive(self, max_messages):
+        # while handlers are running, poll briefly so that finished messages
+        # are deleted well inside their visibility timeout
+        if self.in_flight:
+            wait_time_seconds = 1
+        else:
+            wait_time_seconds = self.wait_time_seconds
+
+        if self.verbose:
+            log.info('checking SQS queue for messages', queue_url=self.queue_url)
+
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            AttributeNames=[
+                'SentTimestamp'
+            ],
+            MaxNumberOfMessages=max_messages,
+            MessageAttributeNames=[
+                'All'
+            ],
+            VisibilityTimeout=self.visibility_timeout_seconds,
+            WaitTimeSeconds=wait_time_seconds
+        )
+
+        return response.get('Messages') or []
+
+    def dispatch(self, message):
+        # handlers are timed here rather than in the worker, so that the numbers
+        # survive process-mode workers (whose memory the consumer never sees)
+        start_time = bxmetrics.HANDLER_METRICS.started(self.handler_name)
+        future = self.executor.submit(run_handler, self.handler_func, message)
+        future.add_done_callback(lambda f: bxmetrics.HANDLER_METRICS.finished(self.handler_name,
+                                                                            start_time,
+                                                                            failed=f.exception() is not None))
+        with self.in_flight_lock:
+            self.in_flight[future] = message
+
+    def reap(self, timeout=None):
+        '''Wait up to <timeout> seconds for running handlers to finish, then
+        batch-delete the messages whose handlers succeeded.
+        '''
+        if not self.in_flight:
+            return
+
+        done, _ = wait(list(self.in_flight.keys()), timeout=timeout, return_when=FIRST_COMPLETED)
+        handled_messages = []
+        for future in done:
+            with self.in_flight_lock:
+                message = self.in_flight.pop(future)
+            err = future.exception()
+            if err:
+                log.error('error processing message', receipt_handle=message['ReceiptHandle'], error=repr(err))
+            else:
+                handled_messages.append(message)
+
+        self.delete_messages(handled_messages)
+
+    def delete_messages(self, messages):
+        for start in range(0, len(messages), SQS_MAX_BATCH_SIZE):
+            batch = messages[start:start + SQS_MAX_BATCH_SIZE]
+            entries = [{'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']}
+                       for index, message in enumerate(batch)]
+
+            response = self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            for failure in response.get('Failed') or []:
+                log.error('unable to delete message from queue',
+                          entry_id=failure.get('Id'),
+                          reason=failure.get('Message'))
+
+    def heartbeat(self):
+        while not self.stopping.wait(self.heartbeat_interval_seconds):
+            try:
+                self.extend_visibility()
+            except Exception:
+                # the next heartbeat tries again; one missed beat is well inside the timeout
+                log.exception('unable to extend the visibility of in-flight messages')
+
+    def extend_visibility(self):
+        '''Restart the visibility timeout of every message whose handler is still running.'''
+        with self.in_flight_lock:
+            messages = list(self.in_flight.values())
+
+        for start in range(0, len(messages), SQS_MAX_BATCH_SIZE):
+            batch = messages[start:start + SQS_MAX_BATCH_SIZE]
+            entries = [{'Id': str(index),
+                        'ReceiptHandle': message['ReceiptHandle'],
+                        'VisibilityTimeout': self.visibility_timeout_seconds}
+                       for index, message in enumerate(batch)]
+
+            response = self.sqs.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            # a message finished (and deleted) since the snapshot above also shows up here
+            for failure in response.get('Failed') or []:
+                log.warning('unable to extend visibility of message',
+                            entry_id=failure.get('Id'),
+                            reason=failure.get('Message'))
+
+    def poll_once(self):
+        free_workers = self.num_workers - len(self.in_flight)
+        if free_workers > 0:
+            for message in self.receive(min(self.batch_size, free_workers)):
+                self.dispatch(message)
+
+            # don't block on running handlers if there is room to receive more work
+            self.reap(timeout=0)
+        else:
+            self.reap(timeout=None)
+
+    def run(self):
+        self.start()
+        log.info('initiating polling loop')
+        try:
+            # loop forever
+            while True:
+                self.poll_once()
+        finally:
+            self.shutdown()
@@ -1,16 +1,19 @@
 #!/usr/bin/env python
 
-import sys
 import dateutil.parser
-import traceback
 import json
 import time
 import random
+import heapq
 import datetime
 from contextlib import ContextDecorator
-from snap import common
 #from mercury import journaling as jrnl
 from bx_services import S3Key
+from constants import JOB_BROADCAST_IN_PROGRESS, JOB_BROADCAST_COMPLETED
+import bxlogging
+
+
+log = bxlogging.get_logger(__name__)
 
 
 class UnrecognizedJobType(Exception):
@@ -18,6 +21,11 @@ class UnrecognizedJobType(Exception):
         super().__init__(self, 'Could not determine type for job %s' % job_tag)
 
 
+class JobBroadcastInProgress(Exception):
+    def __init__(self, job_tag):
+        super().__init__(self, 'Job %s is being broadcast by another worker.' % job_tag)
+
+
 class NoHandlerRegisteredForJobType(Exception):
     def __init__(self, job_type):
         super().__init__(self, 'No handler function registered for job type "%s"' % job_type)
@@ -57,73 +65,285 @@ def arbitrate(bidder_list, service_registry):
     # This is only for the proof of concept; we will upgrade to smarter (and user-pluggable)
     # arbitration methods once we shake the system out.
 
-    print('#####------- Arbitrating bid data:')
-    print(common.jsonpretty(bidder_list))
+    log.debug('arbitrating bids', bid_count=len(bidder_list))
     random.seed(time.time())
     index = random.randrange(0, len(bidder_list))
     return [bidder_list[index]]
 
 
+def select_window_winners(bwindow, bidders, current_time, service_registry):
+    '''Apply a bidding window's policy to its current bids. Returns the list of
+    winning bids if the window is due to be settled, or an empty list if it is not.
+    '''
+    limit_type = bwindow['policy']['limit_type']
+    policy_limit = int(bwindow['policy']['limit'])
+
+    if limit_type == 'num_bids':
+        if len(bidders) < policy_limit:
+            return []
+
+    elif limit_type == 'time_seconds':
+        # see how long the window has been open
+        window_opened_at = dateutil.parser.parse(bwindow['open_ts'])
+        window_open_duration = (current_time - window_opened_at).total_seconds()
+        if window_open_duration < policy_limit:
+            return []
+
+        if not len(bidders):
+            return []
+
+    else:
+        # raise hell; we don't support that
+        raise Exception('Unrecognized bidding window policy limit_type: %s' % limit_type)
+
+    winners = arbitrate(bidders, service_registry)
+    if not len(winners):
+        log.info('no winner determined in arbitration round',
+                 bidding_window_id=bwindow['bidding_window_id'], round_end=current_time.isoformat())
+    return winners
+
+
+class APIArbitrationBackend(object):
+    '''Reads bidding windows and awards jobs through the BXLOGIC web API.'''
+
+    def __init__(self, service_registry):
+        self.api_service = service_registry.lookup('job_mgr_api')
+
+    def open_bidding_windows(self):
+        # windows and their policies only, without bids
+        response = self.api_service.get_open_bid_windows()
+        return response.json()['data']['bidding_windows']
+
+    def arbitration_snapshot(self, window_ids=None):
+        response = self.api_service.get_arbitration_snapshot(window_ids)
+        return response.json()['data']['bidding_windows']
+
+    def award_jobs(self, awards):
+        response = self.api_service.award_jobs(awards)
+        if response.status_code != 200:
+            log.error('error awarding bidding windows', count=len(awards), http_status=response.status_code)
+            return []
+        return response.json()['data']['results']
+
+
+class DirectArbitrationBackend(object):
+    '''Reads bidding windows and awards jobs in-process, against PostgreSQL,
+    using the same lookup and award logic as the web API.
+    '''
+
+    def __init__(self, service_registry):
+        # deferred so that API-mode consumers do not need the transform module's dependencies
+        import bx_transforms
+        self.transforms = bx_transforms
+        self.service_registry = service_registry
+        self.db_svc = service_registry.lookup('postgres')
+
+    def open_bidding_windows(self):
+        with self.db_svc.read_scope() as session:
+            return [self.transforms.prepare_bidding_window_record(bwindow)
+                    for bwindow in self.transforms.lookup_open_bidding_windows(session, self.db_svc)]
+
+    def arbitration_snapshot(self, window_ids=None):
+        with self.db_svc.txn_scope() as session:
+            return self.transforms.lookup_arbitration_snapshot(session, self.db_svc, window_ids)
+
+    def award_jobs(self, awards):
+        transform_status = self.transforms.award_jobs_func({'awards': awards}, self.service_registry)
+        self.service_registry.lookup('sms').flush()
+        if not transform_status.ok:
+            log.error('error awarding bidding windows', count=len(awards), error=transform_status.message)
+            return []
+        return json.loads(transform_status.output_data)['data']['results']
+
+
+def report_award_results(results):
+    for result in results:
+        if not result['awarded']:
+            log.warning('bidding window not awarded', bidding_window_id=result['window_id'], error=result['error'])
+
+
+def select_arbitration_backend(service_registry):
+    '''Return the backend named by the "arbitration" service object (see
+    ArbitrationSettings in bx_services).
+    '''
+    settings = service_registry.lookup('arbitration')
+    if settings.backend == 'api':
+        return APIArbitrationBackend(service_registry)
+
+    try:
+        service_registry.lookup('postgres')
+    except Exception:
+        raise Exception('Arbitration backend "direct" requires a "postgres" service object. Please check your config file.')
+    return DirectArbitrationBackend(service_registry)
+
+
+def check_arbitration_backend(service_registry):
+    '''Worker init hook (see bx_consumer): fail at startup, rather than on the first
+    scan event, if the arbitration settings cannot be used.
+    '''
+    backend = select_arbitration_backend(service_registry)
+    log.info('arbitration backend selected', backend=backend.__class__.__name__)
+
+
 def trigger_arbitration(service_registry, **kwargs):
 
     current_time = datetime.datetime.now()
-    # scan ALL open bidding windows
+    backend = kwargs.get('backend') or select_arbitration_backend(service_registry)
 
-    api_service = service_registry.lookup('job_mgr_api')
-    response = api_service.get_open_bid_windows()
-    bid_windows = response.json()['data']['bidding_windows']
+    # one call returns ALL open bidding windows, each with its policy and its live bids
+    bid_windows = backend.arbitration_snapshot()
 
-    print('###----- Retrieved open bid windows from API endpoint:')
-    print(bid_windows)
+    log.debug('retrieved open bidding windows', count=len(bid_windows), backend=backend.__class__.__name__)
 
-    # for each open window, see who has bid;
+    # use the policy data embedded in each bidding window to decide whether
+    # to award the job; every window settled in this round goes out in one call
+    awards = []
     for bwindow in bid_windows:
+        winners = select_window_winners(bwindow, bwindow['bidders'], current_time, service_registry)
+        if len(winners):
+            log.info('bidding window settled', bidding_window_id=bwindow['bidding_window_id'], winners=len(winners))
+            awards.append({'window_id': bwindow['bidding_window_id'], 'bids': winners})
+
+    if awards:
+        report_award_results(backend.award_jobs(awards))
 
-        job_tag = bwindow['job_tag']
-        window_id = bwindow['bidding_window_id']
 
-        if bwindow['policy']['limit_type'] == 'num_bids':
-            print('++ Policy limit is %d bids.' % int(bwindow['policy']['limit']))
+class BiddingWindowScheduler(object):
+    '''Fires arbitration for each bidding window when it is due, instead of waiting
+    for a scan event.
 
-            json_bidder_data = api_service.get_active_job_bids(job_tag)
-            bidding_users = json_bidder_data.json()['data']['bidders']
-            num_bids = len(bidding_users)
-            policy_limit_bids = int(bwindow['policy']['limit'])
+    Windows are kept in a heap ordered by when they are next due. A time_seconds
+    window is due at its close deadline (open_ts + limit); a num_bids window, which
+    has no deadline, is due as soon as it is seen and then every idle_window_recheck.
+    When windows come due, only those windows (with their bids) are read from the
+    arbitration backend.
 
-            if num_bids >= policy_limit_bids:
-                winners = arbitrate(bidding_users, service_registry)
-                if len(winners):
-                    print('!!!!!!!!!!!  WE HAVE A WINNER !!!!!!!!!!!!!!!!!!')
-                    print(common.jsonpretty(winners))
-                    api_service.award_job(window_id, winners)
-                else:
-                    print('### No winner determined in the arbitration round ending %s.' % current_time.isoformat())
+    Every resync_interval the scheduler also reads the list of open windows, without
+    bids: it picks up new windows, drops ones closed elsewhere, and after a restart
+    rebuilds the schedule from the bidding_windows table. A new window is therefore
+    seen up to resync_interval after it opens.
+    '''
 
-        elif bwindow['policy']['limit_type'] == 'time_seconds':
-            # see how long the window has been open;
+    def __init__(self, service_registry, **kwargs):
+        self.service_registry = service_registry
+        self.backend = kwargs.get('backend') or select_arbitration_backend(service_registry)
+        self.resync_interval = datetime.timedelta(seconds=float(kwargs.get('resync_interval_seconds') or 30))
+        # a window which is due but has no winner yet (no bids by its deadline, or fewer
+        # than a num_bids policy asks for) is looked at again after this long
+        self.idle_window_recheck = datetime.timedelta(seconds=float(kwargs.get('idle_window_recheck_seconds') or 5))
+        # after a failed tick, wait this long before trying again, doubling up to the maximum
+        self.error_backoff_seconds = float(kwargs.get('error_backoff_seconds') or 1)
+        self.max_error_backoff_seconds = float(kwargs.get('max_error_backoff_seconds') or 30)
+        self.deadline_heap = []
+        self.scheduled = {}
+        self.next_resync = None
+
+    def window_deadline(self, bwindow, current_time):
+        policy = bwindow['policy']
+        if policy['limit_type'] == 'time_seconds':
             window_opened_at = dateutil.parser.parse(bwindow['open_ts'])
-            window_open_duration = (current_time - window_opened_at).seconds
-            policy_limit_seconds = int(bwindow['policy']['limit'])
-
-            if window_open_duration >= policy_limit_seconds:
-                json_bidder_data = api_service.get_active_job_bids(job_tag)
-                bid_data = json_bidder_data.json()['data']['bidders']
-                if len(bid_data):
-                    winners = arbitrate(bid_data, service_registry)
-                    if len(winners):
-                        print('!!!!!!!!!!!  WE HAVE A WINNER !!!!!!!!!!!!!!!!!!')
-                        api_service.award_job(window_id, winners)
-                    else:
-                        print('### No winner determined in the arbitration round ending %s.' % current_time.isoformat())
-                else:
-                    print('### No more bidders in this round.')
-
-        else:
-            # raise hell; we don't support that
-            raise Exception('Unrecognized bidding window policy limit_type: %s' % bwindow['policy']['limit_type'])
-
-        # use the policy data embedded in the bidding window to decide whether
-        # to trigger (manual | automatic) arbitration
+            return window_opened_at + datetime.timedelta(seconds=int(policy['limit']))
+        return current_time
+
+    def schedule(self, window_id, deadline):
+        self.scheduled[window_id] = deadline
+        heapq.heappush(self.deadline_heap, (deadline, window_id))
+
+    def resync(self, current_time):
+        open_window_ids = set()
+        for bwindow in self.backend.open_bidding_windows():
+            window_id = bwindow['bidding_window_id']
+            open_window_ids.add(window_id)
+            if window_id not in self.scheduled:
+                self.schedule(window_id, self.window_deadline(bwindow, current_time))
+
+        # heap entries for windows which are no longer scheduled are discarded when popped
+        for window_id in list(self.scheduled.keys()):
+            if window_id not in open_window_ids:
+                del self.scheduled[window_id]
+
+        self.next_resync = current_time + self.resync_interval
+
+    def pop_due_windows(self, current_time):
+        due_window_ids = set()
+        while self.deadline_heap and self.deadline_heap[0][0] <= current_time:
+            deadline, window_id = heapq.heappop(self.deadline_heap)
+            if self.scheduled.get(window_id) == deadline:
+                due_window_ids.add(window_id)
+        return due_window_ids
+
+    def seconds_until_next_event(self, current_time):
+        next_event = self.next_resync
+        if self.deadline_heap and self.deadline_heap[0][0] < next_event:
+            next_event = self.deadline_heap[0][0]
+        return max(0, (next_event - current_time).total_seconds())
+
+    def tick(self):
+        current_time = datetime.datetime.now()
+        if self.next_resync is None or current_time >= self.next_resync:
+            self.resync(current_time)
+
+        due_window_ids = self.pop_due_windows(current_time)
+        if not due_window_ids:
+            return
+
+        try:
+            self.arbitrate(current_time, due_window_ids)
+        except Exception:
+            # put the due windows back, so that they are retried rather than dropped from
+            # the heap for good, and resync from scratch on the next attempt
+            for window_id in due_window_ids:
+                if window_id in self.scheduled:
+                    self.schedule(window_id, self.scheduled[window_id])
+            self.next_resync = None
+            raise
+
+    def arbitrate(self, current_time, due_window_ids):
+        # read only the due windows, so that we arbitrate over their current bids
+        awards = []
+        found_window_ids = set()
+        for bwindow in self.backend.arbitration_snapshot(sorted(due_window_ids)):
+            window_id = bwindow['bidding_window_id']
+            found_window_ids.add(window_id)
+
+            winners = select_window_winners(bwindow, bwindow['bidders'], current_time, self.service_registry)
+            if len(winners):
+                log.info('bidding window settled', bidding_window_id=window_id, winners=len(winners))
+                awards.append({'window_id': window_id, 'bids': winners})
+                # a window that fails to close is still open at the next resync, and is rescheduled then
+                self.scheduled.pop(window_id, None)
+            else:
+                self.schedule(window_id, current_time + self.idle_window_recheck)
+
+        # due windows missing from the snapshot have been closed elsewhere
+        for window_id in due_window_ids - found_window_ids:
+            self.scheduled.pop(window_id, None)
+
+        # windows which come due in the same tick are settled in one round trip
+        if awards:
+            report_award_results(self.backend.award_jobs(awards))
+
+    def run(self):
+        log.info('starting bidding-window scheduler', backend=self.backend.__class__.__name__)
+        backoff_seconds = self.error_backoff_seconds
+        while True:
+            try:
+                self.tick()
+            except Exception:
+                # a timeout from the API, a dropped DB connection or a bad window must not
+                # stop deadline arbitration for good
+                log.exception('error in bidding-window scheduler; retrying', retry_in_seconds=backoff_seconds)
+                time.sleep(backoff_seconds)
+                backoff_seconds = min(backoff_seconds * 2, self.max_error_backoff_seconds)
+                continue
+
+            backoff_seconds = self.error_backoff_seconds
+            time.sleep(self.seconds_until_next_event(datetime.datetime.now()))
+
+
+# how long a claimed but unfinished broadcast blocks other workers (the claimant died,
+# say); well beyond the time it takes to text the whole roster at the SMS rate limit
+JOB_BROADCAST_LEASE_SECONDS = 900
 
 
 def handle_job_posted(service_registry, **kwargs):
@@ -147,15 +367,35 @@ def handle_job_posted(service_registry, **kwargs):
     sms_service = service_registry.lookup('sms')
     api_service = service_registry.lookup('job_mgr_api')
 
-    # get_available_couriers() should return:
-    # { "data": "couriers": [{ <data> }, ...]
-    response = api_service.get_available_couriers()
-    couriers = response.json()['data']['couriers']
+    # SQS delivers at least once, so claim the broadcast first: a redelivered message
+    # must not text the whole roster again
+    broadcast_status = api_service.update_job_broadcast(job_tag, 'claim', lease_seconds=JOB_BROADCAST_LEASE_SECONDS)
+    if broadcast_status == JOB_BROADCAST_COMPLETED:
+        log.info('job already broadcast; skipping', job_tag=job_tag)
+        return
+    if broadcast_status == JOB_BROADCAST_IN_PROGRESS:
+        # leave the message on the queue; if the other worker dies, its claim expires
+        raise JobBroadcastInProgress(job_tag)
+
+    try:
+        # get_available_couriers() should return:
+        # { "data": "couriers": [{ <data> }, ...]
+        response = api_service.get_available_couriers()
+        couriers = response.json()['data']['couriers']
+
+        outcomes = sms_service.broadcast_sms([c['mobile_number'] for c in couriers], job_tag)
+    except Exception:
+        # nothing (or not everything) went out; let the redelivered message try again
+        api_service.update_job_broadcast(job_tag, 'release')
+        raise
 
-    for courier_record in couriers:
-        sms_service.send_sms(courier_record['mobile_number'], job_tag)
+    api_service.update_job_broadcast(job_tag, 'complete')
 
-    # done for now
+    failures = [outcome for outcome in outcomes if outcome.error]
+    for outcome in failures:
+        log.error('error broadcasting job', job_tag=job_tag, mobile_number=outcome.mobile_number, error=outcome.error)
+
+    log.info('broadcast job', job_tag=job_tag, delivered=len(outcomes) - len(failures), couriers=len(outcomes))
 
 
 S3_EVENT_DISPATCH_TABLE = {
@@ -165,18 +405,14 @@ S3_EVENT_DISPATCH_TABLE = {
 
 
 def scan_handler(message, receipt_handle, service_registry):
-    print('### Inside top-level SCAN event handler function.')
-    print("### Triggering bid arbitration...")
-    # print(message)
+    log.debug('scan event received; triggering bid arbitration')
     trigger_arbitration(service_registry)
 
 
 def msg_handler(message, receipt_handle, service_registry):
 
     s3_svc = service_registry.lookup('s3')
-    print('### Inside SQS message handler function.')
-    print("### message follows:")
-    print(common.jsonpretty(message))
+    log.debug_sampled('sqs message received', message_id=message.get('MessageId'), body=message.get('Body'))
 
     # unpack SQS message to get notification about S3 file upload
     message_body_raw = message['Body']
@@ -191,14 +427,13 @@ def msg_handler(message, receipt_handle, service_registry):
         object_key = s3_data['object']['key']
         # TODO: set a limit on file size?
 
-        print('#--- received object upload notification [ bucket: %s, key: %s ]' % (bucket_name, object_key))
+        log.info('object upload notification', bucket=bucket_name, object_key=object_key)
 
         s3key = S3Key(bucket_name, object_key)
         jsondata = None
         try:
             jsondata = s3_svc.download_json(bucket_name, object_key)
-            print('### JSON payload data:')
-            print(common.jsonpretty(jsondata))
+            log.debug_sampled('object upload payload', object_key=object_key, payload=jsondata)
 
             # we use the name of the top-level S3 "folder" to select the action to perform,
             # by keying into the dispatch table
@@ -209,11 +444,10 @@ def msg_handler(message, receipt_handle, service_registry):
 
             handler(service_registry, **jsondata)
 
-        except Exception as err:
-            print('Error handling JSON job data from URI %s.' % s3key.uri)
-            print(err)
-            traceback.print_exc(file=sys.stdout)
-            return
+        except Exception:
+            log.exception('error handling JSON job data', uri=s3key.uri)
+            # re-raise so that the consumer leaves the message on the queue
+            raise
 
 
 """
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+'''Read queries behind the courier job listings (the awd, my, prg, bst and opn
+generator commands, plus the ert and fin handlers).
+
+Each listing is one joined query, and each returns lightweight row tuples
+rather than mapped ORM objects. A ListSelector (see bxcommon) narrows a listing
+in SQL: its filter expression becomes a LIKE on the listing's filter column
+(case-sensitive, matching the in-memory filter the msg listing still uses),
+and its index or range becomes ORDER BY / OFFSET / LIMIT, so a command such as
+opn.3 reads one row instead of every open job.
+'''
+
+from collections import namedtuple
+from sqlalchemy import and_
+
+from constants import JOB_STATUS_BROADCAST, JOB_STATUS_AWARDED, JOB_STATUS_ACCEPTED, JOB_STATUS_IN_PROGRESS
+
+
+JobListing = namedtuple('JobListing', 'job_tag status status_ts')
+BidListing = namedtuple('BidListing', 'bid_id window_id job_tag timestamp')
+
+
+def escape_like(expression):
+    return expression.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class JobView(object):
+    '''A listing query, together with the column that filter expressions match
+    against (None if the listing cannot be filtered) and its sort order.
+    '''
+
+    def __init__(self, query, row_func, filter_column, order_columns):
+        self.query = query
+        self.row_func = row_func
+        self.filter_column = filter_column
+        self.order_columns = order_columns
+
+    def _filtered(self, selector):
+        query = self.query
+        if selector is not None and selector.filter_expression and self.filter_column is not None:
+            pattern = '%%%s%%' % escape_like(selector.filter_expression)
+            query = query.filter(self.filter_column.like(pattern, escape='\\'))
+        return query
+
+    def rows(self, selector=None):
+        query = self._filtered(selector)
+        if selector is not None and selector.reverse:
+            query = query.order_by(*[column.desc() for column in self.order_columns])
+        else:
+            query = query.order_by(*self.order_columns)
+
+        if selector is not None:
+            if selector.offset:
+                query = query.offset(selector.offset)
+            if selector.limit is not None:
+                query = query.limit(selector.limit)
+
+        return self.row_func(query.all())
+
+    def count(self, selector=None):
+        return self._filtered(selector).order_by(None).count()
+
+
+def job_listing_rows(resultset):
+    return [JobListing(*row) for row in resultset]
+
+
+def bid_listing_rows(resultset):
+    return [BidListing(*row) for row in resultset]
+
+
+def awarded_job_listing_rows(resultset):
+    jobs = []
+    for job_tag, status, status_ts, job_data_tag in resultset:
+        if job_data_tag is None:
+            raise Exception('There is an orphan job in this dataset. Please contact your administrator.')
+        jobs.append(JobListing(job_tag, status, status_ts))
+    return jobs
+
+
+def courier_jobs_in_status_view(courier_id, status, session, db_svc):
+    JobAssignment = db_svc.Base.classes.job_assignments
+    JobStatus = db_svc.Base.classes.job_current_status
+
+    query = session.query(JobStatus.job_tag,
+                          JobStatus.status,
+                          JobStatus.write_ts).join(JobAssignment,
+                                                   JobAssignment.job_tag == JobStatus.job_tag).filter(
+                                                       and_(JobAssignment.courier_id == courier_id,
+                                                            JobStatus.status == status)).distinct()
+
+    return JobView(query, job_listing_rows, JobStatus.job_tag, [JobStatus.write_ts, JobStatus.job_tag])
+
+
+def accepted_jobs_view(courier_id, session, db_svc):
+    return courier_jobs_in_status_view(courier_id, JOB_STATUS_ACCEPTED, session, db_svc)
+
+
+def in_progress_jobs_view(courier_id, session, db_svc):
+    return courier_jobs_in_status_view(courier_id, JOB_STATUS_IN_PROGRESS, session, db_svc)
+
+
+def awarded_jobs_view(courier_id, session, db_svc):
+    '''Jobs won by this courier in the bidding process, but not yet accepted.'''
+
+    JobBid = db_svc.Base.classes.job_bids
+    JobStatus = db_svc.Base.classes.job_current_status
+    JobData = db_svc.Base.classes.job_data
+
+    query = session.query(JobStatus.job_tag,
+                          JobStatus.status,
+                          JobStatus.write_ts,
+                          JobData.job_tag).join(JobBid,
+                                                JobBid.job_tag == JobStatus.job_tag).outerjoin(
+                                                    JobData,
+                                                    and_(JobData.job_tag == JobStatus.job_tag,
+                                                         JobData.deleted_ts == None)).filter(
+                                                             and_(JobBid.courier_id == courier_id,
+                                                                  JobBid.expired_ts == None,
+                                                                  JobBid.accepted_ts != None,
+                                                                  JobStatus.status == JOB_STATUS_AWARDED)).distinct()
+
+    return JobView(query, awarded_job_listing_rows, JobStatus.job_tag, [JobStatus.write_ts, JobStatus.job_tag])
+
+
+def available_jobs_view(session, db_svc):
+    JobStatus = db_svc.Base.classes.job_current_status
+
+    query = session.query(JobStatus.job_tag,
+                          JobStatus.status,
+                          JobStatus.write_ts).filter(JobStatus.status == JOB_STATUS_BROADCAST)
+
+    return JobView(query, job_listing_rows, JobStatus.job_tag, [JobStatus.write_ts, JobStatus.job_tag])
+
+
+def user_bids_view(courier_id, session, db_svc):
+    BidWindow = db_svc.Base.classes.bidding_windows
+    JobBid = db_svc.Base.classes.job_bids
+
+    query = session.query(JobBid.id,
+                          BidWindow.id,
+                          JobBid.job_tag,
+                          JobBid.write_ts).join(BidWindow,
+                                                JobBid.bidding_window_id == BidWindow.id).filter(
+                                                    and_(BidWindow.close_ts == None,
+                                                         JobBid.courier_id == courier_id,
+                                                         JobBid.expired_ts == None))
+
+    # the bid listing has never been filterable (see filter_bid)
+    return JobView(query, bid_listing_rows, None, [JobBid.write_ts, JobBid.id])
+
+
+def list_accepted_jobs(courier_id, session, db_svc, selector=None):
+    return accepted_jobs_view(courier_id, session, db_svc).rows(selector)
+
+
+def list_in_progress_jobs_for_courier(courier_id, session, db_svc, selector=None):
+    return in_progress_jobs_view(courier_id, session, db_svc).rows(selector)
+
+
+def list_awarded_jobs(courier_id, session, db_svc, selector=None):
+    return awarded_jobs_view(courier_id, session, db_svc).rows(selector)
+
+
+def list_available_jobs(session, db_svc, selector=None):
+    return available_jobs_view(session, db_svc).rows(selector)
+
+
+def list_user_bids(courier_id, session, db_svc, selector=None):
+    return user_bids_view(courier_id, session, db_svc).rows(selector)
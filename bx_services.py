@@ -1,26 +1,43 @@
 #!/usr/bin/env python
 
 import os
-import sys
+import stat
 import time
+import hashlib
+import itertools
+import pickle
 import urllib
 import json
+import queue
+import threading
 from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
-from sqlalchemy import MetaData
+from sqlalchemy import MetaData, and_
+from sqlalchemy.sql import text
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm.session import sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
 
 import datetime
 
 from snap import common
+from snap import core
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import boto3
 import sqlalchemy as sqla
 
 from twilio.rest import Client
 
+import bxlogging
+import bxmetrics
+
+
+log = bxlogging.get_logger(__name__)
+
 
 POSTGRESQL_SVC_PARAM_NAMES = [
     'host',
@@ -50,6 +67,15 @@ def parse_date(date_string):
 
 ALLOWED_BIDDING_LIMIT_TYPES = ['time_seconds', 'num_bids']
 
+# lookup tables which map a small integer ID to a display value, and which
+# almost never change once the database has been initialized
+REFERENCE_DATA_TABLES = [
+    'boroughs',
+    'transport_methods',
+    'lookup_payment_methods',
+    'lookup_job_status'
+]
+
 
 class JobPipelineService(object):
     def __init__(self, **kwargs):
@@ -82,6 +108,166 @@ class JobPipelineService(object):
         s3_svc.upload_json(payload, self.job_bucket_name, job_request_s3_key)
    
 
+ALLOWED_SMS_DELIVERY_MODES = ['sync', 'async']
+ALLOWED_ARBITRATION_BACKENDS = ['api', 'direct']
+
+
+class ArbitrationSettings(object):
+    '''Which backend the scan consumer and the bid scheduler arbitrate through:
+    "api" (the web API) or "direct" (in-process, against the "postgres" service
+    object, which must then be configured as well).
+    '''
+
+    def __init__(self, **kwargs):
+        self.backend = kwargs.get('backend') or 'api'
+        if self.backend not in ALLOWED_ARBITRATION_BACKENDS:
+            raise Exception('Invalid arbitration backend %s. Allowed backends are %s.' %
+                            (self.backend, ALLOWED_ARBITRATION_BACKENDS))
+
+
+class TransformMetricsService(object):
+    '''Times every transform the web listener runs (served on /metrics).
+    The listener builds its service objects before it creates its Transformer,
+    so declaring this one in the listener's config instruments the Transformer
+    class once, at startup; bxlistener.py itself is generated by routegen.
+    '''
+
+    def __init__(self, **kwargs):
+        bxmetrics.instrument_transformer_class(core.Transformer)
+        log.info('instrumented web listener transforms')
+
+
+OutboundSMS = namedtuple('OutboundSMS', 'mobile_number body future')
+BroadcastOutcome = namedtuple('BroadcastOutcome', 'mobile_number sid error')
+
+
+def sms_error_is_retryable(err):
+    # Twilio reports HTTP failures with a status attribute; client errors
+    # (bad number, unsubscribed recipient) will not succeed on a retry.
+    status = getattr(err, 'status', None)
+    if status is None:
+        return True
+    return status == 429 or status >= 500
+
+
+def send_sms_with_retry(send_func, mobile_number, body, max_retries, retry_backoff_seconds):
+    attempt = 0
+    while True:
+        try:
+            return send_func(mobile_number, body)
+        except Exception as err:
+            attempt += 1
+            if attempt > max_retries or not sms_error_is_retryable(err):
+                raise
+            time.sleep(retry_backoff_seconds * (2 ** (attempt - 1)))
+
+
+class TokenBucket(object):
+    '''Thread-safe token bucket. acquire() blocks until a token is available,
+    so callers are held to rate_per_second on average, with bursts of up to
+    burst_size calls.
+    '''
+
+    def __init__(self, rate_per_second, burst_size=None):
+        self.rate = float(rate_per_second)
+        if self.rate <= 0:
+            raise Exception('Token bucket rate must be a positive number (got %s).' % rate_per_second)
+
+        # a bucket which can never hold a whole token would never release one
+        self.capacity = max(1.0, float(burst_size or self.rate))
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class SMSDeliveryQueue(object):
+    '''Bounded in-process queue of outbound SMS messages, drained by a pool
+    of worker threads. Each submitted message gets a Future which resolves
+    to the message SID, or to the exception raised on the final delivery attempt.
+    '''
+
+    def __init__(self, send_func, **kwargs):
+        self.send_func = send_func
+        self.num_workers = int(kwargs.get('num_workers') or 4)
+        self.max_queue_size = int(kwargs.get('max_queue_size') or 1000)
+        self.max_retries = parse_number(kwargs.get('max_retries'), 3)
+        self.retry_backoff_seconds = parse_number(kwargs.get('retry_backoff_seconds'), 0.5, float)
+        self.enqueue_timeout_seconds = float(kwargs.get('enqueue_timeout_seconds') or 1)
+        self.queue = None
+        self.workers = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # worker threads do not survive a fork, so a child process
+        # gets its own queue and workers the first time it submits
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self.queue = queue.Queue(maxsize=self.max_queue_size)
+            self.workers = []
+            for index in range(self.num_workers):
+                worker = threading.Thread(target=self._work,
+                                          name='sms-delivery-%d' % index,
+                                          daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+            self._pid = os.getpid()
+
+    def submit(self, mobile_number, body):
+        '''Queue a message for delivery. Raises queue.Full if the queue
+        stays full for longer than the enqueue timeout.
+        '''
+        self._ensure_started()
+        future = Future()
+        self.queue.put(OutboundSMS(mobile_number=mobile_number, body=body, future=future),
+                       timeout=self.enqueue_timeout_seconds)
+        return future
+
+    def drain(self):
+        '''Block until every message queued so far has been handled.'''
+        if self._pid == os.getpid():
+            self.queue.join()
+
+    def _deliver(self, outbound_msg):
+        return send_sms_with_retry(self.send_func,
+                                   outbound_msg.mobile_number,
+                                   outbound_msg.body,
+                                   self.max_retries,
+                                   self.retry_backoff_seconds)
+
+    def _work(self):
+        while True:
+            outbound_msg = self.queue.get()
+            try:
+                if not outbound_msg.future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    outbound_msg.future.set_result(self._deliver(outbound_msg))
+                except Exception as err:
+                    log.error('sms delivery failed', mobile_number=outbound_msg.mobile_number, error=err)
+                    outbound_msg.future.set_exception(err)
+            finally:
+                self.queue.task_done()
+
+
 class SMSService(object):
     def __init__(self, **kwargs):
         account_sid = kwargs['account_sid']
@@ -96,9 +282,44 @@ class SMSService(object):
 
         self.client = Client(account_sid, auth_token)
 
+        # rate_limit_per_second (and rate_limit_burst) are the provider's account-wide limits.
+        # Each process has its own bucket, so they are split evenly across
+        # rate_limit_sender_processes: every process, in every deployment using this account,
+        # which sends SMS.
+        self.rate_limiter = None
+        if kwargs.get('rate_limit_per_second'):
+            sender_processes = parse_number(kwargs.get('rate_limit_sender_processes'), 1)
+            if sender_processes < 1:
+                raise Exception('rate_limit_sender_processes must be at least 1 (got %s).' % sender_processes)
+
+            burst_size = kwargs.get('rate_limit_burst')
+            self.rate_limiter = TokenBucket(float(kwargs['rate_limit_per_second']) / sender_processes,
+                                            float(burst_size) / sender_processes if burst_size else None)
+
+        self.broadcast_concurrency = int(kwargs.get('broadcast_concurrency') or 8)
+        self.max_retries = parse_number(kwargs.get('delivery_max_retries'), 3)
+        self.retry_backoff_seconds = parse_number(kwargs.get('delivery_retry_backoff_seconds'), 0.5, float)
+
+        # in sync mode (the default, and the one to use in tests) queue_sms()
+        # delivers inline; in async mode it hands the message to the delivery queue
+        self.delivery_mode = kwargs.get('delivery_mode') or 'sync'
+        if self.delivery_mode not in ALLOWED_SMS_DELIVERY_MODES:
+            raise Exception('Invalid SMS delivery mode %s. Allowed modes are %s.' %
+                            (self.delivery_mode, ALLOWED_SMS_DELIVERY_MODES))
+
+        self.delivery_queue = None
+        if self.delivery_mode == 'async':
+            self.delivery_queue = SMSDeliveryQueue(self.send_sms,
+                                                   num_workers=kwargs.get('delivery_workers'),
+                                                   max_queue_size=kwargs.get('delivery_queue_size'),
+                                                   max_retries=self.max_retries,
+                                                   retry_backoff_seconds=self.retry_backoff_seconds)
+
     def send_sms(self, mobile_number, message):
-        print('### sending message body via SMS from [%s] to [%s] :' % (self.source_number, mobile_number))
-        print(message)
+        log.debug_sampled('sending sms', source_number=self.source_number, mobile_number=mobile_number, body=message)
+
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
 
         message = self.client.messages.create(
             to='+1%s' % mobile_number,
@@ -108,6 +329,522 @@ class SMSService(object):
 
         return message.sid
 
+    def queue_sms(self, mobile_number, message):
+        '''Send an SMS without waiting on the provider. Returns a Future
+        which resolves to the message SID.
+        '''
+        if self.delivery_queue:
+            try:
+                return self.delivery_queue.submit(mobile_number, message)
+            except queue.Full:
+                log.warning('sms delivery queue is full; sending synchronously', mobile_number=mobile_number)
+
+        # sync mode, or a full queue: deliver inline, with the same retries a queued message gets
+        future = Future()
+        try:
+            future.set_result(send_sms_with_retry(self.send_sms,
+                                                  mobile_number,
+                                                  message,
+                                                  self.max_retries,
+                                                  self.retry_backoff_seconds))
+        except Exception as err:
+            log.error('sms delivery failed', mobile_number=mobile_number, error=err)
+            future.set_exception(err)
+        return future
+
+    def broadcast_sms(self, mobile_numbers, message):
+        '''Send the same message to many recipients concurrently, with at most
+        broadcast_concurrency sends in flight (and subject to the rate limit).
+        Blocks until every send has finished; returns one BroadcastOutcome per
+        recipient, in the order given.
+        '''
+        def send_one(mobile_number):
+            try:
+                sid = send_sms_with_retry(self.send_sms,
+                                          mobile_number,
+                                          message,
+                                          self.max_retries,
+                                          self.retry_backoff_seconds)
+                return BroadcastOutcome(mobile_number=mobile_number, sid=sid, error=None)
+            except Exception as err:
+                return BroadcastOutcome(mobile_number=mobile_number, sid=None, error=err)
+
+        if not mobile_numbers:
+            return []
+
+        num_workers = min(self.broadcast_concurrency, len(mobile_numbers))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            return list(executor.map(send_one, mobile_numbers))
+
+    def flush(self):
+        '''Wait for all queued messages to be delivered (or to fail).'''
+        if self.delivery_queue:
+            self.delivery_queue.drain()
+
+
+class ReferenceDataCache(object):
+    '''In-memory, process-wide copy of the (id, value) lookup tables.
+
+    Tables are loaded lazily, on first access, and reloaded once their
+    TTL has elapsed or after an explicit call to invalidate().
+    '''
+
+    def __init__(self, db_svc, table_names, **kwargs):
+        self.db_svc = db_svc
+        self.table_names = table_names
+        self.ttl_seconds = parse_number(kwargs.get('ttl_seconds'), 3600)
+        self._ids_by_value = {}
+        self._values_by_id = {}
+        self._load_times = {}
+        self._lock = threading.Lock()
+
+    def _is_stale(self, table_name):
+        load_time = self._load_times.get(table_name)
+        if load_time is None:
+            return True
+        return time.time() - load_time >= self.ttl_seconds
+
+    def _load(self, table_name):
+        LookupTable = getattr(self.db_svc.Base.classes, table_name)
+        ids_by_value = {}
+        values_by_id = {}
+        with self.db_svc.txn_scope() as session:
+            for record_id, value in session.query(LookupTable.id, LookupTable.value).all():
+                ids_by_value[value] = record_id
+                values_by_id[record_id] = value
+
+        self._ids_by_value[table_name] = ids_by_value
+        self._values_by_id[table_name] = values_by_id
+        self._load_times[table_name] = time.time()
+
+    def _table(self, table_name):
+        if table_name not in self.table_names:
+            raise Exception('%s is not a cached reference data table. Cached tables are %s.' %
+                            (table_name, self.table_names))
+
+        if self._is_stale(table_name):
+            with self._lock:
+                # another thread may have reloaded the table while we waited
+                if self._is_stale(table_name):
+                    self._load(table_name)
+
+        return (self._ids_by_value[table_name], self._values_by_id[table_name])
+
+    def lookup_id(self, table_name, value):
+        ids_by_value, _ = self._table(table_name)
+        return ids_by_value.get(value)
+
+    def lookup_ids(self, table_name, value_array):
+        ids_by_value, _ = self._table(table_name)
+        return [ids_by_value[v] for v in value_array if v in ids_by_value]
+
+    def lookup_value(self, table_name, record_id):
+        _, values_by_id = self._table(table_name)
+        return values_by_id.get(record_id)
+
+    def invalidate(self, table_name=None):
+        with self._lock:
+            if table_name is None:
+                self._load_times.clear()
+            else:
+                self._load_times.pop(table_name, None)
+
+
+CourierIdentity = namedtuple('CourierIdentity', 'id first_name last_name mobile_number email duty_status handle')
+
+
+class CourierIdentityCache(object):
+    '''In-memory, process-wide index of courier identities, keyed by courier ID,
+    normalized mobile number and live user handle.
+
+    Couriers are loaded on a cache miss (one query for the courier and its handle)
+    and reloaded once their TTL has elapsed. Code that changes a courier's duty
+    status or handle calls invalidate() after committing; other processes pick up
+    the change when their own entry expires.
+    '''
+
+    def __init__(self, db_svc, **kwargs):
+        self.db_svc = db_svc
+        self.ttl_seconds = parse_number(kwargs.get('ttl_seconds'), 60)
+        self._entries_by_id = {}
+        self._ids_by_mobile_number = {}
+        self._ids_by_handle = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, courier_id):
+        entry = self._entries_by_id.get(courier_id)
+        if entry is None:
+            return None
+
+        identity, load_time = entry
+        if time.time() - load_time >= self.ttl_seconds:
+            return None
+        return identity
+
+    def _discard(self, courier_id):
+        entry = self._entries_by_id.pop(courier_id, None)
+        if entry is None:
+            return
+
+        identity = entry[0]
+        if self._ids_by_mobile_number.get(identity.mobile_number) == courier_id:
+            self._ids_by_mobile_number.pop(identity.mobile_number)
+        if identity.handle and self._ids_by_handle.get(identity.handle) == courier_id:
+            self._ids_by_handle.pop(identity.handle)
+
+    def _store(self, identity):
+        with self._lock:
+            self._discard(identity.id)
+            self._entries_by_id[identity.id] = (identity, time.time())
+            self._ids_by_mobile_number[identity.mobile_number] = identity.id
+            if identity.handle:
+                self._ids_by_handle[identity.handle] = identity.id
+
+    def _load(self, *criteria):
+        Courier = self.db_svc.Base.classes.couriers
+        HandleMap = self.db_svc.Base.classes.user_handle_maps
+        with self.db_svc.txn_scope() as session:
+            try:
+                courier = session.query(Courier).filter(*criteria).one()
+            except NoResultFound:
+                return None
+
+            # a courier can have more than one live handle row; always report the same one
+            handle = session.query(HandleMap.handle).filter(and_(HandleMap.user_id == courier.id,
+                                                                 HandleMap.expired_ts == None)).order_by(
+                                                                     HandleMap.handle).limit(1).scalar()
+
+            identity = CourierIdentity(id=courier.id,
+                                       first_name=courier.first_name,
+                                       last_name=courier.last_name,
+                                       mobile_number=courier.mobile_number,
+                                       email=courier.email,
+                                       duty_status=courier.duty_status,
+                                       handle=handle)
+        self._store(identity)
+        return identity
+
+    def lookup_by_id(self, courier_id):
+        identity = self._cached(courier_id)
+        if identity is None:
+            Courier = self.db_svc.Base.classes.couriers
+            identity = self._load(Courier.id == courier_id)
+        return identity
+
+    def lookup_by_mobile_number(self, mobile_number):
+        identity = self._cached(self._ids_by_mobile_number.get(mobile_number))
+        if identity is None:
+            Courier = self.db_svc.Base.classes.couriers
+            identity = self._load(Courier.mobile_number == mobile_number, Courier.deleted_ts == None)
+        return identity
+
+    def lookup_by_handle(self, handle):
+        identity = self._cached(self._ids_by_handle.get(handle))
+        if identity is None:
+            HandleMap = self.db_svc.Base.classes.user_handle_maps
+            with self.db_svc.txn_scope() as session:
+                courier_id = session.query(HandleMap.user_id).filter(and_(HandleMap.handle == handle,
+                                                                          HandleMap.expired_ts == None)).order_by(
+                                                                              HandleMap.user_id).limit(1).scalar()
+            if courier_id is None:
+                return None
+
+            Courier = self.db_svc.Base.classes.couriers
+            identity = self._load(Courier.id == courier_id)
+        return identity
+
+    def invalidate(self, courier_id=None):
+        with self._lock:
+            if courier_id is None:
+                self._entries_by_id.clear()
+                self._ids_by_mobile_number.clear()
+                self._ids_by_handle.clear()
+            else:
+                self._discard(courier_id)
+
+
+SCHEMA_FINGERPRINT_QUERIES = [
+    ' '.join(['SELECT table_name, column_name, data_type, is_nullable, column_default',
+              'FROM information_schema.columns WHERE table_schema = :schema',
+              'ORDER BY table_name, ordinal_position']),
+
+    ' '.join(['SELECT table_name, constraint_name, constraint_type',
+              'FROM information_schema.table_constraints WHERE table_schema = :schema',
+              'ORDER BY table_name, constraint_name'])
+]
+
+
+def schema_fingerprint(connection, schema, table_names=None):
+    '''Return a digest of the column and constraint definitions in <schema>.
+    Any DDL change that would alter the reflected metadata changes the digest.
+    '''
+    digest = hashlib.sha256()
+    digest.update(sqla.__version__.encode())
+    digest.update(repr(sorted(table_names or [])).encode())
+    for query in SCHEMA_FINGERPRINT_QUERIES:
+        for row in connection.execute(text(query), schema=schema):
+            digest.update(repr(tuple(row)).encode())
+
+    return digest.hexdigest()
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ['true', 'yes', '1']
+
+
+def parse_number(value, default, cast=int):
+    # unlike "value or default", this keeps an explicit 0 (e.g. max_overflow: 0 for a hard cap)
+    if value is None or value == '':
+        return cast(default)
+    return cast(value)
+
+
+class ConnectionCheckoutStats(object):
+    '''Counts the connections checked out through PostgreSQLService, and how
+    long callers spent waiting for the pool to hand them over. Checkouts which
+    time out waiting for the pool, and ones which fail for any other reason
+    (the database refusing the connection, say), are counted separately from
+    the successful ones.
+    '''
+
+    def __init__(self):
+        self.waiting = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timing(self):
+        start_time = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'checkout'
+        except sqla.exc.TimeoutError:
+            outcome = 'timeout'
+            raise
+        finally:
+            wait_seconds = time.monotonic() - start_time
+            with self._lock:
+                self.waiting -= 1
+                self.total_wait_seconds += wait_seconds
+                self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+                if outcome == 'checkout':
+                    self.checkouts += 1
+                elif outcome == 'timeout':
+                    self.timeouts += 1
+                else:
+                    self.errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'waiting': self.waiting,
+                'checkouts': self.checkouts,
+                'checkout_timeouts': self.timeouts,
+                'checkout_errors': self.errors,
+                'wait_seconds': self.total_wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds,
+                'avg_wait_seconds': self.total_wait_seconds / max(1, self.checkouts + self.timeouts + self.errors)
+            }
+
+
+# Seconds a replica is behind the primary, or NULL if it is not receiving WAL at all.
+# Having replayed everything it received only means the replica is fresh while its
+# WAL receiver is running; without one, it is as stale as its last replayed transaction.
+# The receiver's status and last message time are visible only to superusers and
+# members of pg_read_all_stats; without them the check falls back on the receiver's pid.
+REPLICA_LAG_QUERY = ' '.join([
+    'SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0',
+    'WHEN receiver.pid IS NULL THEN NULL',
+    "WHEN receiver.status IS NOT NULL AND receiver.status <> 'streaming' THEN NULL",
+    'ELSE GREATEST(',
+    'EXTRACT(EPOCH FROM now() - receiver.last_msg_receipt_time),',
+    'CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0',
+    'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END,',
+    '0) END',
+    'FROM (SELECT 1) AS one LEFT JOIN pg_stat_wal_receiver AS receiver ON true'
+])
+
+
+class ReadReplica(object):
+    '''A read-only PostgreSQL endpoint, with its own engine and session factory.
+    Replication lag is measured at most once per check interval; a replica that
+    cannot be reached, or is not receiving WAL from the primary, reports no lag
+    value until the next check.
+    '''
+
+    def __init__(self, host, port, engine, **kwargs):
+        self.host = host
+        self.port = port
+        self.engine = engine
+        self.session_factory = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+        self.lag_check_interval_seconds = float(kwargs.get('lag_check_interval_seconds') or 5)
+        self.lag_seconds = None
+        self.last_check_time = None
+        self._lock = threading.Lock()
+
+    def _check_due(self):
+        return self.last_check_time is None or time.monotonic() - self.last_check_time >= self.lag_check_interval_seconds
+
+    def current_lag(self):
+        if self._check_due():
+            with self._lock:
+                if self._check_due():
+                    try:
+                        with self.engine.connect() as connection:
+                            lag_seconds = connection.execute(text(REPLICA_LAG_QUERY)).scalar()
+                        if lag_seconds is None:
+                            log.warning('replica has no live WAL receiver; not using it',
+                                        replica_host=self.host, replica_port=self.port)
+                            self.lag_seconds = None
+                        else:
+                            self.lag_seconds = float(lag_seconds)
+                    except Exception as err:
+                        log.warning('unable to check replication lag', replica_host=self.host, replica_port=self.port, error=err)
+                        self.lag_seconds = None
+                    self.last_check_time = time.monotonic()
+
+        return self.lag_seconds
+
+    def mark_unavailable(self):
+        with self._lock:
+            self.lag_seconds = None
+            self.last_check_time = time.monotonic()
+
+
+def parse_list_param(value):
+    if not value:
+        return None
+    if isinstance(value, str):
+        return [name.strip() for name in value.split(',') if name.strip()]
+    return list(value)
+
+
+def resolve_project_path(path):
+    # relative paths are taken from the project directory, not the working directory
+    if not path:
+        return None
+    path = os.path.expanduser(path)
+    if os.path.isabs(path):
+        return path
+    return os.path.join(os.environ.get('BXLOGIC_HOME') or os.getcwd(), path)
+
+
+def prepare_private_dir(path):
+    '''Create <path> with mode 0700 if it does not exist. Return True only if it
+    is a real directory (not a symlink), owned by this user, with no group or
+    other permissions.
+    '''
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        dir_stat = os.lstat(path)
+    except OSError as err:
+        log.warning('unable to create private directory', path=path, error=err)
+        return False
+
+    return (stat.S_ISDIR(dir_stat.st_mode)
+            and dir_stat.st_uid == os.geteuid()
+            and not dir_stat.st_mode & 0o077)
+
+
+def load_private_pickle(filename):
+    '''Unpickle <filename> only if it is a regular file owned by this user which
+    no one else can write to; return None if it is missing, unsafe or unreadable.
+    '''
+    try:
+        fd = os.open(filename, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+
+    with os.fdopen(fd, 'rb') as f:
+        file_stat = os.fstat(f.fileno())
+        if (not stat.S_ISREG(file_stat.st_mode)
+                or file_stat.st_uid != os.geteuid()
+                or file_stat.st_mode & 0o022):
+            log.warning('ignoring schema metadata cache file with unsafe ownership or permissions',
+                        cache_file=filename)
+            return None
+        try:
+            return pickle.load(f)
+        except Exception as err:
+            log.warning('unable to load cached schema metadata', cache_file=filename, error=err)
+            return None
+
+
+class UnitOfWork(object):
+    '''One session, and one connection, shared by everything done on behalf of a
+    single unit of work (for example, one inbound SMS message and every command
+    chained from it).
+
+    The session is opened lazily, by the first txn_scope() which is passed this
+    unit of work. Each such scope (and each read_scope() after that) runs inside a
+    SAVEPOINT, so a scope which fails rolls back only its own changes. The enclosing
+    transaction is committed once, when the unit of work ends -- unless an exception
+    escapes it, in which case everything is rolled back. Callers which want the work
+    of earlier steps kept must catch a failing step's exception inside the unit of
+    work (as DialogEngine.reply_command() does). Callbacks registered with
+    after_commit() run only after the commit succeeds.
+    '''
+
+    def __init__(self, db_svc):
+        self.db_svc = db_svc
+        self.session = None
+        self._after_commit_callbacks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.session is None:
+            return False
+
+        try:
+            if exc_type is None:
+                self.session.commit()
+            else:
+                self.session.rollback()
+        finally:
+            self.session.close()
+            self.session = None
+
+        if exc_type is None:
+            for callback in self._after_commit_callbacks:
+                callback()
+        return False
+
+    def active_session(self):
+        if self.session is None:
+            self.session = self.db_svc.session_factory()
+            with self.db_svc.checkout_stats.timing():
+                self.session.connection()
+        return self.session
+
+    def after_commit(self, callback):
+        self._after_commit_callbacks.append(callback)
+
+    @contextmanager
+    def savepoint(self):
+        session = self.active_session()
+        savepoint = session.begin_nested()
+        try:
+            yield session
+            # the caller may already have rolled back to (and so ended) the savepoint
+            if savepoint.is_active:
+                savepoint.commit()
+        except Exception:
+            if savepoint.is_active:
+                savepoint.rollback()
+            raise
+
 
 class PostgreSQLService(object):
     def __init__(self, **kwargs):
@@ -121,13 +858,36 @@ class PostgreSQLService(object):
         self.password = kwargs['password']        
         self.schema = kwargs['schema']
         self.max_connect_retries = int(kwargs.get('max_connect_retries') or 3)
+        # optional: directory for the pickled schema metadata (relative paths are under
+        # $BXLOGIC_HOME; created with mode 0700), and the subset of tables this process
+        # uses (comma-separated); the default reflects all of them
+        self.reflection_cache_dir = resolve_project_path(kwargs.get('reflection_cache_dir'))
+        self.reflect_tables = parse_list_param(kwargs.get('reflect_tables'))
+        self.pool_size = parse_number(kwargs.get('pool_size'), 5)
+        self.max_overflow = parse_number(kwargs.get('max_overflow'), 10)
+        self.pool_timeout_seconds = int(kwargs.get('pool_timeout_seconds') or 30)
+        # recycle connections before the server or a load balancer drops them (-1 disables)
+        self.pool_recycle_seconds = int(kwargs.get('pool_recycle_seconds') or 1800)
+        self.pool_pre_ping = parse_bool(kwargs.get('pool_pre_ping', False))
+        self.statement_timeout_ms = parse_number(kwargs.get('statement_timeout_ms'), 0)
+        self.checkout_stats = ConnectionCheckoutStats()
+        # optional read replicas (comma-separated host or host:port entries) for read_scope()
+        self.replica_hosts = parse_list_param(kwargs.get('replica_hosts')) or []
+        self.replica_max_lag_seconds = float(kwargs.get('replica_max_lag_seconds') or 10)
+        self.replica_lag_check_interval_seconds = float(kwargs.get('replica_lag_check_interval_seconds') or 5)
+        self.replicas = []
+        self._replica_counter = itertools.count()
+        self.refdata = ReferenceDataCache(self,
+                                          REFERENCE_DATA_TABLES,
+                                          ttl_seconds=kwargs.get('refdata_ttl_seconds'))
+        self.identities = CourierIdentityCache(self, ttl_seconds=kwargs.get('identity_cache_ttl_seconds'))
         self.metadata = None
         self.engine = None
         self.session_factory = None
         self.Base = None
         self.url = None
 
-        url_template = '{db_type}://{user}:{passwd}@{host}/{database}'
+        url_template = '{db_type}://{user}:{passwd}@{host}:{port}/{database}'
         db_url = url_template.format(db_type='postgresql+psycopg2',
                                      user=self.username,
                                      passwd=self.password,
@@ -139,24 +899,24 @@ class PostgreSQLService(object):
         connected = False
         while not connected and retries < self.max_connect_retries:
             try:
-                self.engine = sqla.create_engine(db_url, echo=False)
-                self.metadata = MetaData(schema=self.schema)
+                self.engine = self.create_engine(db_url)
+                self.metadata = self.load_metadata()
+                # the metadata is already populated, so automap only has to build the classes
                 self.Base = automap_base(bind=self.engine, metadata=self.metadata)
-                self.Base.prepare(self.engine, reflect=True)
-                self.metadata.reflect(bind=self.engine)
+                self.Base.prepare()
                 self.session_factory = sessionmaker(bind=self.engine, autoflush=False, autocommit=False)
+                self.replicas = self.create_replicas(url_template)
 
                 # this is required. See comment in SimpleRedshiftService 
                 connection = self.engine.connect()                
                 connection.close()
                 connected = True
-                print('### Connected to PostgreSQL DB.', file=sys.stderr)
+                log.info('connected to postgresql', db_host=self.host, database=self.db_name)
                 self.url = db_url
 
             except Exception as err:
-                print(err, file=sys.stderr)
-                print(err.__class__.__name__, file=sys.stderr)
-                print(err.__dict__, file=sys.stderr)
+                log.error('unable to connect to postgresql', db_host=self.host, attempt=retries + 1,
+                          error_type=err.__class__.__name__, error=err)
                 time.sleep(1)
                 retries += 1
 
@@ -164,10 +924,115 @@ class PostgreSQLService(object):
             raise Exception('!!! Unable to connect to PostgreSQL db on host %s at port %s.' % 
                             (self.host, self.port))
 
+    def create_engine(self, db_url):
+        connect_args = {}
+        if self.statement_timeout_ms:
+            # applied server-side to every statement on every pooled connection
+            connect_args['options'] = '-c statement_timeout=%d' % self.statement_timeout_ms
+
+        return sqla.create_engine(db_url,
+                                  echo=False,
+                                  pool_size=self.pool_size,
+                                  max_overflow=self.max_overflow,
+                                  pool_timeout=self.pool_timeout_seconds,
+                                  pool_recycle=self.pool_recycle_seconds,
+                                  pool_pre_ping=self.pool_pre_ping,
+                                  connect_args=connect_args)
+
+    def create_replicas(self, url_template):
+        replicas = []
+        for replica_host in self.replica_hosts:
+            host, _, port = replica_host.partition(':')
+            port = int(port or self.port)
+            replica_url = url_template.format(db_type='postgresql+psycopg2',
+                                              user=self.username,
+                                              passwd=self.password,
+                                              host=host,
+                                              port=port,
+                                              database=self.db_name)
+            replicas.append(ReadReplica(host,
+                                        port,
+                                        self.create_engine(replica_url),
+                                        lag_check_interval_seconds=self.replica_lag_check_interval_seconds))
+        return replicas
+
+    def choose_replica(self):
+        '''Return the next replica (round robin) that is reachable and within
+        replica_max_lag_seconds of the primary, or None if there is no such replica.
+        '''
+        for i in range(len(self.replicas)):
+            replica = self.replicas[next(self._replica_counter) % len(self.replicas)]
+            lag_seconds = replica.current_lag()
+            if lag_seconds is not None and lag_seconds <= self.replica_max_lag_seconds:
+                return replica
+        return None
+
+    def pool_stats(self):
+        '''Live connection pool statistics for this process.'''
+        pool = self.engine.pool
+        stats = {
+            'pool_size': pool.size(),
+            'max_overflow': self.max_overflow,
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': pool.overflow()
+        }
+        stats.update(self.checkout_stats.snapshot())
+        return stats
+
+    def reflect_metadata(self):
+        metadata = MetaData(schema=self.schema)
+        metadata.reflect(bind=self.engine, only=self.reflect_tables)
+        return metadata
+
+    def load_metadata(self):
+        '''Return the reflected schema metadata, from the local cache file if one
+        matches the live schema's fingerprint, and by live reflection otherwise
+        (writing a new cache file for the next process to start).
+        '''
+        if not self.reflection_cache_dir:
+            return self.reflect_metadata()
+
+        with self.connect() as connection:
+            fingerprint = schema_fingerprint(connection, self.schema, self.reflect_tables)
+
+        # the cache is unpickled, so only a directory nobody else can write to will do
+        if not prepare_private_dir(self.reflection_cache_dir):
+            log.warning('schema metadata cache directory is not private to this user; not using it',
+                        cache_dir=self.reflection_cache_dir)
+            return self.reflect_metadata()
+
+        cache_filename = os.path.join(self.reflection_cache_dir,
+                                      '%s.%s.%s.metadata' % (self.db_name, self.schema, fingerprint))
+        metadata = load_private_pickle(cache_filename)
+        if metadata is not None:
+            return metadata
+
+        metadata = self.reflect_metadata()
+        try:
+            # write-then-rename, so that a process starting concurrently never reads a partial file
+            tmp_filename = '%s.%d.tmp' % (cache_filename, os.getpid())
+            fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(metadata, f)
+            os.replace(tmp_filename, cache_filename)
+        except (IOError, OSError) as err:
+            log.warning('unable to write schema metadata cache', cache_file=cache_filename, error=err)
+
+        return metadata
+
     @contextmanager
-    def txn_scope(self):
+    def txn_scope(self, unit_of_work=None):
+        if unit_of_work is not None:
+            with unit_of_work.savepoint() as session:
+                yield session
+            return
+
         session = self.session_factory()
         try:
+            # check out the connection up front, so that time spent queueing on the pool is measured
+            with self.checkout_stats.timing():
+                session.connection()
             yield session
             session.commit()
         except Exception:
@@ -176,9 +1041,53 @@ class PostgreSQLService(object):
         finally:
             session.close()
 
+    def unit_of_work(self):
+        return UnitOfWork(self)
+
+    @contextmanager
+    def read_scope(self, unit_of_work=None, use_replica=True):
+        '''Session scope for read-only work. The session is bound to a replica
+        within the staleness bound when one is available (and <use_replica> is
+        set), and to the primary otherwise. Nothing done in a read scope is ever
+        committed.
+
+        If <unit_of_work> has already opened its session, the read shares it,
+        and so sees the changes made earlier in the same unit of work.
+        '''
+        if unit_of_work is not None and unit_of_work.session is not None:
+            # a failed read would otherwise abort the whole unit's transaction
+            with unit_of_work.savepoint() as session:
+                yield session
+            return
+
+        session = None
+        replica = self.choose_replica() if use_replica else None
+        if replica is not None:
+            session = replica.session_factory()
+            try:
+                session.connection()
+            except sqla.exc.OperationalError as err:
+                log.warning('replica unavailable; reading from the primary',
+                            replica_host=replica.host, replica_port=replica.port, error=err)
+                replica.mark_unavailable()
+                session.close()
+                session = None
+
+        if session is None:
+            session = self.session_factory()
+            with self.checkout_stats.timing():
+                session.connection()
+
+        try:
+            yield session
+        finally:
+            session.rollback()
+            session.close()
+
     @contextmanager
     def connect(self):
-        connection = self.engine.connect()
+        with self.checkout_stats.timing():
+            connection = self.engine.connect()
         try:
             yield connection
         finally:
@@ -231,7 +1140,7 @@ class S3Service(object):
         should_authenticate_via_iam = kwargs.get('auth_via_iam', False)
 
         if not should_authenticate_via_iam:
-            print("NOT authenticating via IAM. Setting credentials now.", file=sys.stderr)
+            log.info('not authenticating via IAM; using configured credentials')
             self.aws_access_key_id = kwargs.get('aws_key_id')
             self.aws_secret_access_key = kwargs.get('aws_secret_key')
             if not self.aws_secret_access_key or not self.aws_access_key_id:
@@ -288,6 +1197,16 @@ class BXLogicAPIService(object):
         self.hostname = kwreader.get_value('host')
         self.port = int(kwreader.get_value('port'))
 
+        self.pool_size = int(kwargs.get('pool_size') or 10)
+        self.timeout = (float(kwargs.get('connect_timeout_seconds') or 3.05),
+                        float(kwargs.get('read_timeout_seconds') or 10))
+        # retries apply to connection failures and 502-504 responses on idempotent (GET) calls only
+        self.max_retries = parse_number(kwargs.get('max_retries'), 0)
+        self.retry_backoff_factor = parse_number(kwargs.get('retry_backoff_factor'), 0.3, float)
+        self._http_session = None
+        self._session_pid = None
+        self._url_cache = {}
+
         self.poll_job = APIEndpoint(host=self.hostname, port=self.port, path='job', method='GET')
         self.update_job_status = APIEndpoint(host=self.hostname, port=self.port, path='jobstatus', method='POST')
         self.update_job_log = APIEndpoint(host=self.hostname, port=self.port, path='joblog', method='POST')
@@ -295,6 +1214,27 @@ class BXLogicAPIService(object):
         self.couriers = APIEndpoint(host=self.hostname, port=self.port, path='couriers', method='GET')
         self.bidstat = APIEndpoint(host=self.hostname, port=self.port, path='bidstat', method='GET')
         self.award = APIEndpoint(host=self.hostname, port=self.port, path='award', method='POST')
+        self.award_many = APIEndpoint(host=self.hostname, port=self.port, path='awards', method='POST')
+        self.arbsnap = APIEndpoint(host=self.hostname, port=self.port, path='arbsnap', method='GET')
+        self.broadcasts = APIEndpoint(host=self.hostname, port=self.port, path='broadcasts', method='POST')
+
+    def http_session(self):
+        # pooled sockets must not be shared across a fork, so each process builds its own session
+        if self._http_session is None or self._session_pid != os.getpid():
+            retry_policy = Retry(total=self.max_retries,
+                                 backoff_factor=self.retry_backoff_factor,
+                                 status_forcelist=[502, 503, 504],
+                                 raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=self.pool_size,
+                                  max_retries=retry_policy)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._http_session = session
+            self._session_pid = os.getpid()
+
+        return self._http_session
 
     def endpoint_url(self, api_endpoint, **kwargs):
         if kwargs.get('ssl') is True:
@@ -302,20 +1242,23 @@ class BXLogicAPIService(object):
         else:
             scheme = 'http'
 
-        url = '{scheme}://{host}:{port}'.format(scheme=scheme,
-                                                host=api_endpoint.host,
-                                                port=api_endpoint.port)
+        url = self._url_cache.get((scheme, api_endpoint))
+        if url is None:
+            url = '{scheme}://{host}:{port}/{path}'.format(scheme=scheme,
+                                                          host=api_endpoint.host,
+                                                          port=api_endpoint.port,
+                                                          path=api_endpoint.path)
+            self._url_cache[(scheme, api_endpoint)] = url
 
-        return os.path.join(url, api_endpoint.path)
+        return url
 
     def _call_endpoint(self, endpoint, payload, **kwargs):        
         url_path = self.endpoint_url(endpoint, **kwargs)
+        log.debug_sampled('calling endpoint', url=url_path, method=endpoint.method, payload=payload)
         if endpoint.method == 'GET':
-            print('calling endpoint %s using GET with payload %s...' % (url_path, payload))
-            return requests.get(url_path, params=payload)
+            return self.http_session().get(url_path, params=payload, timeout=self.timeout)
         if endpoint.method == 'POST':
-            print('calling endpoint %s using POST with payload %s...' % (url_path, payload))
-            return requests.post(url_path, json=payload)
+            return self.http_session().post(url_path, json=payload, timeout=self.timeout)
 
     def award_job(self, bid_window_id, bidder_array, **kwargs):
         payload = {
@@ -323,16 +1266,43 @@ class BXLogicAPIService(object):
             'bids': bidder_array
         }
 
-        print('PAYLOAD for calling /award endpoint:')
-        print(common.jsonpretty(payload))
-
         response = self._call_endpoint(self.award, payload, **kwargs)
         return response
 
+    def award_jobs(self, awards, **kwargs):
+        '''Award several bidding windows in one call. <awards> is a list of
+        {"window_id": ..., "bids": [...]} dictionaries.
+        '''
+        payload = {
+            'awards': awards
+        }
+        return self._call_endpoint(self.award_many, payload, **kwargs)
+
     def get_open_bid_windows(self, **kwargs):
         payload = {}
         return self._call_endpoint(self.bidstat, payload, **kwargs)
 
+    def get_arbitration_snapshot(self, window_ids=None, **kwargs):
+        payload = {}
+        if window_ids is not None:
+            payload['window_ids'] = ','.join(window_ids)
+        return self._call_endpoint(self.arbsnap, payload, **kwargs)
+
+    def update_job_broadcast(self, job_tag, action, lease_seconds=None, **kwargs):
+        '''Claim, complete or release the broadcast of a job (see job_broadcast_func
+        in bx_transforms). Returns the broadcast status reported by the API.
+        '''
+        payload = {'job_tag': job_tag, 'action': action}
+        if lease_seconds is not None:
+            payload['lease_seconds'] = lease_seconds
+
+        response = self._call_endpoint(self.broadcasts, payload, **kwargs)
+        if not response:
+            raise APIError(self.endpoint_url(self.broadcasts),
+                           self.broadcasts.method,
+                           response.status_code)
+        return response.json()['data']['broadcast_status']
+
     def get_active_job_bids(self, job_tag, **kwargs):
         payload = {'job_tag': job_tag}
         response = self._call_endpoint(self.poll_job_bids,
@@ -348,7 +1318,7 @@ class BXLogicAPIService(object):
         return response
 
     def notify_job_completed(self, job_tag, **kwargs):
-        print('### signaling completion for job tag %s' % job_tag)
+        log.info('signaling job completion', job_tag=job_tag)
         payload = {'job_tag': job_tag, 'status': 'completed'}
         response = self._call_endpoint(self.update_job_status,
                                        payload)
@@ -358,7 +1328,7 @@ class BXLogicAPIService(object):
                            response.status_code)
 
     def notify_job_canceled(self, job_tag, **kwargs):
-        print('### --- signaling cancellation for job tag %s' % job_tag)
+        log.info('signaling job cancellation', job_tag=job_tag)
         response = self._call_endpoint(self.update_job_status,
                                        {'job_tag': job_tag,
                                         'status': 'canceled'})
@@ -368,7 +1338,7 @@ class BXLogicAPIService(object):
                            response.status_code)
 
     def send_log_msg(self, job_tag, raw_message):
-        print('### sending message to joblog for tag %s' % job_tag)
+        log.debug('sending message to job log', job_tag=job_tag)
         message = urllib.parse.quote(raw_message)
         self._call_endpoint(self.update_job_log,
                             {'job_tag': job_tag,
@@ -1,23 +1,41 @@
 #!/usr/bin/env python
 
-import sys
 import re
 import uuid
 import json
-import traceback
 import datetime
 from urllib.parse import unquote_plus
-from collections import namedtuple
-from snap import snap, common
+from collections import namedtuple, OrderedDict, Counter
+from snap import snap
 from snap import core
 # from snap.loggers import transform_logger as log
 # from sqlalchemy.sql import text
 import git
-# import constants as const
+from constants import (JOB_STATUS_BROADCAST,
+                       JOB_STATUS_AWARDED,
+                       JOB_STATUS_ACCEPTED,
+                       JOB_STATUS_IN_PROGRESS,
+                       JOB_STATUS_COMPLETED,
+                       JOB_BROADCAST_CLAIMED,
+                       JOB_BROADCAST_IN_PROGRESS,
+                       JOB_BROADCAST_COMPLETED,
+                       JOB_BROADCAST_RELEASED)
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy import and_, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
-from bxcommon import ListOutputResponder
+from bxcommon import ListOutputResponder, CommandGrammar
+import bxmetrics
+from bx_jobviews import (list_accepted_jobs,
+                         awarded_jobs_view,
+                         accepted_jobs_view,
+                         in_progress_jobs_view,
+                         available_jobs_view,
+                         user_bids_view)
+import bxlogging
+
+
+log = bxlogging.get_logger(__name__)
 
 '''
 TODO: if a job's core information changes AFTER the job has been accepted, auto-generate message(s) for the courier
@@ -56,7 +74,8 @@ SMS_SYSTEM_COMMAND_SPECS = {
     'mdel': SMSCommandSpec(command='mdel', definition='Delete a user message', synonyms=[], tag_required=False),
     'fin': SMSCommandSpec(command='fin', definition='Finished a delivery', synonyms=['f'], tag_required=True),
     '911': SMSCommandSpec(command='911', definition='Courier is having a problem and needs assistance', synonyms=[], tag_required=False),
-    'hlp': SMSCommandSpec(command='hlp', definition='Display help prompts', synonyms=['?'], tag_required=False)
+    'hlp': SMSCommandSpec(command='hlp', definition='Display help prompts', synonyms=['?'], tag_required=False),
+    'nxt': SMSCommandSpec(command='nxt', definition='Show the next page of the last list', synonyms=['more'], tag_required=False)
 }
 
 SMS_GENERATOR_COMMAND_SPECS = {
@@ -76,6 +95,10 @@ SMS_PREFIX_COMMAND_SPECS = {
     '#': SMSPrefixSpec(command='#', definition='look up an abbreviation', defchar=':')
 }
 
+SMS_COMMAND_GRAMMAR = CommandGrammar(SMS_SYSTEM_COMMAND_SPECS,
+                                     SMS_GENERATOR_COMMAND_SPECS,
+                                     SMS_PREFIX_COMMAND_SPECS)
+
 SMS_RESPONSES = {
     'assign_job': 'Thank you for responding -- job tag {tag} has been assigned to you.',
     'assigned_to_other': 'Another courier in the network responded first, but thank you for stepping up.'
@@ -104,14 +127,9 @@ REPLY_GET_INVOLVED_TPL = "If you'd like to become a courier, please send email t
 REPLY_CMD_FORMAT = "You have texted a command that requires a job tag. Text the job tag, a space, and then the command."
 REPLY_CMD_HELP_AVAILABLE = 'Text "help" to the target number to get a list of command strings and what they do.'
 REPLY_INVALID_TAG_TPL = 'The job tag you have specified (%s) appears to be invalid.'
+REPLY_COMMAND_FAILED_TPL = 'Sorry, we were unable to complete the "%s" command. Please try it again.'
 
 
-JOB_STATUS_BROADCAST = 0
-JOB_STATUS_AWARDED = 1
-JOB_STATUS_ACCEPTED = 3
-JOB_STATUS_IN_PROGRESS = 4
-JOB_STATUS_COMPLETED = 5
-
 
 def generate_assign_job_reply(**kwargs):
     return REPLY_ASSIGN_JOB_TPL.format(**kwargs)
@@ -182,6 +200,11 @@ class ObjectFactory(object):
         JobStatus = db_svc.Base.classes.job_status
         return JobStatus(**kwargs)
 
+    @classmethod
+    def create_job_current_status(cls, db_svc, **kwargs):
+        JobCurrentStatus = db_svc.Base.classes.job_current_status
+        return JobCurrentStatus(**kwargs)
+
     @classmethod
     def create_job_bid(cls, db_svc, **kwargs):
         JobBid = db_svc.Base.classes.job_bids
@@ -224,39 +247,16 @@ class ObjectFactory(object):
 
 
 def lookup_transport_method_ids(name_array, session, db_svc):
-    TransportMethod = db_svc.Base.classes.transport_methods
-    ids = []
-    for name in name_array:
-        # one() will throw an exception if no match
-        try:
-            result = session.query(TransportMethod).filter(TransportMethod.value == name).one()
-            ids.append(result.id)
-        except NoResultFound:
-            pass
-
-    return ids
+    # names with no match in the lookup table are skipped
+    return db_svc.refdata.lookup_ids('transport_methods', name_array)
 
 
 def lookup_borough_ids(name_array, session, db_svc):
-    Borough = db_svc.Base.classes.boroughs
-    ids = []
-    for name in name_array:
-        try:
-            result = session.query(Borough).filter(Borough.value == name).one()
-            ids.append(result.id)
-        except NoResultFound:
-            pass
-
-    return ids
+    return db_svc.refdata.lookup_ids('boroughs', name_array)
 
 
 def lookup_payment_method_id(name, session, db_svc):
-    PaymentMethod = db_svc.Base.classes.lookup_payment_methods
-    try:    
-        method = session.query(PaymentMethod).filter(PaymentMethod.value == name).one()
-        return method.id
-    except NoResultFound:
-        return None
+    return db_svc.refdata.lookup_id('lookup_payment_methods', name)
 
 
 def lookup_couriers_by_status(status, session, db_svc):
@@ -323,6 +323,64 @@ def lookup_open_bidding_windows(session, db_svc):
         yield record
 
 
+def prepare_bidding_window_record(bwindow):
+    return {
+        'bidding_window_id': bwindow.id,
+        'job_id': bwindow.job_id,
+        'job_tag': bwindow.job_tag,
+        'policy': bwindow.policy,
+        'open_ts': bwindow.open_ts.isoformat()
+    }
+
+
+def prepare_bidder_record(courier, job_bid):
+    return {
+        'bid_id': job_bid.id,
+        'job_tag': job_bid.job_tag,
+        'courier_id': courier.id,
+        'first_name': courier.first_name,
+        'last_name': courier.last_name,
+        'mobile_number': courier.mobile_number
+    }
+
+
+def lookup_arbitration_snapshot(session, db_svc, window_ids=None):
+    '''Return every open bidding window (or, if <window_ids> is given, every open
+    one of those), with its policy and all of its live (unexpired, not yet
+    accepted) bids, using a single joined query.
+    '''
+    current_time = datetime.datetime.now()
+    BiddingWindow = db_svc.Base.classes.bidding_windows
+    JobBid = db_svc.Base.classes.job_bids
+    Courier = db_svc.Base.classes.couriers
+
+    query = session.query(BiddingWindow, JobBid, Courier).outerjoin(
+        JobBid, and_(JobBid.job_tag == BiddingWindow.job_tag,
+                     JobBid.accepted_ts == None,
+                     JobBid.expired_ts == None)).outerjoin(
+        Courier, Courier.id == JobBid.courier_id).filter(
+        and_(BiddingWindow.open_ts <= current_time,
+             or_(BiddingWindow.close_ts == None,
+                 BiddingWindow.close_ts > current_time)))
+
+    if window_ids is not None:
+        query = query.filter(BiddingWindow.id.in_(window_ids))
+    query = query.order_by(BiddingWindow.open_ts)
+
+    windows = OrderedDict()
+    for bwindow, job_bid, courier in query.all():
+        window_record = windows.get(bwindow.id)
+        if window_record is None:
+            window_record = prepare_bidding_window_record(bwindow)
+            window_record['bidders'] = []
+            windows[bwindow.id] = window_record
+
+        if job_bid is not None and courier is not None:
+            window_record['bidders'].append(prepare_bidder_record(courier, job_bid))
+
+    return list(windows.values())
+
+
 def lookup_live_courier_handle(courier_id, session, db_svc):
     UserHandle = db_svc.Base.classes.user_handle_maps
     try:
@@ -333,24 +391,14 @@ def lookup_live_courier_handle(courier_id, session, db_svc):
 
 
 def lookup_courier_by_handle(handle, session, db_svc):
-    HandleMap = db_svc.Base.classes.user_handle_maps
-    try:
-        handle_map = session.query(HandleMap).filter(and_(HandleMap.handle == handle,
-                                                          HandleMap.expired_ts == None)).one()
-
-        return lookup_courier_by_id(handle_map.user_id, session, db_svc)
-
-    except NoResultFound:
-        return None
+    # returns a CourierIdentity (see bx_services), not a mapped courier record
+    return db_svc.identities.lookup_by_handle(handle)
 
 
 def lookup_current_job_status(job_tag, session, db_svc):
-    JobStatus = db_svc.Base.classes.job_status
-    try:
-        return session.query(JobStatus).filter(and_(JobStatus.job_tag == job_tag,
-                                                    JobStatus.expired_ts == None)).one()
-    except NoResultFound:
-        return None
+    # job_current_status holds exactly one row per job, keyed by job tag
+    JobCurrentStatus = db_svc.Base.classes.job_current_status
+    return session.query(JobCurrentStatus).get(job_tag)
 
 
 def lookup_user_job_bid(job_tag, courier_id, session, db_svc):
@@ -373,27 +421,15 @@ def lookup_bid_by_id(bid_id, session, db_svc):
 
 
 def job_is_available(job_tag, session, db_svc):
-    JobStatus = db_svc.Base.classes.job_status
-    try:
-        # status 0 is "broadcast" (available for bidding)
-        session.query(JobStatus).filter(and_(JobStatus.expired_ts == None,
-                                             JobStatus.job_tag == job_tag, 
-                                             JobStatus.status == JOB_STATUS_BROADCAST)).one()
-        return True
-    except NoResultFound:
-        return False
+    # status 0 is "broadcast" (available for bidding)
+    current_status = lookup_current_job_status(job_tag, session, db_svc)
+    return current_status is not None and current_status.status == JOB_STATUS_BROADCAST
 
 
 def job_is_awarded(job_tag, session, db_svc):
-    JobStatus = db_svc.Base.classes.job_status
-    try:
-        # status 1 is "awarded" (bidding is complete and there is a winner)
-        session.query(JobStatus).filter(and_(JobStatus.expired_ts == None,
-                                             JobStatus.job_tag == job_tag, 
-                                             JobStatus.status == JOB_STATUS_AWARDED)).one()
-        return True
-    except NoResultFound:
-        return False
+    # status 1 is "awarded" (bidding is complete and there is a winner)
+    current_status = lookup_current_job_status(job_tag, session, db_svc)
+    return current_status is not None and current_status.status == JOB_STATUS_AWARDED
 
 
 def job_belongs_to_courier(job_tag, courier_id, session, db_svc):
@@ -406,91 +442,6 @@ def job_belongs_to_courier(job_tag, courier_id, session, db_svc):
         return False
 
 
-def list_user_bids(courier_id, session, db_svc):
-    BidWindow = db_svc.Base.classes.bidding_windows
-    JobBid = db_svc.Base.classes.job_bids
-
-    bids = []
-    for window, bid in session.query(BidWindow, JobBid).filter(and_(JobBid.bidding_window_id == BidWindow.id,
-                                                                    BidWindow.close_ts == None,
-                                                                    JobBid.courier_id == courier_id,
-                                                                    JobBid.expired_ts == None)).all():
-        bids.append({
-            'bid_id': bid.id,
-            'window_id': window.id,
-            'job_tag': bid.job_tag,
-            'timestamp': bid.write_ts
-        })
-
-    return bids
-
-
-def list_awarded_jobs(courier_id, session, db_svc):
-    jobs = []
-    JobBid = db_svc.Base.classes.job_bids
-
-    for bid in session.query(JobBid).filter(and_(JobBid.courier_id == courier_id,
-                                                 JobBid.expired_ts == None,
-                                                 JobBid.accepted_ts != None)).all():
-
-        if job_is_awarded(bid.job_tag, session, db_svc):
-            job = lookup_job_data_by_tag(bid.job_tag, session, db_svc)
-            if not job:
-                raise Exception('There is an orphan job in this dataset. Please contact your administrator.')
-            else:
-                jobs.append(job)
-
-    return jobs
-
-    '''
-    # status 1 is "awarded" (granted to winning bidder, but not yet accepted)
-    status_record = session.query(JobStatus).filter(and_(JobStatus.expired_ts == None,
-                                                            JobStatus.job_tag == job_tag, 
-                                                            JobStatus.status == 1)).one()
-    '''
-
-
-def list_accepted_jobs(courier_id, session, db_svc):
-    JobAssignment = db_svc.Base.classes.job_assignments
-    JobStatus = db_svc.Base.classes.job_status
-    # resultset = session.query(JobAssignment).filter(JobAssignment.courier_id == dlg_context.courier.id).all()
-    jobs = []
-    for ja, stat in session.query(JobAssignment,
-                                  JobStatus).filter(and_(JobStatus.job_tag == JobAssignment.job_tag,
-                                                         JobStatus.status == JOB_STATUS_ACCEPTED,
-                                                         JobStatus.expired_ts == None,
-                                                         JobAssignment.courier_id == courier_id)).all():
-        jobs.append(stat)
-
-    return jobs
-
-
-def list_available_jobs(session, db_svc):
-    jobs = []
-    JobStatus = db_svc.Base.classes.job_status
-    resultset = session.query(JobStatus).filter(and_(JobStatus.expired_ts == None,
-                                                     JobStatus.status == 0)).all()
-    for record in resultset:
-        jobs.append(record)
-
-    return jobs
-
-
-def list_in_progress_jobs_for_courier(courier_id, session, db_svc):
-    jobs = []
-
-    JobAssignment = db_svc.Base.classes.job_assignments
-    JobStatus = db_svc.Base.classes.job_status
-
-    for jas, jstat in session.query(JobAssignment, JobStatus).filter(and_(JobAssignment.job_tag == JobStatus.job_tag,
-                                                                          JobStatus.expired_ts == None,
-                                                                          JobStatus.status == JOB_STATUS_IN_PROGRESS,
-                                                                          JobAssignment.courier_id == courier_id)).all():
-
-        jobs.append(jstat)
-    return jobs
-
-
 def prepare_courier_record(input_data, session, db_svc):
     output_record = copy_fields_from(input_data, 'first_name', 'last_name', 'email')
     output_record['mobile_number'] = normalize_mobile_number(input_data['mobile_number'])
@@ -555,24 +506,33 @@ def exception_status(err, **kwargs):
     return json.dumps(result)
 
 
-def update_job_status(job_tag, new_status, session, db_svc):
-    current_time = datetime.datetime.now()
+def update_job_status(job_tag, new_status, session, db_svc, **kwargs):
+    '''Set the current status of a job, creating its job_current_status row if
+    there is none, and append the transition to the job_status history.
+    Returns False if the job was already in the requested status.
+    '''
+    current_time = kwargs.get('timestamp') or datetime.datetime.now()
     current_status_record = lookup_current_job_status(job_tag, session, db_svc)
-    if current_status_record.status == new_status:
+    if current_status_record is None:
+        current_status_record = ObjectFactory.create_job_current_status(db_svc,
+                                                                        job_tag=job_tag,
+                                                                        status=new_status,
+                                                                        write_ts=current_time)
+    elif current_status_record.status == new_status:
         return False
-    
-    print('### updating the status for job tag %s...' % job_tag)
+    else:
+        current_status_record.status = new_status
+        current_status_record.write_ts = current_time
 
-    # expire the existing status
-    current_status_record.expired_ts = current_time
+    log.debug('updating job status', job_tag=job_tag, new_status=new_status)
     session.add(current_status_record)
 
-    # add a new status record
-    new_job_status = ObjectFactory.create_job_status(db_svc,
+    # job_status is an append-only audit log of every transition
+    history_record = ObjectFactory.create_job_status(db_svc,
                                                      job_tag=job_tag,
                                                      status=new_status,
                                                      write_ts=current_time)
-    session.add(new_job_status)
+    session.add(history_record)
     return True
 
 
@@ -626,11 +586,7 @@ def new_job_func(input_data, service_objects, **kwargs):
             session.flush()
             job_id = job.id
 
-            status_record = ObjectFactory.create_job_status(db_svc,
-                                                            job_tag=raw_record['job_tag'],
-                                                            status=0,
-                                                            write_ts=datetime.datetime.now())
-            session.add(status_record)
+            update_job_status(raw_record['job_tag'], JOB_STATUS_BROADCAST, session, db_svc)
 
             # we've created a job, now open it up for bids
             bidding_window = ObjectFactory.create_bidding_window(db_svc,
@@ -668,29 +624,11 @@ def new_client_func(input_data, service_objects, **kwargs):
 
 
 def lookup_sms_command(cmd_string):
-    for key, cmd_spec in SMS_SYSTEM_COMMAND_SPECS.items():
-        if cmd_string == key:
-            return cmd_spec
-        if cmd_string in cmd_spec.synonyms:
-            return cmd_spec
-
-    return None
+    return SMS_COMMAND_GRAMMAR.lookup_system_command(cmd_string)
 
 
 def lookup_generator_command(cmd_string):
-    for key, cmd_spec in SMS_GENERATOR_COMMAND_SPECS.items():
-        delimiter = cmd_spec.specifier
-        filter_char = cmd_spec.filterchar
-
-        print('the filter character is [%s].' % filter_char)
-
-        if cmd_string.split(delimiter)[0] == key:
-            return cmd_spec
-
-        if cmd_string.split(filter_char)[0] == key:
-            return cmd_spec
-
-    return None
+    return SMS_COMMAND_GRAMMAR.lookup_generator_command(cmd_string)
 
 
 class UnrecognizedSMSCommand(Exception):
@@ -718,16 +656,13 @@ def parse_sms_message_body(raw_body):
     # make sure there's no leading whitespace, then see what we've got
     body = unquote_plus(raw_body).lstrip().rstrip().lower()
 
-    print('\n\n###__________ inside parse logic. Raw message body is:')
-    print(body)
-    print('###__________\n\n')
+    log.debug_sampled('parsing message body', body=body)
 
     if body.startswith('bxlog-'):
         # remove the URL encoded whitespace chars;
         # remove any trailing/leading space chars as well
         tokens = [token.lstrip().rstrip() for token in body.split(' ') if token]
 
-        print('###------ message tokens: %s' % common.jsonpretty(tokens))
 
         job_tag = tokens[0]
         if len(tokens) == 2:
@@ -737,7 +672,6 @@ def parse_sms_message_body(raw_body):
             command_string = tokens[1].lower()
             modifiers = tokens[2:]
 
-        print('#--------- looking up system SMS command: %s...' % command_string)
         command_spec = lookup_sms_command(command_string)
         if command_spec:
             return CommandInput(cmd_type='syscommand', cmd_object=SystemCommand(job_tag=job_tag,
@@ -745,10 +679,9 @@ def parse_sms_message_body(raw_body):
                                                                                 modifiers=modifiers))
         raise UnrecognizedSMSCommand(command_string)
 
-    elif body[0] in SMS_PREFIX_COMMAND_SPECS.keys():
+    elif SMS_COMMAND_GRAMMAR.lookup_prefix_command(body[0]):
         prefix = body[0]
-        prefix_spec = SMS_PREFIX_COMMAND_SPECS[prefix]
-        print('### probable prefix command "%s". Body length is %d.' % (prefix, len(body)))
+        prefix_spec = SMS_COMMAND_GRAMMAR.lookup_prefix_command(prefix)
         if len(body) == 1:
             raise IncompletePrefixCommand(command_string)
 
@@ -779,10 +712,8 @@ def parse_sms_message_body(raw_body):
         # see if we received a generator 
         # (a command which generates a list or a slice of a list)
 
-        print('******************* LOOKING UP GENERATOR CMD for string [%s]...' % command_string)
         command_spec = lookup_generator_command(command_string)
         if command_spec:
-            print('###------------ detected GENERATOR-type command: %s' % command_string)            
             return CommandInput(cmd_type='generator',
                                 cmd_object=GeneratorCommand(cmd_string=command_string,
                                                             cmdspec=command_spec,
@@ -791,7 +722,6 @@ def parse_sms_message_body(raw_body):
         # if we didn't find a generator, perhaps the user issued a regular sms comand                                             
         command_spec = lookup_sms_command(command_string)
         if command_spec:
-            print('###------------ detected system command: %s' % command_string)
             return CommandInput(cmd_type='syscommand',
                                 cmd_object=SystemCommand(job_tag=job_tag,
                                                          cmdspec=command_spec,
@@ -803,11 +733,60 @@ def parse_sms_message_body(raw_body):
 def lookup_courier_by_mobile_number(mobile_number, session, db_svc):
     Courier = db_svc.Base.classes.couriers
     try:
-        return session.query(Courier).filter(Courier.mobile_number == mobile_number).one()
+        return session.query(Courier).filter(and_(Courier.mobile_number == mobile_number,
+                                                  Courier.deleted_ts == None)).one()
     except:
         return None
 
 
+def lookup_list_cursor(courier_id, session, db_svc):
+    ListCursor = db_svc.Base.classes.list_cursors
+    return session.query(ListCursor).get(courier_id)
+
+
+def save_list_cursor(courier_id, command_string, next_offset, session, db_svc):
+    '''Record where the courier's next "nxt" should resume a paged listing,
+    or clear the cursor if the listing has no more pages (next_offset is None).
+    '''
+    ListCursor = db_svc.Base.classes.list_cursors
+    if next_offset is None:
+        session.query(ListCursor).filter(ListCursor.courier_id == courier_id).delete(synchronize_session=False)
+        return
+
+    values = {
+        'courier_id': courier_id,
+        'command_string': command_string,
+        'next_offset': next_offset,
+        'write_ts': datetime.datetime.now()
+    }
+    statement = pg_insert(ListCursor.__table__).values(**values)
+    session.execute(statement.on_conflict_do_update(index_elements=['courier_id'],
+                                                    set_={'command_string': statement.excluded.command_string,
+                                                          'next_offset': statement.excluded.next_offset,
+                                                          'write_ts': statement.excluded.write_ts}))
+
+
+def list_cursor_saver(cmd_object, dlg_context, service_registry):
+    '''Return an on_page callback (see ListOutputResponder.generate) which stores
+    the courier's position in the listing produced by <cmd_object>.
+    '''
+    def save_cursor(next_offset):
+        db_svc = service_registry.lookup('postgres')
+        if next_offset is None:
+            # most listings fit on one page and most couriers have no cursor to clear, so
+            # check before writing; the check reads the primary, which "nxt" also reads
+            with db_svc.read_scope(dlg_context.unit_of_work, use_replica=False) as session:
+                if lookup_list_cursor(dlg_context.courier.id, session, db_svc) is None:
+                    return
+
+        # listings may be read from a replica; the cursor is always written to the primary,
+        # as part of the message's unit of work
+        with db_svc.txn_scope(dlg_context.unit_of_work) as session:
+            save_list_cursor(dlg_context.courier.id, cmd_object.cmd_string, next_offset, session, db_svc)
+
+    return save_cursor
+
+
 def lookup_macro(courier_id, macro_name, session, db_svc):
     Macro = db_svc.Base.classes.user_macros
     try:
@@ -817,20 +796,41 @@ def lookup_macro(courier_id, macro_name, session, db_svc):
 
 
 def courier_is_on_duty(courier_id, session, db_svc):
-    Courier = db_svc.Base.classes.couriers
-    try:
-        courier = session.query(Courier).filter(Courier.id == courier_id).one()
-        if courier.duty_status == 1:
-            return True
-        elif courier.duty_status == 0:
-            return False
-        else:
-            raise Exception('Unrecognized courier duty_status value %s.' % courier.duty_status)
-    except NoResultFound:
+    courier = db_svc.identities.lookup_by_id(courier_id)
+    if courier is None:
         # TODO: maybe raise some more hell if we got an invalid courier ID,
         # but this is fine for now
         return False
 
+    if courier.duty_status == 1:
+        return True
+    elif courier.duty_status == 0:
+        return False
+    else:
+        raise Exception('Unrecognized courier duty_status value %s.' % courier.duty_status)
+
+
+def set_courier_duty_status(courier_id, new_status, session, db_svc):
+    '''Returns True if the courier's duty status was changed, False if it already
+    had the requested value.
+    '''
+    courier = lookup_courier_by_id(courier_id, session, db_svc)
+    if courier.duty_status == new_status:
+        return False
+
+    courier.duty_status = new_status
+    session.flush()
+    return True
+
+
+def invalidate_courier_identity(courier_id, db_svc, unit_of_work=None):
+    # a cached identity must not be dropped before the change to it is committed,
+    # or a concurrent lookup could cache the old row again
+    if unit_of_work is None:
+        db_svc.identities.invalidate(courier_id)
+    else:
+        unit_of_work.after_commit(lambda: db_svc.identities.invalidate(courier_id))
+
 
 def courier_has_bid(courier_id, job_tag, session, db_svc):
     JobBid =db_svc.Base.classes.job_bids
@@ -880,41 +880,40 @@ def handle_delete_user_message(cmd_object, dlg_context, service_registry, **kwar
 
 def handle_on_duty(cmd_object, dlg_context, service_registry, **kwargs):
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
-        courier = lookup_courier_by_id(dlg_context.courier.id, session, db_svc)
-        if courier.duty_status == 1:
-            return ' '.join([
-                'Hello %s, you are already on the duty roster.' % dlg_context.courier.first_name,
-                'The system will automatically notify you when a job is posted.'
-            ])
-        else:
-            courier.duty_status = 1
-            session.flush()
-            return ' '.join([
-                'Hello %s, welcome to the on-call roster.' % dlg_context.courier.first_name, 
-                'Reply to advertised job tags with the tag and "acc" to accept a job.',
-                'Text "hlp" or "?" at any time to see the command codes.'
-            ])
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
+        did_update = set_courier_duty_status(dlg_context.courier.id, 1, session, db_svc)
+
+    if not did_update:
+        return ' '.join([
+            'Hello %s, you are already on the duty roster.' % dlg_context.courier.first_name,
+            'The system will automatically notify you when a job is posted.'
+        ])
+
+    invalidate_courier_identity(dlg_context.courier.id, db_svc, dlg_context.unit_of_work)
+    return ' '.join([
+        'Hello %s, welcome to the on-call roster.' % dlg_context.courier.first_name, 
+        'Reply to advertised job tags with the tag and "acc" to accept a job.',
+        'Text "hlp" or "?" at any time to see the command codes.'
+    ])
 
 
 def handle_off_duty(cmd_object, dlg_context, service_registry, **kwargs):
     # TODO remove courier from any open bidding pools
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
-        courier = lookup_courier_by_id(dlg_context.courier.id, session, db_svc)
-        if courier.duty_status == 0:
-            return ' '.join([
-                'Hello %s, you are already off duty.' % dlg_context.courier.first_name,
-                'Enjoy the downtime!'
-            ])
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
+        did_update = set_courier_duty_status(dlg_context.courier.id, 0, session, db_svc)
 
-        else:
-            courier.duty_status = 0
-            session.flush()
-            return ' '.join([
-                'Hello %s, you are now leaving the on-call roster.' % dlg_context.courier.first_name,
-                'Thank you for your service. Have a good one!'
-            ])
+    if not did_update:
+        return ' '.join([
+            'Hello %s, you are already off duty.' % dlg_context.courier.first_name,
+            'Enjoy the downtime!'
+        ])
+
+    invalidate_courier_identity(dlg_context.courier.id, db_svc, dlg_context.unit_of_work)
+    return ' '.join([
+        'Hello %s, you are now leaving the on-call roster.' % dlg_context.courier.first_name,
+        'Thank you for your service. Have a good one!'
+    ])
 
 
 def handle_bid_for_job(cmd_object, dlg_context, service_registry, **kwargs):
@@ -925,7 +924,7 @@ def handle_bid_for_job(cmd_object, dlg_context, service_registry, **kwargs):
         return REPLY_INVALID_TAG_TPL % cmd_object.job_tag
 
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
         # make sure the job is open
         if not job_is_available(cmd_object.job_tag, session, db_svc):
             return ' '.join(['The job with tag:',
@@ -935,15 +934,10 @@ def handle_bid_for_job(cmd_object, dlg_context, service_registry, **kwargs):
                             ])
         
         if not courier_is_on_duty(dlg_context.courier.id, session, db_svc):
-            # automatically place this courier on the duty roster
-            payload = {
-                'id': dlg_context.courier.id,
-                'status': 1 # 1 means on-duty
-            }
-            transform_status = update_courier_status_func(payload, service_registry, **kwargs)
-            if not transform_status.ok:
-                print(transform_status)
-                return 'There was an error attempting to auto-update your duty status. Please contact your administrator.'
+            # automatically place this courier on the duty roster (1 means on-duty),
+            # in the same transaction as the bid itself
+            set_courier_duty_status(dlg_context.courier.id, 1, session, db_svc)
+            invalidate_courier_identity(dlg_context.courier.id, db_svc, dlg_context.unit_of_work)
         
         # only one bid per user (TODO: pluggable bidding policy)
         if courier_has_bid(dlg_context.courier.id, cmd_object.job_tag, session, db_svc):
@@ -985,7 +979,7 @@ def handle_accept_job(cmd_object, dlg_context, service_registry, **kwargs):
         return 'To accept a job assignment, text the job tag, a space, and "acc".'
 
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
         try:
             # first, does this user even own this job?
             job_bid = lookup_user_job_bid(job_tag, dlg_context.courier.id, session, db_svc)
@@ -1001,15 +995,7 @@ def handle_accept_job(cmd_object, dlg_context, service_registry, **kwargs):
                 return 'You have already accepted this job.'
 
             else:
-                # expire this job status and create a new one
-                jobstat.expired_ts = current_time
-                session.add(jobstat)
-
-                new_status = ObjectFactory.create_job_status(db_svc,
-                                                             job_tag=job_tag,
-                                                             status=JOB_STATUS_ACCEPTED,
-                                                             write_ts=current_time)
-                session.add(new_status)
+                update_job_status(job_tag, JOB_STATUS_ACCEPTED, session, db_svc, timestamp=current_time)
 
                 jobdata = lookup_job_data_by_tag(job_tag, session, db_svc)
                 if not jobdata:
@@ -1032,8 +1018,7 @@ def handle_accept_job(cmd_object, dlg_context, service_registry, **kwargs):
                 ])
 
         except Exception as err:
-            print(err)
-            traceback.print_exc(file=sys.stdout)
+            log.exception('error accepting job', job_tag=job_tag, courier_id=dlg_context.courier.id)
             session.rollback()
             return 'There was an error while attempting to accept this job. Please contact your administrator.'
 
@@ -1047,7 +1032,7 @@ def handle_job_details(cmd_object, dlg_context, service_registry, **kwargs):
         return 'To receive details on a job, text the job tag, a space, and "dt".'
 
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
         job = lookup_job_data_by_tag(cmd_object.job_tag, session, db_svc)
         if not job:
             return 'The job with tag "%s" is either not in the system, or has already been scheduled.' % cmd_object.job_tag
@@ -1069,7 +1054,7 @@ def handle_job_details(cmd_object, dlg_context, service_registry, **kwargs):
 def handle_en_route(cmd_object, dlg_context, service_registry, **kwargs):
     current_time = datetime.datetime.now()
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
         try:
             jobs = list_accepted_jobs(dlg_context.courier.id, session, db_svc)
 
@@ -1092,7 +1077,6 @@ def handle_en_route(cmd_object, dlg_context, service_registry, **kwargs):
             if not job_belongs_to_courier(job_tag, dlg_context.courier.id, session, db_svc):
                 return 'Job with tag %s does not appear to be one of yours.' % job_tag
 
-            print('###  performing en-route status update for job %s...' % job_tag)
             current_job_status = lookup_current_job_status(job_tag,
                                                            session,
                                                            db_svc)
@@ -1100,13 +1084,7 @@ def handle_en_route(cmd_object, dlg_context, service_registry, **kwargs):
             if current_job_status.status == JOB_STATUS_IN_PROGRESS:
                 return 'You have already reported en-route status for this job.'
             else:
-                current_job_status.expired_ts = current_time
-                session.add(current_job_status)
-                new_job_status = ObjectFactory.create_job_status(db_svc,
-                                                                    job_tag=job_tag,
-                                                                    status=JOB_STATUS_IN_PROGRESS,
-                                                                    write_ts=current_time)
-                session.add(new_job_status)
+                update_job_status(job_tag, JOB_STATUS_IN_PROGRESS, session, db_svc, timestamp=current_time)
                 session.flush()
 
                 return ' '.join([
@@ -1116,8 +1094,7 @@ def handle_en_route(cmd_object, dlg_context, service_registry, **kwargs):
         
         except Exception as err:
             session.rollback()
-            print(err)
-            traceback.print_exc(file=sys.stdout)
+            log.exception('error updating job status', job_tag=cmd_object.job_tag, command=cmd_object.cmdspec.command)
             return 'There was an error updating the status of this job. Please contact your administrator.'
 
 
@@ -1127,7 +1104,7 @@ def handle_cancel_job(cmd_object, dlg_context, service_registry, **kwargs):
     
     job_tag = cmd_object.job_tag
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
         
         if not job_belongs_to_courier(job_tag, dlg_context.courier.id, session, db_svc):
             return 'Job with tag %s does not appear to be one of yours.' % job_tag
@@ -1146,7 +1123,7 @@ def handle_cancel_job(cmd_object, dlg_context, service_registry, **kwargs):
 def handle_job_finished(cmd_object, dlg_context, service_registry, **kwargs):
     current_time = datetime.datetime.now()
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
         try:
             job_tag = None
             jobs = list_accepted_jobs(dlg_context.courier.id, session, db_svc)
@@ -1169,7 +1146,6 @@ def handle_job_finished(cmd_object, dlg_context, service_registry, **kwargs):
             if not job_belongs_to_courier(job_tag, dlg_context.courier.id, session, db_svc):
                 return 'Job with tag %s does not appear to be one of yours.' % job_tag
 
-            print('###  performing ->complete status update for job %s...' % job_tag)
             current_job_status = lookup_current_job_status(job_tag,
                                                            session,
                                                            db_svc)
@@ -1177,13 +1153,7 @@ def handle_job_finished(cmd_object, dlg_context, service_registry, **kwargs):
             if current_job_status.status == JOB_STATUS_COMPLETED:
                 return 'You have already reported that this job is complete. Thanks again!'
             else:
-                current_job_status.expired_ts = current_time
-                session.add(current_job_status)
-                new_job_status = ObjectFactory.create_job_status(db_svc,
-                                                                 job_tag=job_tag,
-                                                                 status=JOB_STATUS_COMPLETED,
-                                                                 write_ts=current_time)
-                session.add(new_job_status)
+                update_job_status(job_tag, JOB_STATUS_COMPLETED, session, db_svc, timestamp=current_time)
                 session.flush()
 
                 return ' '.join([
@@ -1193,8 +1163,7 @@ def handle_job_finished(cmd_object, dlg_context, service_registry, **kwargs):
 
         except Exception as err:
             session.rollback()
-            print(err)
-            traceback.print_exc(file=sys.stdout)
+            log.exception('error updating job status', job_tag=cmd_object.job_tag, command=cmd_object.cmdspec.command)
             return 'There was an error updating the status of this job. Please contact your administrator.'
 
 
@@ -1209,6 +1178,20 @@ def handle_emergency(cmd_object, dlg_context, service_registry, **kwargs):
     ])
     
 
+def handle_next_page(cmd_object, dlg_context, service_registry, **kwargs):
+    db_svc = service_registry.lookup('postgres')
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
+        cursor = lookup_list_cursor(dlg_context.courier.id, session, db_svc)
+        if cursor is None:
+            return 'There is no list to continue. Text "hlp" or "?" to see the list commands.'
+        command_string = cursor.command_string
+        next_offset = cursor.next_offset
+
+    # re-run the original listing command, starting from the stored offset
+    command_input = parse_sms_message_body(command_string)
+    return SMS_DIALOG_ENGINE.reply_command(command_input, dlg_context, service_registry, list_offset=next_offset)
+
+
 def handle_bidding_status_for_job(cmd_object, dlg_context, service_registry, **kwargs):
     # TODO: return actual bidding status (is bidding open? closed? Has job been awarded? Accepted?)
     if not cmd_object.job_tag:
@@ -1223,17 +1206,19 @@ def generate_list_my_awarded_jobs(cmd_object, dlg_engine, dlg_context, service_r
     '''
 
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
-        job_records = list_awarded_jobs(dlg_context.courier.id, session, db_svc)
-        if not len(job_records):
-            return 'Either you have accepted all your awarded jobs, or you have not been awarded any.'
-
-
+    with db_svc.read_scope(dlg_context.unit_of_work) as session:
         responder = ListOutputResponder(cmd_object.cmdspec,
                                         parse_sms_message_body,
                                         single_item_noun='accepted job',
                                         plural_item_noun='accepted jobs')
 
+        # fetch only the rows the command asks for
+        job_view = awarded_jobs_view(dlg_context.courier.id, session, db_svc)
+        selector = responder.build_selector(cmd_object, offset=kwargs.get('list_offset'))
+        job_records = job_view.rows(selector)
+        if not len(job_records) and not job_view.count():
+            return 'Either you have accepted all your awarded jobs, or you have not been awarded any.'
+
         raw_jobs = [j.job_tag for j in job_records]
 
         return responder.generate(command_object=cmd_object,
@@ -1242,65 +1227,66 @@ def generate_list_my_awarded_jobs(cmd_object, dlg_engine, dlg_context, service_r
                                   filter_callback=filter_job_tag,
                                   dialog_context=dlg_context,
                                   dialog_engine=dlg_engine,
-                                  service_registry=service_registry)
+                                  service_registry=service_registry,
+                                  selector=selector,
+                                  count_callback=lambda: job_view.count(selector),
+                                  on_page=list_cursor_saver(cmd_object, dlg_context, service_registry))
 
 
 def generate_list_my_accepted_jobs(cmd_object, dlg_engine, dlg_context, service_registry, **kwargs):
-    job_records = []
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
-        
-        JobAssignment = db_svc.Base.classes.job_assignments
-        JobStatus = db_svc.Base.classes.job_status
-        # resultset = session.query(JobAssignment).filter(JobAssignment.courier_id == dlg_context.courier.id).all()
-
-        for ja, stat in session.query(JobAssignment,
-                                      JobStatus).filter(and_(JobStatus.job_tag == JobAssignment.job_tag,
-                                                             JobStatus.status == JOB_STATUS_ACCEPTED,
-                                                             JobStatus.expired_ts == None,
-                                                             JobAssignment.courier_id == dlg_context.courier.id)).all():
-            job_records.append(stat)
-
-        if not len(job_records):
-            return 'You have no current accepted jobs in your queue.'
-
-        raw_jobs = [j.job_tag for j in job_records]
-
+    with db_svc.read_scope(dlg_context.unit_of_work) as session:
         responder = ListOutputResponder(cmd_object.cmdspec,
                                         parse_sms_message_body,
                                         single_item_noun='accepted job',
                                         plural_item_noun='accepted jobs')
 
+        job_view = accepted_jobs_view(dlg_context.courier.id, session, db_svc)
+        selector = responder.build_selector(cmd_object, offset=kwargs.get('list_offset'))
+        job_records = job_view.rows(selector)
+        if not len(job_records) and not job_view.count():
+            return 'You have no current accepted jobs in your queue.'
+
+        raw_jobs = [j.job_tag for j in job_records]
+
         return responder.generate(command_object=cmd_object,
-                                  string_list=raw_jobs,
+                                  record_list=raw_jobs,
                                   render_callback=render_job_line,
                                   filter_callback=filter_job_tag,
                                   dialog_context=dlg_context,
                                   dialog_engine=dlg_engine,
-                                  service_registry=service_registry)
+                                  service_registry=service_registry,
+                                  selector=selector,
+                                  count_callback=lambda: job_view.count(selector),
+                                  on_page=list_cursor_saver(cmd_object, dlg_context, service_registry))
 
 
 def generate_list_in_progress_jobs(cmd_object, dlg_engine, dlg_context, service_registry, **kwargs):
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
-        job_records = list_in_progress_jobs_for_courier(dlg_context.courier.id, session, db_svc)
-        if not len(job_records):
-            return 'You have no in-progress jobs in your queue.'
-
-        raw_jobs = [j.job_tag for j in job_records]
-
+    with db_svc.read_scope(dlg_context.unit_of_work) as session:
         responder = ListOutputResponder(cmd_object.cmdspec,
                                         parse_sms_message_body,
                                         single_item_noun='in-progress job',
                                         plural_item_noun='in-progress jobs')
 
+        job_view = in_progress_jobs_view(dlg_context.courier.id, session, db_svc)
+        selector = responder.build_selector(cmd_object, offset=kwargs.get('list_offset'))
+        job_records = job_view.rows(selector)
+        if not len(job_records) and not job_view.count():
+            return 'You have no in-progress jobs in your queue.'
+
+        raw_jobs = [j.job_tag for j in job_records]
+
         return responder.generate(command_object=cmd_object,
                                   record_list=raw_jobs,
                                   render_callback=render_job_line,
                                   filter_callback=filter_job_tag,
                                   dialog_context=dlg_context,
                                   dialog_engine=dlg_engine,
-                                  service_registry=service_registry)
+                                  service_registry=service_registry,
+                                  selector=selector,
+                                  count_callback=lambda: job_view.count(selector),
+                                  on_page=list_cursor_saver(cmd_object, dlg_context, service_registry))
 
 
 def list_user_messages(courier_id, session, db_svc):
@@ -1345,7 +1331,7 @@ def filter_message(msg_record, filter_expression):
 
 def generate_list_messages(cmd_object, dlg_engine, dlg_context, service_registry, **kwargs):
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
+    with db_svc.read_scope(dlg_context.unit_of_work) as session:
         user_messages = list_user_messages(dlg_context.courier.id, session, db_svc)
 
         if not len(user_messages):
@@ -1358,13 +1344,15 @@ def generate_list_messages(cmd_object, dlg_engine, dlg_context, service_registry
                                   filter_callback=filter_message,
                                   dialog_context=dlg_context,
                                   dialog_engine=dlg_engine,
-                                  service_registry=service_registry)
+                                  service_registry=service_registry,
+                                  offset=kwargs.get('list_offset'),
+                                  on_page=list_cursor_saver(cmd_object, dlg_context, service_registry))
         
 
 def render_bid_line(index, bid_record):
     if index:
-        return 'bid #%d: %s' % (index, bid_record['job_tag'])
-    return bid_record['job_tag']
+        return 'bid #%d: %s' % (index, bid_record.job_tag)
+    return bid_record.job_tag
     
 
 def filter_bid(bid_record, filter_expression):
@@ -1373,20 +1361,25 @@ def filter_bid(bid_record, filter_expression):
 
 def generate_list_my_bids(cmd_object, dlg_engine, dlg_context, service_registry, **kwargs):
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
-        user_bids = list_user_bids(dlg_context.courier.id, session, db_svc)
+    with db_svc.read_scope(dlg_context.unit_of_work) as session:
+        responder = ListOutputResponder(cmd_object.cmdspec, parse_sms_message_body)
 
-        if not len(user_bids):
+        bid_view = user_bids_view(dlg_context.courier.id, session, db_svc)
+        selector = responder.build_selector(cmd_object, offset=kwargs.get('list_offset'))
+        user_bids = bid_view.rows(selector)
+        if not len(user_bids) and not bid_view.count():
             return 'You have no active bids.'
 
-        responder = ListOutputResponder(cmd_object.cmdspec, parse_sms_message_body)
         return responder.generate(command_object=cmd_object,
                                   record_list=user_bids,
                                   render_callback=render_bid_line,
                                   filter_callback=filter_bid,
                                   dialog_context=dlg_context,
                                   dialog_engine=dlg_engine,
-                                  service_registry=service_registry)
+                                  service_registry=service_registry,
+                                  selector=selector,
+                                  count_callback=lambda: bid_view.count(selector),
+                                  on_page=list_cursor_saver(cmd_object, dlg_context, service_registry))
     
 
 def render_job_line(index, job_tag):
@@ -1396,23 +1389,28 @@ def render_job_line(index, job_tag):
 
 
 def generate_list_open_jobs(cmd_object, dlg_engine, dlg_context, service_registry, **kwargs):
-    print('#--- Generating open job listing...')
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
-        job_records = list_available_jobs(session, db_svc)
-        if not len(job_records):
+    with db_svc.read_scope(dlg_context.unit_of_work) as session:
+        responder = ListOutputResponder(cmd_object.cmdspec, parse_sms_message_body)
+
+        # opn.3 reads one row, not every open job in the system
+        job_view = available_jobs_view(session, db_svc)
+        selector = responder.build_selector(cmd_object, offset=kwargs.get('list_offset'))
+        job_records = job_view.rows(selector)
+        if not len(job_records) and not job_view.count():
             return 'No open jobs found.'
 
         raw_jobs = [j.job_tag for j in job_records]
-
-        responder = ListOutputResponder(cmd_object.cmdspec, parse_sms_message_body)
         return responder.generate(command_object=cmd_object,
                                   record_list=raw_jobs,
                                   render_callback=render_job_line,
                                   filter_callback=filter_job_tag,
                                   dialog_context=dlg_context,
                                   dialog_engine=dlg_engine,
-                                  service_registry=service_registry)
+                                  service_registry=service_registry,
+                                  selector=selector,
+                                  count_callback=lambda: job_view.count(selector),
+                                  on_page=list_cursor_saver(cmd_object, dlg_context, service_registry))
 
 
 def pfx_command_lookup_abbrev(prefix_cmd, dlg_engine, dlg_context, service_registry):
@@ -1426,7 +1424,7 @@ def pfx_command_lookup_abbrev(prefix_cmd, dlg_engine, dlg_context, service_regis
 def pfx_command_sethandle(prefix_cmd, dlg_engine, dlg_context, service_registry):
     handle = prefix_cmd.name
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
         try:
             handle_entry = lookup_live_courier_handle(dlg_context.courier.id, session, db_svc)
             if handle_entry:
@@ -1449,21 +1447,22 @@ def pfx_command_sethandle(prefix_cmd, dlg_engine, dlg_context, service_registry)
             session.add(new_handle_entry)
             session.flush()
 
-            return ' '.join([
-                'Your user handle has been set to %s.' % new_handle_entry.handle,
-                'A system user can send a message to your log by texting:',
-                '@%s, space, and the message.' % handle
-            ])
-
         except Exception as err:
-            print('exception of type %s thrown: %s' % (err.__class__.__name__, str(err)))
+            log.exception('error setting user handle', courier_id=dlg_context.courier.id, handle=handle)
             session.rollback()
             return 'There was an error creating your user handle. Please contact your administrator.'
+
+    invalidate_courier_identity(dlg_context.courier.id, db_svc, dlg_context.unit_of_work)
+    return ' '.join([
+        'Your user handle has been set to %s.' % handle,
+        'A system user can send a message to your log by texting:',
+        '@%s, space, and the message.' % handle
+    ])
             
 
 def pfx_command_sendlog(prefix_cmd, dlg_engine, dlg_context, service_registry):
     db_svc = service_registry.lookup('postgres')
-    with db_svc.txn_scope() as session:
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
         try:
             if prefix_cmd.mode == 'simple':
                 return ' '.join([
@@ -1494,7 +1493,7 @@ def pfx_command_sendlog(prefix_cmd, dlg_engine, dlg_context, service_registry):
                 return 'Message sent.'
 
         except Exception as err:
-            print('exception of type %s thrown: %s' % (err.__class__.__name__, str(err)))
+            log.exception('error sending message to user log', courier_id=dlg_context.courier.id)
             session.rollback()
             return 'There was an error sending your message. Please contact your administrator.'
 
@@ -1504,7 +1503,7 @@ def pfx_command_macro(prefix_cmd, dlg_engine, dlg_context, service_registry):
     macro = None
     db_svc = service_registry.lookup('postgres')
 
-    with db_svc.txn_scope() as session:
+    with db_svc.txn_scope(dlg_context.unit_of_work) as session:
         # in extended mode, a prefix command contains a name and a body,
         # separated by the "defchar" found in the prefix's command spec
         #
@@ -1532,69 +1531,86 @@ def pfx_command_macro(prefix_cmd, dlg_engine, dlg_context, service_registry):
             chained_command = parse_sms_message_body(macro.command_string)
             return dlg_engine.reply_command(chained_command, dlg_context, service_registry)            
 
-    print('Courier %s created macro: macro' % macro)
+    log.info('macro created', courier_id=dlg_context.courier.id, macro_name=prefix_cmd.name)
     return 'Command macro %s%s registered.' % (prefix_cmd.cmdspec.command, prefix_cmd.name)
         
 
-SMSDialogContext = namedtuple('SMSDialogContext', 'courier source_number message')
+# unit_of_work is shared by every command run on behalf of one inbound message (see bx_services.UnitOfWork)
+SMSDialogContext = namedtuple('SMSDialogContext', 'courier source_number message unit_of_work')
 
 class DialogEngine(object):
     def __init__(self):
+        # handlers are keyed by command name, which is unique within each command family
         self.msg_dispatch_tbl = {}
         self.generator_dispatch_tbl = {}
         self.prefix_dispatch_tbl = {}
 
 
     def register_cmd_spec(self, sms_command_spec, handler_func):
-        self.msg_dispatch_tbl[str(sms_command_spec)] = handler_func
+        self.msg_dispatch_tbl[sms_command_spec.command] = handler_func
 
     def register_generator_cmd(self, generator_cmd_spec, handler_func):
-        self.generator_dispatch_tbl[str(generator_cmd_spec)] = handler_func
+        self.generator_dispatch_tbl[generator_cmd_spec.command] = handler_func
 
     def register_prefix_cmd(self, prefix_spec, handler_func):
-        self.prefix_dispatch_tbl[str(prefix_spec)] = handler_func
+        self.prefix_dispatch_tbl[prefix_spec.command] = handler_func
 
 
     def _reply_prefix_command(self, prefix_cmd, dialog_context, service_registry, **kwargs):
-        command = self.prefix_dispatch_tbl.get(str(prefix_cmd.cmdspec))
+        command = self.prefix_dispatch_tbl.get(prefix_cmd.cmdspec.command)
         if not command:
             return 'No handler registered in SMS DialogEngine for prefix command %s.' % prefix_cmd.cmdspec.command
         return command(prefix_cmd, self, dialog_context, service_registry)
 
 
     def _reply_generator_command(self, gen_cmd, dialog_context, service_registry, **kwargs):
-        list_generator = self.generator_dispatch_tbl.get(str(gen_cmd.cmdspec))
+        list_generator = self.generator_dispatch_tbl.get(gen_cmd.cmdspec.command)
         if not list_generator:
             return 'No handler registered in SMS DialogEngine for generator command %s.' % gen_cmd.cmdspec.command
-        return list_generator(gen_cmd, self, dialog_context, service_registry)
+        return list_generator(gen_cmd, self, dialog_context, service_registry, **kwargs)
 
 
     def _reply_sys_command(self, sys_cmd, dialog_context, service_registry, **kwargs):
-        handler = self.msg_dispatch_tbl.get(str(sys_cmd.cmdspec))
+        handler = self.msg_dispatch_tbl.get(sys_cmd.cmdspec.command)
         if not handler:
             return 'No handler registered in SMS DialogEngine for system command %s.' % sys_cmd.cmdspec.command
         return handler(sys_cmd, dialog_context, service_registry)
 
 
     def reply_command(self, command_input, dialog_context, service_registry, **kwargs):
+        '''Run one command and return its reply. A command which fails is reported
+        in its reply rather than raised: its own database work has already been
+        rolled back to its savepoint, and the commands run before it in the same
+        message (earlier items in a range, earlier steps in a macro) are kept.
+        '''
+        try:
+            return self._dispatch_command(command_input, dialog_context, service_registry, **kwargs)
+
+        except (UnrecognizedSMSCommand, IncompletePrefixCommand):
+            raise
+
+        except Exception:
+            command_name = command_input.cmd_object.cmdspec.command
+            log.exception('sms command failed', command=command_name, mobile_number=dialog_context.source_number)
+            return REPLY_COMMAND_FAILED_TPL % command_name
+
+
+    def _dispatch_command(self, command_input, dialog_context, service_registry, **kwargs):
         # command types: generator, syscommand, prefix
         if command_input.cmd_type == 'prefix':
-            return self._reply_prefix_command(command_input.cmd_object, dialog_context, service_registry)
+            return self._reply_prefix_command(command_input.cmd_object, dialog_context, service_registry, **kwargs)
 
         elif command_input.cmd_type == 'syscommand':
-            return self._reply_sys_command(command_input.cmd_object, dialog_context, service_registry)
+            return self._reply_sys_command(command_input.cmd_object, dialog_context, service_registry, **kwargs)
 
         elif command_input.cmd_type == 'generator':
-            return self._reply_generator_command(command_input.cmd_object, dialog_context, service_registry)
+            return self._reply_generator_command(command_input.cmd_object, dialog_context, service_registry, **kwargs)
 
         else:
             raise Exception('Unrecognized command input type %s.' % command_input.cmd_type)
 
 
-def sms_responder_func(input_data, service_objects, **kwargs):
-    db_svc = service_objects.lookup('postgres')
-    sms_svc = service_objects.lookup('sms')
-
+def build_dialog_engine():
     engine = DialogEngine()
     
     engine.register_cmd_spec(SMS_SYSTEM_COMMAND_SPECS['bid'], handle_bid_for_job)
@@ -1605,6 +1621,7 @@ def sms_responder_func(input_data, service_objects, **kwargs):
     engine.register_cmd_spec(SMS_SYSTEM_COMMAND_SPECS['fin'], handle_job_finished)
     engine.register_cmd_spec(SMS_SYSTEM_COMMAND_SPECS['911'], handle_emergency)
     engine.register_cmd_spec(SMS_SYSTEM_COMMAND_SPECS['hlp'], handle_help)
+    engine.register_cmd_spec(SMS_SYSTEM_COMMAND_SPECS['nxt'], handle_next_page)
     engine.register_cmd_spec(SMS_SYSTEM_COMMAND_SPECS['on'], handle_on_duty)
     engine.register_cmd_spec(SMS_SYSTEM_COMMAND_SPECS['off'], handle_off_duty)
     engine.register_cmd_spec(SMS_SYSTEM_COMMAND_SPECS['mdel'], handle_delete_user_message)
@@ -1621,58 +1638,70 @@ def sms_responder_func(input_data, service_objects, **kwargs):
     engine.register_prefix_cmd(SMS_PREFIX_COMMAND_SPECS['&'], pfx_command_sethandle)
     engine.register_prefix_cmd(SMS_PREFIX_COMMAND_SPECS['#'], pfx_command_lookup_abbrev)
 
-    print('###------ SMS payload:')
+    return engine
+
+
+# the dispatch table is immutable once built, so one engine serves every inbound message
+SMS_DIALOG_ENGINE = build_dialog_engine()
+
+
+def sms_responder_func(input_data, service_objects, **kwargs):
+    db_svc = service_objects.lookup('postgres')
+    sms_svc = service_objects.lookup('sms')
+
+    engine = SMS_DIALOG_ENGINE
+
     source_number = input_data['From']
     raw_message_body = input_data['Body']
-    
-    print('###')
-    print('###------ Received raw message "%s" from mobile number [%s].' % (raw_message_body, source_number))
-    print('###')
+    log.debug_sampled('sms received', source_number=source_number, body=raw_message_body)
 
     mobile_number = normalize_mobile_number(source_number)
 
-    courier = None
-    with db_svc.txn_scope() as session:
-        courier = lookup_courier_by_mobile_number(mobile_number, session, db_svc)
-        if not courier:
-            print('Courier with mobile number %s not found.' % mobile_number)
-            sms_svc.send_sms(mobile_number, REPLY_NOT_IN_NETWORK)
-            return core.TransformStatus(ok_status('SMS event received', is_valid_command=False))
-        
-        session.expunge(courier)        
+    # resolving the sender is normally a cache hit; see CourierIdentityCache
+    courier = db_svc.identities.lookup_by_mobile_number(mobile_number)
+    if not courier:
+        log.info('sms from unknown number', mobile_number=mobile_number)
+        sms_svc.queue_sms(mobile_number, REPLY_NOT_IN_NETWORK)
+        return core.TransformStatus(ok_status('SMS event received', is_valid_command=False))
         
-    dlg_context = SMSDialogContext(courier=courier, source_number=mobile_number, message=unquote_plus(raw_message_body))
-
     try:
         command_input = parse_sms_message_body(raw_message_body)
-        print('#----- Resolved command: %s' % str(command_input))
+        log.debug_sampled('resolved sms command', command=command_input)
+
+        # chained commands, list ranges and macro expansions all run in this one transaction
+        with db_svc.unit_of_work() as unit_of_work:
+            dlg_context = SMSDialogContext(courier=courier,
+                                           source_number=mobile_number,
+                                           message=unquote_plus(raw_message_body),
+                                           unit_of_work=unit_of_work)
+
+            response = engine.reply_command(command_input, dlg_context, service_objects)
 
-        response = engine.reply_command(command_input, dlg_context, service_objects)
-        sms_svc.send_sms(mobile_number, response)
+        # reply only once everything the message did has been committed
+        sms_svc.queue_sms(mobile_number, response)
 
         return core.TransformStatus(ok_status('SMS event received', is_valid_command=True, command=command_input))
 
-    except IncompletePrefixCommand as err:
-        print('Error data: %s' % err)
-        print('#----- Incomplete prefix command: in message body: %s' % raw_message_body)
-        sms_svc.send_sms(mobile_number, SMS_PREFIX_COMMAND_SPECS[raw_message_body].definition)
+    except IncompletePrefixCommand:
+        log.info('incomplete prefix command', mobile_number=mobile_number, body=raw_message_body)
+        sms_svc.queue_sms(mobile_number, SMS_PREFIX_COMMAND_SPECS[raw_message_body].definition)
         return core.TransformStatus(ok_status('SMS event received', is_valid_command=False))
 
-    except UnrecognizedSMSCommand as err:
-        print('Error data: %s' % err)
-        print('#----- Unrecognized system command: in message body: %s' % raw_message_body)
-        sms_svc.send_sms(mobile_number, compile_help_string())
+    except UnrecognizedSMSCommand:
+        log.info('unrecognized sms command', mobile_number=mobile_number, body=raw_message_body)
+        sms_svc.queue_sms(mobile_number, compile_help_string())
         return core.TransformStatus(ok_status('SMS event received', is_valid_command=False))
     
 
 def poll_job_status_func(input_data, service_objects, **kwargs):
     db_svc = service_objects.lookup('postgres')
-    JobStatus = db_svc.Base.classes.job_status
     tag = input_data['job_tag']
 
     status = None
-    with db_svc.txn_scope() as session:
-        result = session.query(JobStatus).filter(and_(JobStatus.job_tag == tag, JobStatus.expired_ts == None)).one()
+    with db_svc.read_scope() as session:
+        result = lookup_current_job_status(tag, session, db_svc)
+        if result is None:
+            raise NoResultFound('No job found with tag %s.' % tag)
         status = result.status
 
     return core.TransformStatus(ok_status('poll request', job_tag=tag, job_status=status))
@@ -1686,7 +1715,7 @@ def couriers_by_status_func(input_data, service_objects, **kwargs):
     status = input_data['status']
     courier_records = None
     db_svc = service_objects.lookup('postgres')
-    with db_svc.txn_scope() as session:
+    with db_svc.read_scope() as session:
         courier_records = lookup_couriers_by_status(status, session, db_svc)
     
     return core.TransformStatus(ok_status('couriers by status', courier_status=status, couriers=courier_records))
@@ -1698,14 +1727,10 @@ def update_courier_status_func(input_data, service_objects, **kwargs):
 
     db_svc = service_objects.lookup('postgres')
     with db_svc.txn_scope() as session:
-        courier = lookup_courier_by_id(courier_id, session, db_svc)
+        did_update = set_courier_duty_status(courier_id, new_status, session, db_svc)
 
-        if courier.duty_status == new_status:
-            did_update = False
-        else:
-            courier.duty_status = new_status
-            session.add(courier)
-            did_update = True
+    if did_update:
+        invalidate_courier_identity(courier_id, db_svc)
 
     return core.TransformStatus(ok_status('update courier status', updated=did_update, id=courier_id, duty_status=new_status))
 
@@ -1767,110 +1792,214 @@ def active_job_bids_func(input_data, service_objects, **kwargs):
     JobBid = db_svc.Base.classes.job_bids
     Courier = db_svc.Base.classes.couriers
 
-    with db_svc.txn_scope() as session:
+    with db_svc.read_scope() as session:
         try:
             for c, jb in session.query(Courier, JobBid).filter(and_(Courier.id == JobBid.courier_id,
                                                                     JobBid.job_tag == job_tag,
                                                                     JobBid.accepted_ts == None,
                                                                     JobBid.expired_ts == None)).all(): 
 
-                bid_list.append({
-                    'bid_id': jb.id,
-                    'job_tag': jb.job_tag,
-                    'courier_id': c.id,
-                    'first_name': c.first_name,
-                    'last_name': c.last_name,
-                    'mobile_number': c.mobile_number
-                })
+                bid_list.append(prepare_bidder_record(c, jb))
             return core.TransformStatus(ok_status('get active job bidders', bidders=bid_list))
         except Exception as err:
             return core.TransformStatus(exception_status(err), False, message=str(err))
 
 
-def award_job_func(input_data, service_objects, **kwargs):
-    '''
-    print(common.jsonpretty(input_data))
-    return core.TransformStatus(ok_status('debugging', data=input_data))
+AWARD_MESSAGE_TEMPLATE = ' '.join([
+    "Hello {name}, you've been awarded the job with tag:",
+    "{job_tag}.",
+    "To accept this job, text the job tag, space, and {accept_command}."
+])
+
+
+def award_bidding_windows(awards, session, db_svc, current_time):
+    '''Close each bidding window in <awards> and accept its winning bids, using one
+    set-based statement per table for all of the windows together. Jobs still open
+    for bidding move to "awarded".
+
+    The open windows are locked (SELECT ... FOR UPDATE) before anything is decided,
+    so when the scan handler and the scheduler settle the same window at once, the
+    second one to get the lock sees it closed and awards nothing.
+
+    Returns an OrderedDict of per-window results, keyed by window ID. A window which
+    does not exist, is already closed, appears more than once in <awards>, or whose
+    winning bids are not all live bids on that window's job, is left untouched and
+    reported with an error.
     '''
-    print('###-------- awarding job to winning bids')
-    print('----------------INPUT DATA\n\n')
-    print(input_data)
-    print('\n\n----------------INPUT DATA ENDS')
+    BidWindow = db_svc.Base.classes.bidding_windows
+    JobBid = db_svc.Base.classes.job_bids
+    JobCurrentStatus = db_svc.Base.classes.job_current_status
+    JobStatus = db_svc.Base.classes.job_status
+
+    window_id_counts = Counter(award['window_id'] for award in awards)
+    window_ids = list(window_id_counts.keys())
+    bid_ids = [bid_record['bid_id'] for award in awards for bid_record in award['bids']]
+
+    # window ID -> job tag, for the windows still open; locked in ID order, so that
+    # concurrent awards of overlapping window sets cannot deadlock
+    open_window_tags = {}
+    closed_window_ids = set()
+    if window_ids:
+        open_window_tags = {row.id: row.job_tag for row in session.query(BidWindow.id, BidWindow.job_tag).filter(
+            and_(BidWindow.id.in_(window_ids),
+                 BidWindow.close_ts == None)).order_by(BidWindow.id).with_for_update()}
+
+        unlocked_ids = [window_id for window_id in window_ids if window_id not in open_window_tags]
+        if unlocked_ids:
+            closed_window_ids = {row.id for row in session.query(BidWindow.id).filter(BidWindow.id.in_(unlocked_ids))}
+
+    # bid ID -> job tag, for the live bids
+    live_bid_tags = {}
+    if bid_ids:
+        live_bid_tags = {row.id: row.job_tag for row in session.query(JobBid.id, JobBid.job_tag).filter(
+            and_(JobBid.id.in_(bid_ids),
+                 JobBid.expired_ts == None))}
+
+    results = OrderedDict()
+    winning_bids = []
+    for award in awards:
+        window_id = award['window_id']
+        if window_id_counts[window_id] > 1:
+            results[window_id] = {'window_id': window_id,
+                                  'awarded': False,
+                                  'error': 'Bidding window with ID %s appears more than once in the awards.' % window_id}
+            continue
+
+        if window_id in closed_window_ids:
+            results[window_id] = {'window_id': window_id,
+                                  'awarded': False,
+                                  'error': 'Bidding window with ID %s is already closed.' % window_id}
+            continue
+
+        if window_id not in open_window_tags:
+            results[window_id] = {'window_id': window_id,
+                                  'awarded': False,
+                                  'error': 'Bidding window with ID %s not found.' % window_id}
+            continue
+
+        window_job_tag = open_window_tags[window_id]
+        missing_bid_ids = [b['bid_id'] for b in award['bids'] if b['bid_id'] not in live_bid_tags]
+        # the bid must be on this window's job, and the caller must agree (it addresses the award notice)
+        foreign_bid_ids = [b['bid_id'] for b in award['bids'] if b['bid_id'] in live_bid_tags
+                           and {live_bid_tags[b['bid_id']], b.get('job_tag', window_job_tag)} != {window_job_tag}]
+        if missing_bid_ids:
+            results[window_id] = {'window_id': window_id,
+                                  'awarded': False,
+                                  'error': 'Bid(s) %s not found or expired.' % ', '.join(missing_bid_ids)}
+        elif foreign_bid_ids:
+            results[window_id] = {'window_id': window_id,
+                                  'awarded': False,
+                                  'error': 'Bid(s) %s are not bids on job %s.' % (', '.join(foreign_bid_ids), window_job_tag)}
+        else:
+            results[window_id] = {'window_id': window_id,
+                                  'awarded': True,
+                                  'winners': award['bids']}
+            winning_bids.extend(award['bids'])
 
-    award_message_lines = [
-        "Hello {name}, you've been awarded the job with tag:",
-        "{job_tag}.",
-        "To accept this job, text the job tag, space, and {accept_command}."
-    ]
+    awarded_window_ids = [window_id for window_id, result in results.items() if result['awarded']]
+    if not awarded_window_ids:
+        return results
 
-    award_message_template = ' '.join(award_message_lines)
+    log.debug('closing bidding windows', count=len(awarded_window_ids))
+    session.query(BidWindow).filter(and_(BidWindow.id.in_(awarded_window_ids),
+                                         BidWindow.close_ts == None)).update({BidWindow.close_ts: current_time},
+                                                                             synchronize_session=False)
+
+    # record the winning bids as having been accepted
+    session.query(JobBid).filter(JobBid.id.in_([b['bid_id'] for b in winning_bids])).update({JobBid.accepted_ts: current_time},
+                                                                                            synchronize_session=False)
+
+    # update the status of each job still up for bidding to "awarded"
+    job_tags = list({open_window_tags[window_id] for window_id in awarded_window_ids})
+    broadcast_job_tags = [row.job_tag for row in session.query(JobCurrentStatus.job_tag).filter(
+        and_(JobCurrentStatus.job_tag.in_(job_tags),
+             JobCurrentStatus.status == JOB_STATUS_BROADCAST)).with_for_update()]
+
+    if broadcast_job_tags:
+        session.query(JobCurrentStatus).filter(JobCurrentStatus.job_tag.in_(broadcast_job_tags)).update(
+            {JobCurrentStatus.status: JOB_STATUS_AWARDED, JobCurrentStatus.write_ts: current_time},
+            synchronize_session=False)
+
+        session.bulk_insert_mappings(JobStatus, [{'job_tag': job_tag,
+                                                  'status': JOB_STATUS_AWARDED,
+                                                  'write_ts': current_time} for job_tag in broadcast_job_tags])
+
+    return results
+
+
+def notify_award_winners(winning_bids, sms_svc):
+    notify_targets = {}
+    for bid_record in winning_bids:
+        notify_targets[bid_record['mobile_number']] = {
+            'name': bid_record['first_name'],
+            'job_tag': bid_record['job_tag'],
+            'accept_command': 'acc'
+        }
+
+    for mobile_number, data in notify_targets.items():
+        sms_svc.queue_sms(mobile_number, AWARD_MESSAGE_TEMPLATE.format(**data))
+
+
+def award_job_func(input_data, service_objects, **kwargs):
+    log.debug('awarding job to winning bids', window_id=input_data.get('window_id'), bids=input_data.get('bids'))
 
     window_id = input_data['window_id']
     current_time = datetime.datetime.now()
-    notify_targets = {}
 
     sms_svc = service_objects.lookup('sms')
     db_svc = service_objects.lookup('postgres')
 
     with db_svc.txn_scope() as session:
         try:
-            print('### closing the bidding window %s...' % window_id)
-            # close the bidding window
-            window = lookup_bidding_window_by_id(window_id, session, db_svc)
-            if not window:
-                raise Exception('Bidding window with ID %s not found.' % window_id)
+            results = award_bidding_windows([{'window_id': window_id, 'bids': input_data['bids']}],
+                                            session,
+                                            db_svc,
+                                            current_time)
+            if not results[window_id]['awarded']:
+                raise Exception(results[window_id]['error'])
+
+        except Exception as err:
+            session.rollback()
+            log.exception('error awarding job', window_id=window_id)
+            return core.TransformStatus(exception_status(err),
+                                        False, 
+                                        message='error of type %s closing bid window %s' % (err.__class__.__name__, window_id))
 
-            window.close_ts = current_time
-            session.add(window)
+    # notify only once the award has been committed
+    notify_award_winners(input_data['bids'], sms_svc)
 
-            # record the winning bids as having been accepted
-            
-            for bid_record in input_data['bids']:
-                
-                print('### updating bid to accepted...')
-                bid = lookup_bid_by_id(bid_record['bid_id'], session, db_svc)
-                bid.accepted_ts = current_time
-                session.add(bid)
-
-                notify_targets[bid_record['mobile_number']] = {
-                    'name': bid_record['first_name'],
-                    'job_tag': bid_record['job_tag'],
-                    'accept_command': 'acc'
-                }
+    return core.TransformStatus(ok_status('award job to winning bidders',
+                                          winners=input_data['bids']))
 
-                # update the status of the job to "awarded"
-                
-                job_status = lookup_current_job_status(bid_record['job_tag'], session, db_svc)
-                if job_status.status == 0:  # 0 is "broadcast"
-                    print('### updating the status for job tag %s...' % bid_record['job_tag'])
-
-                    # expire the existing status
-                    job_status.expired_ts = current_time
-                    session.add(job_status)
-
-                    # add a new status record
-                    # status 1 is "awarded"
-                    new_job_status = ObjectFactory.create_job_status(db_svc,
-                                                                     job_tag=bid_record['job_tag'],
-                                                                     status=1,
-                                                                     write_ts=current_time)
-                    session.add(new_job_status)
 
-            session.flush()
+def award_jobs_func(input_data, service_objects, **kwargs):
+    '''Award many bidding windows in one transaction. The input is
+    {"awards": [{"window_id": <id>, "bids": [<winning bid>, ...]}, ...]},
+    and the output has one result per window.
+    '''
+    awards = input_data['awards']
+    current_time = datetime.datetime.now()
 
-            print('### Sending SMS notification to bid winner(s)...')
-            for mobile_number, data in notify_targets.items():
-                sms_svc.send_sms(mobile_number, award_message_template.format(**data)) 
+    sms_svc = service_objects.lookup('sms')
+    db_svc = service_objects.lookup('postgres')
+
+    with db_svc.txn_scope() as session:
+        try:
+            results = award_bidding_windows(awards, session, db_svc, current_time)
 
-            return core.TransformStatus(ok_status('award job to winning bidders',
-                                                winners=input_data['bids']))
         except Exception as err:
             session.rollback()
-            print(err)
-            traceback.print_exc(file=sys.stdout)
+            log.exception('error awarding bidding windows', count=len(awards))
             return core.TransformStatus(exception_status(err),
-                                        False, 
-                                        message='error of type %s closing bid window %s' % (err.__class__.__name__, window_id))
+                                        False,
+                                        message='error of type %s awarding %d bidding windows' % (err.__class__.__name__, len(awards)))
+
+    for award in awards:
+        if results[award['window_id']]['awarded']:
+            notify_award_winners(award['bids'], sms_svc)
+
+    return core.TransformStatus(ok_status('award jobs to winning bidders',
+                                          results=list(results.values())))
 
 
 def rebroadcast_func(input_data, service_objects, **kwargs):
@@ -1890,19 +2019,99 @@ def bidding_status_func(input_data, service_objects, **kwargs):
 
     windows = []
     db_svc = service_objects.lookup('postgres')
-    with db_svc.txn_scope() as session:
+    with db_svc.read_scope() as session:
         for bwindow in lookup_open_bidding_windows(session, db_svc):
-            windows.append({
-                'bidding_window_id': bwindow.id,
-                'job_id': bwindow.job_id,
-                'job_tag': bwindow.job_tag,
-                'policy': bwindow.policy,
-                'open_ts': bwindow.open_ts.isoformat()
-            })
+            windows.append(prepare_bidding_window_record(bwindow))
 
     return core.TransformStatus(ok_status('bidstat', bidding_windows=windows))
 
 
+def arbitration_snapshot_func(input_data, service_objects, **kwargs):
+    '''Return all open bidding windows, each with its policy and its live bids,
+    so that the arbitration scanner can evaluate every window from one call.
+    An optional window_ids parameter (comma-separated) limits the result to
+    those windows.
+    '''
+
+    window_ids = None
+    if input_data.get('window_ids') is not None:
+        window_ids = [window_id for window_id in input_data['window_ids'].split(',') if window_id]
+
+    db_svc = service_objects.lookup('postgres')
+    with db_svc.txn_scope() as session:
+        windows = lookup_arbitration_snapshot(session, db_svc, window_ids)
+
+    return core.TransformStatus(ok_status('arbitration snapshot', bidding_windows=windows))
+
+
+DEFAULT_JOB_BROADCAST_LEASE_SECONDS = 900
+
+
+def claim_job_broadcast(job_tag, lease_seconds, session, db_svc, current_time):
+    '''Claim the broadcast of <job_tag> for the caller, unless it has been completed
+    or someone else holds a claim which has not yet expired. Returns the job's
+    broadcast status: claimed (by this call), in_progress or completed.
+    '''
+    broadcasts = db_svc.Base.classes.job_broadcasts.__table__
+    statement = pg_insert(broadcasts).values(job_tag=job_tag,
+                                             claimed_ts=current_time,
+                                             lease_expires_ts=current_time + datetime.timedelta(seconds=lease_seconds))
+    # concurrent claims of one tag queue on the row lock; only the first gets a row back
+    statement = statement.on_conflict_do_update(index_elements=['job_tag'],
+                                                set_={'claimed_ts': statement.excluded.claimed_ts,
+                                                      'lease_expires_ts': statement.excluded.lease_expires_ts},
+                                                where=and_(broadcasts.c.completed_ts == None,
+                                                           broadcasts.c.lease_expires_ts <= current_time))
+
+    if session.execute(statement.returning(broadcasts.c.job_tag)).first() is not None:
+        return JOB_BROADCAST_CLAIMED
+
+    completed_ts = session.query(broadcasts.c.completed_ts).filter(broadcasts.c.job_tag == job_tag).scalar()
+    return JOB_BROADCAST_COMPLETED if completed_ts is not None else JOB_BROADCAST_IN_PROGRESS
+
+
+def complete_job_broadcast(job_tag, session, db_svc, current_time):
+    broadcasts = db_svc.Base.classes.job_broadcasts.__table__
+    session.execute(broadcasts.update().where(broadcasts.c.job_tag == job_tag).values(completed_ts=current_time))
+    return JOB_BROADCAST_COMPLETED
+
+
+def release_job_broadcast(job_tag, session, db_svc, current_time):
+    # a completed broadcast stays recorded; only an unfinished claim is given up
+    broadcasts = db_svc.Base.classes.job_broadcasts.__table__
+    session.execute(broadcasts.delete().where(and_(broadcasts.c.job_tag == job_tag,
+                                                   broadcasts.c.completed_ts == None)))
+    return JOB_BROADCAST_RELEASED
+
+
+def job_broadcast_func(input_data, service_objects, **kwargs):
+    '''Claim, complete or release the SMS broadcast of a job, so that a job is
+    broadcast to the courier roster once even when its "posted" message is
+    delivered more than once. The input is
+    {"job_tag": <tag>, "action": "claim" | "complete" | "release", "lease_seconds": <n>},
+    where lease_seconds (claim only) is how long an unfinished claim holds.
+    '''
+    job_tag = input_data['job_tag']
+    action = input_data['action']
+    current_time = datetime.datetime.now()
+
+    db_svc = service_objects.lookup('postgres')
+    with db_svc.txn_scope() as session:
+        if action == 'claim':
+            lease_seconds = int(input_data.get('lease_seconds') or DEFAULT_JOB_BROADCAST_LEASE_SECONDS)
+            broadcast_status = claim_job_broadcast(job_tag, lease_seconds, session, db_svc, current_time)
+        elif action == 'complete':
+            broadcast_status = complete_job_broadcast(job_tag, session, db_svc, current_time)
+        elif action == 'release':
+            broadcast_status = release_job_broadcast(job_tag, session, db_svc, current_time)
+        else:
+            err = Exception('Unknown job broadcast action "%s".' % action)
+            return core.TransformStatus(exception_status(err), False, message=str(err))
 
+    return core.TransformStatus(ok_status('job broadcast', job_tag=job_tag, broadcast_status=broadcast_status))
 
 
+def metrics_func(input_data, service_objects, **kwargs):
+    # Prometheus text format, not JSON; see bxmetrics
+    pool_stats = bxmetrics.pool_stats_collector(service_objects.lookup('postgres'))
+    return core.TransformStatus(bxmetrics.REGISTRY.render(extra_collectors=[pool_stats]))
@@ -1,7 +1,131 @@
 #!/usr/bin/env python
 
 import re
+import threading
+from collections import namedtuple
 from snap import common
+import bxlogging
+
+
+POS_INTEGER_RX = re.compile(r'^[0-9]+$')
+NEG_INTEGER_RX = re.compile(r'^-[0-9]+$')
+RANGE_RX = re.compile(r'^[0-9]+\-[0-9]+$')
+
+# a GSM-7 SMS segment carries 160 characters on its own, or 153 as part of a
+# concatenated message; list replies are paged to a small number of segments
+SMS_SEGMENT_CHARS = 153
+LIST_PAGE_SEGMENTS = 3
+LIST_ITEM_SEPARATOR = '\n\n'
+LIST_PAGE_FOOTER_TPL = '({first}-{last} of {total} {noun}. Text "nxt" for more.)'
+# upper bound on the items in one page, so that a page can be fetched with a LIMIT
+LIST_PAGE_MAX_ITEMS = 40
+
+log = bxlogging.get_logger(__name__)
+
+# the rows a generator command asks for: an optional filter expression, then
+# <limit> rows starting at position <offset> (counted from the end if <reverse>)
+ListSelector = namedtuple('ListSelector', 'filter_expression offset limit reverse')
+
+
+def select_records(record_list, selector, filter_function):
+    '''Apply a ListSelector to an in-memory list. Returns the selected records
+    and the number of records which pass the filter.
+    '''
+    if selector.filter_expression is None:
+        records = list(record_list)
+    else:
+        records = [r for r in record_list if filter_function(r, selector.filter_expression)]
+
+    matched_count = len(records)
+    if selector.reverse:
+        records.reverse()
+
+    if selector.limit is None:
+        return (records[selector.offset:], matched_count)
+    return (records[selector.offset:selector.offset + selector.limit], matched_count)
+
+# filter-expression regexes, compiled once per filter character
+FILTER_EXPRESSION_RX_CACHE = {}
+FILTER_RX_CACHE_LOCK = threading.Lock()
+
+
+def compile_filter_expression_rx(fchar):
+    CHARS_TO_ESCAPE = ['?', '+']
+
+    if fchar in CHARS_TO_ESCAPE:
+        fchar_seq = "\\" + fchar
+    else:
+        fchar_seq = fchar
+
+    filter_expr_at_end_rx = re.compile(r'{fchar}[a-zA-z0-9\-]+$'.format(fchar=fchar_seq))
+    filter_expr_with_ext_rx = re.compile(r'{fchar}[a-zA-z0-9\-]+.'.format(fchar=fchar_seq))
+    return (filter_expr_at_end_rx, filter_expr_with_ext_rx)
+
+
+def lookup_filter_expression_rx(fchar):
+    rx_pair = FILTER_EXPRESSION_RX_CACHE.get(fchar)
+    if rx_pair is None:
+        with FILTER_RX_CACHE_LOCK:
+            rx_pair = FILTER_EXPRESSION_RX_CACHE.get(fchar)
+            if rx_pair is None:
+                rx_pair = compile_filter_expression_rx(fchar)
+                FILTER_EXPRESSION_RX_CACHE[fchar] = rx_pair
+    return rx_pair
+
+
+class CommandGrammar(object):
+    '''Precompiled lookup structures for the three SMS command families.
+
+    System commands and their synonyms are resolved through a single hash index;
+    generator commands are matched by walking a prefix trie, so that a command string
+    such as opn?bk.2 resolves to the "opn" spec without re-splitting the string once per spec.
+    '''
+
+    TERMINAL = None
+
+    def __init__(self, system_specs, generator_specs, prefix_specs):
+        self.system_index = {}
+        for key, cmd_spec in system_specs.items():
+            self.system_index[key] = cmd_spec
+            for synonym in cmd_spec.synonyms:
+                self.system_index[synonym] = cmd_spec
+
+        self.generator_trie = {}
+        for key, cmd_spec in generator_specs.items():
+            node = self.generator_trie
+            for char in key:
+                node = node.setdefault(char, {})
+            node[self.TERMINAL] = cmd_spec
+
+        self.prefix_index = dict(prefix_specs)
+
+    def lookup_system_command(self, cmd_string):
+        return self.system_index.get(cmd_string)
+
+    def lookup_prefix_command(self, prefix_char):
+        return self.prefix_index.get(prefix_char)
+
+    def lookup_generator_command(self, cmd_string):
+        # a generator command matches when its name is followed by either
+        # the end of the string, its specifier, or its filter character.
+        # If more than one name matches, the longest one wins.
+        node = self.generator_trie
+        match = None
+        length = len(cmd_string)
+        index = 0
+        while node is not None:
+            cmd_spec = node.get(self.TERMINAL)
+            if cmd_spec:
+                if index == length or cmd_string[index] in (cmd_spec.specifier, cmd_spec.filterchar):
+                    match = cmd_spec
+
+            if index == length:
+                break
+
+            node = node.get(cmd_string[index])
+            index += 1
+
+        return match
 
 
 class ListOutputResponder(object):
@@ -10,9 +134,10 @@ class ListOutputResponder(object):
         self.command_parse_func = command_parse_function
         self.singular_item_noun = kwargs.get('single_item_noun', 'object')
         self.plural_item_noun = kwargs.get('plural_item_noun', 'objects')
-        self.pos_integer_rx = re.compile(r'^[0-9]+$')
-        self.neg_integer_rx = re.compile(r'^-[0-9]+$')
-        self.range_rx = re.compile(r'^[0-9]+\-[0-9]+$')
+        self.max_page_chars = int(kwargs.get('max_page_chars') or SMS_SEGMENT_CHARS * LIST_PAGE_SEGMENTS)
+        self.pos_integer_rx = POS_INTEGER_RX
+        self.neg_integer_rx = NEG_INTEGER_RX
+        self.range_rx = RANGE_RX
 
     def extension_is_positive_num(self, ext_string):
         if self.pos_integer_rx.match(ext_string):
@@ -37,19 +162,11 @@ class ListOutputResponder(object):
 
         <cmd><filter_char><exp>
         '''
-        CHARS_TO_ESCAPE = ['?', '+']
-
         command_string = cmd_object.cmd_string
         fchar = cmd_object.cmdspec.filterchar
         spec = cmd_object.cmdspec.specifier
 
-        if fchar in CHARS_TO_ESCAPE:
-            fchar_seq = "\\" + fchar
-        else:
-            fchar_seq = fchar
-
-        filter_expr_at_end_rx = re.compile(r'{fchar}[a-zA-z0-9\-]+$'.format(fchar=fchar_seq))
-        filter_expr_with_ext_rx = re.compile(r'{fchar}[a-zA-z0-9\-]+.'.format(fchar=fchar_seq))
+        filter_expr_at_end_rx, filter_expr_with_ext_rx = lookup_filter_expression_rx(fchar)
 
         #
         # the filter expression is the part of the command string between the filter character and:
@@ -72,7 +189,80 @@ class ListOutputResponder(object):
 
         return '*'  # if no match, filter expression is wildcard
 
+    def build_selector(self, cmd_object, **kwargs):
+        '''Translate the filter expression and the index, negative index or range
+        extension of a generator command into a ListSelector. A command with no
+        extension selects one page of the list, starting at <offset>; the page limit
+        is one row more than a page can hold, which tells us whether another page follows.
+        '''
+        filter_expression = self.detect_filter_expression(cmd_object)
+        if filter_expression == '*':
+            filter_expression = None
+
+        tokens = cmd_object.cmd_string.split(cmd_object.cmdspec.specifier)
+        if len(tokens) == 1:
+            return ListSelector(filter_expression, int(kwargs.get('offset') or 0), LIST_PAGE_MAX_ITEMS + 1, False)
+
+        ext = tokens[1]
+        if self.extension_is_positive_num(ext):
+            return ListSelector(filter_expression, max(0, int(ext) - 1), 1, False)
+
+        if self.extension_is_negative_num(ext):
+            return ListSelector(filter_expression, max(0, -int(ext) - 1), 1, True)
+
+        if self.extension_is_range(ext):
+            min_index, max_index = [int(t) for t in ext.split('-')]
+            return ListSelector(filter_expression, max(0, min_index - 1), max(0, max_index - min_index + 1), False)
+
+        return ListSelector(filter_expression, 0, None, False)
+
+    def render_page(self, items, offset, render_callback, count_func):
+        '''Render <items> -- the records of the list from position <offset> on -- until the
+        next one would overflow the page (a page always holds at least one item). Returns
+        the page text and the offset of the following page, which is None if this is the
+        last page.
+        '''
+        footer_length = len(LIST_PAGE_FOOTER_TPL.format(first=999999,
+                                                        last=999999,
+                                                        total=999999,
+                                                        noun=self.plural_item_noun))
+        budget = self.max_page_chars - footer_length - len(LIST_ITEM_SEPARATOR)
+
+        lines = []
+        page_length = 0
+        for position, item in enumerate(items):
+            if len(lines) == LIST_PAGE_MAX_ITEMS:
+                break
+
+            line = render_callback(offset + position + 1, item)
+            line_length = len(line) + (len(LIST_ITEM_SEPARATOR) if lines else 0)
+            if lines and page_length + line_length > budget:
+                break
+
+            lines.append(line)
+            page_length += line_length
+
+        if len(lines) >= len(items):
+            return (LIST_ITEM_SEPARATOR.join(lines), None)
+
+        next_offset = offset + len(lines)
+        lines.append(LIST_PAGE_FOOTER_TPL.format(first=offset + 1,
+                                                 last=next_offset,
+                                                 total=count_func(),
+                                                 noun=self.plural_item_noun))
+        return (LIST_ITEM_SEPARATOR.join(lines), next_offset)
+
     def generate(self, **kwargs):
+        '''Optional keyword args:
+
+        selector: the ListSelector (see build_selector) already applied to <record_list>
+        by the caller, typically in SQL. Without one, <record_list> is the entire list,
+        and the command's filter and index are applied to it here.
+        count_callback: with a selector, returns the number of records matching its filter
+        offset: index of the first item to show (to resume a paged listing)
+        on_page: callback which receives the offset of the next page after each page
+        is rendered, or None once the last page has been shown
+        '''
 
         kwreader = common.KeywordArgReader('command_object',
                                            'record_list',
@@ -91,11 +281,16 @@ class ListOutputResponder(object):
         dlg_engine = kwargs['dialog_engine']
         service_registry = kwargs['service_registry']
 
-        filter_expression = self.detect_filter_expression(cmd_object)
-        if filter_expression == '*':
-            items = rec_list
+        selector = kwargs.get('selector')
+        if selector is None:
+            selector = self.build_selector(cmd_object, offset=kwargs.get('offset'))
+            items, matched_count = select_records(rec_list, selector, filter_function)
+            count_func = lambda: matched_count
         else:
-            items = [item for item in rec_list if filter_function(item, filter_expression)]
+            items = rec_list
+            count_func = kwargs.get('count_callback') or (lambda: selector.offset + len(items))
+
+        # from here on, <items> holds only the selected records
 
         # we will either receive a plain command string,
         # or a command string followed immediately by specifier
@@ -103,18 +298,22 @@ class ListOutputResponder(object):
         #
         tokens = cmd_object.cmd_string.split(cmd_object.cmdspec.specifier)
         if len(tokens) == 1:
-            lines = []
-            index = 1
-
             # if no specifier is present in the command string,
-            # return the entire list (with indices)
-            # TODO: segment output for very long lists
-
-            for item in items:
-                lines.append(render_callback(index, item))
-                index += 1
-
-            return '\n\n'.join(lines)
+            # return the list (with indices) one page at a time
+            offset = selector.offset
+            on_page = kwargs.get('on_page')
+
+            if not len(items):
+                if on_page:
+                    on_page(None)
+                if offset:
+                    return 'There are no more %s in this list.' % self.plural_item_noun
+                return 'There are no %s matching "%s".' % (self.plural_item_noun, selector.filter_expression)
+
+            page_text, next_offset = self.render_page(items, offset, render_callback, count_func)
+            if on_page:
+                on_page(next_offset)
+            return page_text
 
         else:
             ext = tokens[1]
@@ -127,14 +326,14 @@ class ListOutputResponder(object):
             if self.extension_is_positive_num(ext):
                 list_index = int(ext)
 
-                if list_index > len(items):
-                    return ("You requested open job # %d, but there are only %d %s in this list."
-                            % (list_index, len(items), self.plural_item_noun))
-
                 if list_index == 0:
                     return "You may not request the 0th element of a list. (Nice try, C programmers.)"
 
-                list_element = items[list_index-1]
+                if not len(items):
+                    return ("You requested open job # %d, but there are only %d %s in this list."
+                            % (list_index, count_func(), self.plural_item_noun))
+
+                list_element = items[0]
 
                 # if the user is extracting a single list element (by using an integer extension), we do 
                 # one of two things. If there were no command modifiers specified, we simply return the element:
@@ -152,7 +351,7 @@ class ListOutputResponder(object):
                     command_string = '+'.join(command_tokens)
                     chained_command = self.command_parse_func(command_string)
 
-                    print('command: ' + str(chained_command))                                       
+                    log.debug_sampled('chained command', command=chained_command)
                     return dlg_engine.reply_command(chained_command, dlg_context, service_registry)
 
             elif self.extension_is_negative_num(ext):
@@ -160,13 +359,12 @@ class ListOutputResponder(object):
                 if neg_index == 0:
                     return '-0 is not a valid negative index. Use -1 to specify the last %s in the list.' % self.singular_item_noun
 
-                zero_list_index = len(items) + neg_index
-
-                if zero_list_index < 0:
+                if not len(items):
                     return ('You specified a negative list offset (%d), but there are only %d %s in the list.' 
-                            % (neg_index, len(items), self.plural_item_noun))
+                            % (neg_index, count_func(), self.plural_item_noun))
 
-                list_element = items[zero_list_index]
+                # the selector reverses the list, so the requested element comes first
+                list_element = items[0]
 
                 if not len(cmd_object.modifiers):
                     return list_element
@@ -180,7 +378,7 @@ class ListOutputResponder(object):
                     command_string = '+'.join(command_tokens)
                     chained_command = self.command_parse_func(command_string)
 
-                    print('command: ' + str(chained_command))                                       
+                    log.debug_sampled('chained command', command=chained_command)
                     return dlg_engine.reply_command(chained_command, dlg_context, service_registry)
 
             elif self.extension_is_range(ext):
@@ -195,16 +393,16 @@ class ListOutputResponder(object):
                 if min_index > max_index:
                     return 'The first number in your range specification A-B must be less than or equal to the second number.'
 
-                if max_index > len(items):
-                    return "There are only %d %s open." % (len(items), self.plural_item_noun)
-
                 if min_index == 0:
                     return "You may not request the 0th element of a list. (This stack was written in Python, but the UI is in English.)"
 
+                if len(items) < max_index - min_index + 1:
+                    return "There are only %d %s open." % (count_func(), self.plural_item_noun)
+
                 if not len(cmd_object.modifiers):
                     lines = []
                     for index in range(min_index, max_index+1):
-                        lines.append(render_callback(index, items[index-1]))
+                        lines.append(render_callback(index, items[index-min_index]))
 
                     return '\n\n'.join(lines)
                 else:
@@ -215,14 +413,14 @@ class ListOutputResponder(object):
                         # ...we construct a new command by chaining the current element
                         # with the modifier array
 
-                        command_tokens = [items[index-1]]
+                        command_tokens = [items[index-min_index]]
                         command_tokens.extend(cmd_object.modifiers)
 
                         # sub + for spaces
                         command_string = '+'.join(command_tokens)
                         chained_command = self.command_parse_func(command_string)
 
-                        print('command: ' + str(chained_command))                                       
+                        log.debug_sampled('chained command', command=chained_command)
                         lines.append(dlg_engine.reply_command(chained_command, dlg_context, service_registry))
 
                     return '\n\n'.join(lines)
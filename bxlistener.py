@@ -91,6 +91,12 @@ default = core.InputShape("default")
 award_job_shape = core.InputShape("award_job_shape")
 award_job_shape.add_field('window_id', 'str', True)
 award_job_shape.add_field('bids', 'list', True)
+award_jobs_shape = core.InputShape("award_jobs_shape")
+award_jobs_shape.add_field('awards', 'list', True)
+job_broadcast_shape = core.InputShape("job_broadcast_shape")
+job_broadcast_shape.add_field('job_tag', 'str', True)
+job_broadcast_shape.add_field('action', 'str', True)
+job_broadcast_shape.add_field('lease_seconds', 'int', False)
 rebroadcast_shape = core.InputShape("rebroadcast_shape")
 rebroadcast_shape.add_field('job_tag', 'str', True)
 rollover_shape = core.InputShape("rollover_shape")
@@ -113,9 +119,13 @@ xformer.register_transform('close_bidding', close_bidding_shape, bx_transforms.c
 xformer.register_transform('active_job_bids', job_bids_shape, bx_transforms.active_job_bids_func, 'application/json')
 xformer.register_transform('bidding_policy', default, bx_transforms.bidding_policy_func, 'application/json')
 xformer.register_transform('award_job', award_job_shape, bx_transforms.award_job_func, 'application/json')
+xformer.register_transform('award_jobs', award_jobs_shape, bx_transforms.award_jobs_func, 'application/json')
+xformer.register_transform('metrics', default, bx_transforms.metrics_func, 'text/plain; version=0.0.4; charset=utf-8')
 xformer.register_transform('rebroadcast', rebroadcast_shape, bx_transforms.rebroadcast_func, 'application/json')
 xformer.register_transform('rollover', rollover_shape, bx_transforms.rollover_func, 'application/json')
 xformer.register_transform('bidding_status', default, bx_transforms.bidding_status_func, 'application/json')
+xformer.register_transform('arbitration_snapshot', default, bx_transforms.arbitration_snapshot_func, 'application/json')
+xformer.register_transform('job_broadcast', job_broadcast_shape, bx_transforms.job_broadcast_func, 'application/json')
 
 #-- endpoints -----------------
 
@@ -578,6 +588,114 @@ def bidding_status():
         log.error("Exception thrown: ", exc_info=1)        
         raise err
 
+@app.route('/arbsnap', methods=['GET'])
+def arbitration_snapshot():
+    try:
+        if app.debug:
+            # dump request headers for easier debugging
+            log.info('### HTTP request headers:')
+            log.info(request.headers)
+
+        input_data = {}
+                                
+        input_data.update(request.args)
+        
+        transform_status = xformer.transform('arbitration_snapshot',
+                                             input_data,
+                                             headers=request.headers)
+                
+        output_mimetype = xformer.target_mimetype_for_transform('arbitration_snapshot')
+
+        if transform_status.ok:
+            return Response(transform_status.output_data, status=snap.HTTP_OK, mimetype=output_mimetype)
+        return Response(json.dumps(transform_status.user_data), 
+                        status=transform_status.get_error_code() or snap.HTTP_DEFAULT_ERRORCODE, 
+                        mimetype=output_mimetype) 
+    except Exception as err:
+        log.error("Exception thrown: ", exc_info=1)        
+        raise err
+
+@app.route('/awards', methods=['POST'])
+def award_jobs():
+    try:
+        if app.debug:
+            # dump request headers for easier debugging
+            log.info('### HTTP request headers:')
+            log.info(request.headers)
+
+        input_data = {}
+                
+        request.get_data()
+        input_data.update(core.map_content(request))
+        
+        transform_status = xformer.transform('award_jobs', input_data, headers=request.headers)
+
+                
+        output_mimetype = xformer.target_mimetype_for_transform('award_jobs')
+
+        if transform_status.ok:
+            return Response(transform_status.output_data, status=snap.HTTP_OK, mimetype=output_mimetype)
+        return Response(json.dumps(transform_status.user_data), 
+                        status=transform_status.get_error_code() or snap.HTTP_DEFAULT_ERRORCODE, 
+                        mimetype=output_mimetype) 
+    except Exception as err:
+        log.error("Exception thrown: ", exc_info=1)        
+        raise err
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    try:
+        if app.debug:
+            # dump request headers for easier debugging
+            log.info('### HTTP request headers:')
+            log.info(request.headers)
+
+        input_data = {}
+                                
+        input_data.update(request.args)
+        
+        transform_status = xformer.transform('metrics',
+                                             input_data,
+                                             headers=request.headers)
+                
+        output_mimetype = xformer.target_mimetype_for_transform('metrics')
+
+        if transform_status.ok:
+            return Response(transform_status.output_data, status=snap.HTTP_OK, mimetype=output_mimetype)
+        return Response(json.dumps(transform_status.user_data), 
+                        status=transform_status.get_error_code() or snap.HTTP_DEFAULT_ERRORCODE, 
+                        mimetype=output_mimetype) 
+    except Exception as err:
+        log.error("Exception thrown: ", exc_info=1)        
+        raise err
+
+@app.route('/broadcasts', methods=['POST'])
+def job_broadcast():
+    try:
+        if app.debug:
+            # dump request headers for easier debugging
+            log.info('### HTTP request headers:')
+            log.info(request.headers)
+
+        input_data = {}
+                
+        request.get_data()
+        input_data.update(core.map_content(request))
+        
+        transform_status = xformer.transform('job_broadcast', input_data, headers=request.headers)
+
+                
+        output_mimetype = xformer.target_mimetype_for_transform('job_broadcast')
+
+        if transform_status.ok:
+            return Response(transform_status.output_data, status=snap.HTTP_OK, mimetype=output_mimetype)
+        return Response(json.dumps(transform_status.user_data), 
+                        status=transform_status.get_error_code() or snap.HTTP_DEFAULT_ERRORCODE, 
+                        mimetype=output_mimetype) 
+    except Exception as err:
+        log.error("Exception thrown: ", exc_info=1)        
+        raise err
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+'''Structured, non-blocking logging for BXLOGIC services.
+
+Each module takes a logger with
+
+    log = bxlogging.get_logger(__name__)
+
+and logs a short event message plus keyword fields:
+
+    log.info('sms received', mobile_number=number, command='opn')
+
+Records are written as one logfmt line each (ts=... level=... logger=... msg=... key=value ...).
+The calling thread only builds the record and enqueues it; a background
+listener thread formats it and does the write. If the queue is full the
+record is dropped rather than blocking the request. Drops are counted in the
+bxlogic_log_records_dropped_total metric, and reported in a warning line as
+soon as the queue has room again.
+
+High-volume debug lines go through debug_sampled(), which emits roughly one
+call in every 1/BXLOGIC_LOG_DEBUG_SAMPLE_RATE.
+
+Environment settings:
+
+    BXLOGIC_LOG_LEVEL               DEBUG | INFO | WARNING | ERROR (default INFO)
+    BXLOGIC_LOG_DEBUG_SAMPLE_RATE   fraction of sampled debug calls to emit (default 0.01)
+    BXLOGIC_LOG_QUEUE_SIZE          records held for the writer thread (default 10000)
+'''
+
+import os
+import sys
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+import multiprocessing.util
+from logging.handlers import QueueHandler, QueueListener
+
+import bxmetrics
+
+
+ROOT_LOGGER_NAME = 'bxlogic'
+DEFAULT_LEVEL = 'INFO'
+DEFAULT_DEBUG_SAMPLE_RATE = 0.01
+DEFAULT_QUEUE_SIZE = 10000
+
+# attributes of every LogRecord; anything else on a record is a structured field
+STANDARD_RECORD_ATTRS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__.keys()) | {'message', 'asctime'}
+
+DROPPED_RECORDS = bxmetrics.REGISTRY.counter('bxlogic_log_records_dropped_total',
+                                             'Log records discarded because the log queue was full.')
+
+
+def logfmt_value(value):
+    text = str(value)
+    if text == '' or any(c in text for c in ' ="\n\t'):
+        return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return text
+
+
+class LogfmtFormatter(logging.Formatter):
+    def format(self, record):
+        timestamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+        pairs = [('ts', '%s.%03dZ' % (timestamp, record.msecs)),
+                 ('level', record.levelname.lower()),
+                 ('logger', record.name),
+                 ('msg', record.getMessage())]
+
+        for name, value in record.__dict__.items():
+            if name not in STANDARD_RECORD_ATTRS:
+                pairs.append((name, value))
+
+        line = ' '.join('%s=%s' % (name, logfmt_value(value)) for name, value in pairs)
+        if record.exc_text:
+            line = '%s\n%s' % (line, record.exc_text)
+        return line
+
+
+class DroppingQueueHandler(QueueHandler):
+    '''Enqueues records without ever blocking the caller. Records which arrive
+    while the queue is full are counted and discarded.
+    '''
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.reported_dropped = 0
+        self._report_lock = threading.Lock()
+
+    def prepare(self, record):
+        # formatting happens on the listener thread; only make the record safe to hand over
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        # a forked worker inherits the queue but not the listener thread
+        if LOGGING_STATE.get('pid') != os.getpid():
+            restart_listener()
+            LOGGING_STATE['handler'].enqueue(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            DROPPED_RECORDS.inc()
+            return
+
+        if self.dropped != self.reported_dropped:
+            self.report_dropped()
+
+    def report_dropped(self):
+        # say in the log itself that lines are missing from it, once there is room to
+        with self._report_lock:
+            unreported = self.dropped - self.reported_dropped
+            if unreported <= 0:
+                return
+            record = logging.LogRecord('%s.bxlogging' % ROOT_LOGGER_NAME, logging.WARNING, __file__, 0,
+                                       'log records dropped; the log queue was full', None, None)
+            record.dropped = unreported
+            try:
+                self.queue.put_nowait(record)
+                self.reported_dropped += unreported
+            except queue.Full:
+                pass
+
+
+LOGGING_STATE = {}
+LOGGING_LOCK = threading.Lock()
+
+
+def env_setting(name, default):
+    value = os.getenv(name)
+    return value if value else default
+
+
+def start_listener():
+    log_queue = queue.Queue(maxsize=int(env_setting('BXLOGIC_LOG_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)))
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(LogfmtFormatter())
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    listener.start()
+
+    handler = DroppingQueueHandler(log_queue)
+    root_logger = logging.getLogger(ROOT_LOGGER_NAME)
+    if LOGGING_STATE.get('handler'):
+        root_logger.removeHandler(LOGGING_STATE['handler'])
+    root_logger.addHandler(handler)
+
+    LOGGING_STATE.update(pid=os.getpid(), handler=handler, listener=listener)
+
+    # multiprocessing workers (ProcessPoolExecutor) leave through os._exit(), which skips
+    # atexit handlers but runs these finalizers, so their queued records are still written
+    multiprocessing.util.Finalize(None, stop_listener, exitpriority=0)
+
+
+def restart_listener():
+    with LOGGING_LOCK:
+        if LOGGING_STATE.get('pid') != os.getpid():
+            start_listener()
+
+
+def stop_listener():
+    listener = LOGGING_STATE.get('listener')
+    if listener and LOGGING_STATE.get('pid') == os.getpid():
+        # drain whatever is still queued before the process exits
+        listener.stop()
+        LOGGING_STATE['listener'] = None
+
+
+def configure_logging():
+    with LOGGING_LOCK:
+        if LOGGING_STATE.get('configured'):
+            return
+
+        root_logger = logging.getLogger(ROOT_LOGGER_NAME)
+        root_logger.setLevel(env_setting('BXLOGIC_LOG_LEVEL', DEFAULT_LEVEL).upper())
+        root_logger.propagate = False
+
+        LOGGING_STATE['debug_sample_rate'] = float(env_setting('BXLOGIC_LOG_DEBUG_SAMPLE_RATE',
+                                                               DEFAULT_DEBUG_SAMPLE_RATE))
+        start_listener()
+        atexit.register(stop_listener)
+        LOGGING_STATE['configured'] = True
+
+
+class StructuredLogger(object):
+    '''Thin wrapper over a stdlib logger which takes structured fields as
+    keyword arguments. Level checks happen before anything is built, so a
+    suppressed call costs one comparison.
+    '''
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    # field names must not collide with LogRecord attributes (name, msg, args, ...)
+    def _log(self, level, message, fields, exc_info=False):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, message, extra=fields, exc_info=exc_info)
+
+    def debug(self, message, **fields):
+        self._log(logging.DEBUG, message, fields)
+
+    def debug_sampled(self, message, **fields):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        sample_rate = LOGGING_STATE.get('debug_sample_rate', DEFAULT_DEBUG_SAMPLE_RATE)
+        if random.random() < sample_rate:
+            fields['sample_rate'] = sample_rate
+            self._log(logging.DEBUG, message, fields)
+
+    def info(self, message, **fields):
+        self._log(logging.INFO, message, fields)
+
+    def warning(self, message, **fields):
+        self._log(logging.WARNING, message, fields)
+
+    def error(self, message, **fields):
+        self._log(logging.ERROR, message, fields)
+
+    def exception(self, message, **fields):
+        self._log(logging.ERROR, message, fields, exc_info=True)
+
+    def is_debug_enabled(self):
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+
+def get_logger(name):
+    configure_logging()
+    return StructuredLogger(logging.getLogger('%s.%s' % (ROOT_LOGGER_NAME, name)))
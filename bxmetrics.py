@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+'''In-process latency, error and concurrency metrics, rendered in the
+Prometheus text exposition format (version 0.0.4).
+
+Every metric is labelled by the name of the thing being measured (a transform
+in the web listener, a message handler in a queue consumer). Latencies are
+kept as cumulative histograms, so per-endpoint quantiles come from the
+scraper, e.g.
+
+    histogram_quantile(0.99, rate(bxlogic_transform_duration_seconds_bucket{transform="sms_responder"}[5m]))
+
+Metrics live in the memory of the process which records them; under a
+multi-worker WSGI server each worker reports its own series.
+'''
+
+import time
+import threading
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# upper bounds, in seconds; chosen to resolve p50 and p99 for both
+# sub-10ms lookups and multi-second SMS fan-out
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def get_log():
+    # imported on first use: bxlogging registers its own metrics here when it loads
+    import bxlogging
+    return bxlogging.get_logger(__name__)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.extend(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label_value(value)) for name, value in pairs)
+
+
+class Metric(object):
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, label_values):
+        if len(label_values) != len(self.label_names):
+            raise Exception('Metric %s expects labels %s; got %s.' % (self.name, self.label_names, label_values))
+        return tuple(str(v) for v in label_values)
+
+    def header_lines(self):
+        return ['# HELP %s %s' % (self.name, self.documentation),
+                '# TYPE %s %s' % (self.name, self.metric_type)]
+
+    def sample_lines(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return ['%s%s %s' % (self.name, format_labels(self.label_names, key), format_value(value))
+                for key, value in items]
+
+    def render(self):
+        return self.header_lines() + self.sample_lines()
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def inc(self, *label_values, amount=1):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names, buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, *label_values, value):
+        key = self._key(label_values)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    series['counts'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def sample_lines(self):
+        with self._lock:
+            items = sorted((key, dict(series, counts=list(series['counts']))) for key, series in self._values.items())
+
+        lines = []
+        for key, series in items:
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name,
+                                                 format_labels(self.label_names, key, [('le', format_value(upper_bound))]),
+                                                 cumulative))
+            labels = format_labels(self.label_names, key)
+            lines.append('%s_sum%s %s' % (self.name, labels, format_value(series['sum'])))
+            lines.append('%s_count%s %d' % (self.name, labels, series['count']))
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def add_collector(self, collector_func):
+        '''<collector_func> is called at render time and returns a list of
+        metrics, for values (such as connection pool state) which are read
+        rather than recorded.
+        '''
+        self.collectors.append(collector_func)
+
+    def render(self, extra_collectors=()):
+        '''Render every registered metric, then the output of every collector,
+        including <extra_collectors>, which are used for this call only.
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        for collector_func in list(self.collectors) + list(extra_collectors):
+            try:
+                for metric in collector_func():
+                    lines.extend(metric.render())
+            except Exception:
+                # a broken collector must not take the rest of the scrape down with it
+                get_log().exception('metrics collector failed',
+                                    collector=getattr(collector_func, '__name__', collector_func))
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class OperationMetrics(object):
+    '''Latency histogram, error counter and in-flight gauge for one family of
+    named operations (transforms, queue handlers), all labelled <label_name>.
+    '''
+
+    def __init__(self, registry, prefix, label_name, noun):
+        self.duration = registry.histogram('%s_duration_seconds' % prefix,
+                                           'Time taken to complete a %s, in seconds.' % noun,
+                                           [label_name])
+        self.errors = registry.counter('%s_errors_total' % prefix,
+                                       'Number of %s calls which raised or returned an error.' % noun,
+                                       [label_name])
+        self.in_flight = registry.gauge('%s_in_flight' % prefix,
+                                        'Number of %s calls currently running.' % noun,
+                                        [label_name])
+
+    def started(self, name):
+        self.in_flight.inc(name)
+        return time.monotonic()
+
+    def finished(self, name, start_time, failed=False):
+        self.in_flight.dec(name)
+        self.duration.observe(name, value=time.monotonic() - start_time)
+        if failed:
+            self.errors.inc(name)
+
+    @contextmanager
+    def measure(self, name):
+        start_time = self.started(name)
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.finished(name, start_time, failed)
+
+
+TRANSFORM_METRICS = OperationMetrics(REGISTRY, 'bxlogic_transform', 'transform', 'transform')
+# labelled by the consumer's entry function (msg_handler, scan_handler), not by the
+# event handler it dispatches to: in process mode only the worker knows the event type
+HANDLER_METRICS = OperationMetrics(REGISTRY, 'bxlogic_handler', 'handler', 'queue message handler')
+
+
+def instrument_transformer_class(transformer_class):
+    '''Wrap <transformer_class>.transform() so that every call, on every instance,
+    is measured under the name of the transform it runs. A call counts as an error
+    if it raises, or if the returned TransformStatus is not ok.
+
+    This patches the class rather than an instance because the web listener's
+    Transformer is created in bxlistener.py, which is generated by routegen and
+    must not be edited by hand; TransformMetricsService (bx_services) calls it
+    when the listener starts. Calling this more than once has no further effect.
+    '''
+    transform_func = transformer_class.transform
+    if getattr(transform_func, 'instrumented', False):
+        return transformer_class
+
+    def instrumented_transform(self, transform_name, input_data, **kwargs):
+        start_time = TRANSFORM_METRICS.started(transform_name)
+        failed = True
+        try:
+            transform_status = transform_func(self, transform_name, input_data, **kwargs)
+            failed = not transform_status.ok
+            return transform_status
+        finally:
+            TRANSFORM_METRICS.finished(transform_name, start_time, failed)
+
+    instrumented_transform.instrumented = True
+    transformer_class.transform = instrumented_transform
+    return transformer_class
+
+
+# pool statistics which only ever go up; the rest are point-in-time values
+POOL_STAT_COUNTERS = {'checkouts', 'checkout_timeouts', 'checkout_errors', 'wait_seconds'}
+
+
+def pool_stats_collector(db_svc):
+    '''Return a collector which reports the connection pool state of <db_svc>
+    (see PostgreSQLService.pool_stats()).
+    '''
+    def collect():
+        stats = db_svc.pool_stats()
+        metrics = []
+        for stat_name in sorted(stats.keys()):
+            if stat_name in POOL_STAT_COUNTERS:
+                counter = Counter('bxlogic_db_pool_%s_total' % stat_name,
+                                  'PostgreSQL connection pool statistic %s, since the process started.' % stat_name,
+                                  ())
+                counter.inc(amount=stats[stat_name])
+                metrics.append(counter)
+            else:
+                gauge = Gauge('bxlogic_db_pool_%s' % stat_name,
+                              'PostgreSQL connection pool statistic %s.' % stat_name,
+                              ())
+                gauge.set(value=stats[stat_name])
+                metrics.append(gauge)
+        return metrics
+
+    return collect
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes arrive every few seconds; don't echo each one to stderr
+        pass
+
+
+class ThreadingMetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port, bind_host='0.0.0.0'):
+    '''Serve /metrics from a daemon thread, for processes (such as the queue
+    consumers) which have no HTTP listener of their own.
+    '''
+    server = ThreadingMetricsServer((bind_host, int(port)), MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    get_log().info('serving metrics', port=port)
+    return server
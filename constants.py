@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+
+# job status codes (see the lookup_job_status table)
+JOB_STATUS_BROADCAST = 0
+JOB_STATUS_AWARDED = 1
+JOB_STATUS_ACCEPTED = 3
+JOB_STATUS_IN_PROGRESS = 4
+JOB_STATUS_COMPLETED = 5
+
+# job broadcast states (see the job_broadcasts table)
+JOB_BROADCAST_CLAIMED = 'claimed'
+JOB_BROADCAST_IN_PROGRESS = 'in_progress'
+JOB_BROADCAST_COMPLETED = 'completed'
+JOB_BROADCAST_RELEASED = 'released'
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+'''
+Usage:
+    explain-hot-queries --config <configfile>
+
+Runs EXPLAIN against the hot-path queries in bx_transforms.py and bx_jobviews.py,
+with sequential scans disabled, and lists every query whose plan still needs one
+(meaning no usable index exists). Exits with status 1 if any are found.
+
+The SQL is not written out here: each hot-path function is called with sample
+arguments (in a transaction which is rolled back), and the statements SQLAlchemy
+sends for it are the ones explained.
+'''
+
+import sys
+import docopt
+from snap import common
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import text
+from bx_services import PostgreSQLService
+import bx_transforms
+import bx_jobviews
+
+
+SAMPLE_PARAMS = {
+    'mobile_number': '5555555555',
+    'courier_id': '00000000-0000-0000-0000-000000000000',
+    'window_id': '00000000-0000-0000-0000-000000000000',
+    'job_tag': 'bxlog-sample-tag',
+    'handle': 'sample'
+}
+
+# (function name, call against a session and PostgreSQLService)
+HOT_QUERIES = [
+    ('lookup_courier_by_mobile_number',
+     lambda session, db_svc: bx_transforms.lookup_courier_by_mobile_number(SAMPLE_PARAMS['mobile_number'],
+                                                                           session, db_svc)),
+
+    ('lookup_courier_by_id',
+     lambda session, db_svc: bx_transforms.lookup_courier_by_id(SAMPLE_PARAMS['courier_id'], session, db_svc)),
+
+    ('lookup_current_job_status',
+     lambda session, db_svc: bx_transforms.lookup_current_job_status(SAMPLE_PARAMS['job_tag'], session, db_svc)),
+
+    ('list_available_jobs',
+     lambda session, db_svc: bx_jobviews.list_available_jobs(session, db_svc)),
+
+    ('lookup_job_data_by_tag',
+     lambda session, db_svc: bx_transforms.lookup_job_data_by_tag(SAMPLE_PARAMS['job_tag'], session, db_svc)),
+
+    ('lookup_user_job_bid',
+     lambda session, db_svc: bx_transforms.lookup_user_job_bid(SAMPLE_PARAMS['job_tag'],
+                                                               SAMPLE_PARAMS['courier_id'],
+                                                               session, db_svc)),
+
+    ('courier_has_bid',
+     lambda session, db_svc: bx_transforms.courier_has_bid(SAMPLE_PARAMS['courier_id'],
+                                                           SAMPLE_PARAMS['job_tag'],
+                                                           session, db_svc)),
+
+    ('list_user_bids',
+     lambda session, db_svc: bx_jobviews.list_user_bids(SAMPLE_PARAMS['courier_id'], session, db_svc)),
+
+    ('job_belongs_to_courier',
+     lambda session, db_svc: bx_transforms.job_belongs_to_courier(SAMPLE_PARAMS['job_tag'],
+                                                                  SAMPLE_PARAMS['courier_id'],
+                                                                  session, db_svc)),
+
+    ('list_accepted_jobs',
+     lambda session, db_svc: bx_jobviews.list_accepted_jobs(SAMPLE_PARAMS['courier_id'], session, db_svc)),
+
+    ('lookup_bidding_window_by_id',
+     lambda session, db_svc: bx_transforms.lookup_bidding_window_by_id(SAMPLE_PARAMS['window_id'], session, db_svc)),
+
+    ('lookup_open_bidding_window_by_job_tag',
+     lambda session, db_svc: bx_transforms.lookup_open_bidding_window_by_job_tag(SAMPLE_PARAMS['job_tag'],
+                                                                                 session, db_svc)),
+
+    ('lookup_live_courier_handle',
+     lambda session, db_svc: bx_transforms.lookup_live_courier_handle(SAMPLE_PARAMS['courier_id'], session, db_svc)),
+
+    ('lookup_courier_by_handle',
+     lambda session, db_svc: bx_transforms.lookup_courier_by_handle(SAMPLE_PARAMS['handle'], session, db_svc)),
+
+    ('list_user_messages',
+     lambda session, db_svc: bx_transforms.list_user_messages(SAMPLE_PARAMS['courier_id'], session, db_svc)),
+
+    ('active_job_bids_func',
+     lambda session, db_svc: bx_transforms.active_job_bids_func({'job_tag': SAMPLE_PARAMS['job_tag']},
+                                                                common.ServiceObjectRegistry({'postgres': db_svc})))
+]
+
+
+def capture_statements(query_func, db_svc):
+    '''Call <query_func> and return the (SQL, parameters) of every SELECT it
+    sends, on any engine (read_scope() may route it to a replica).
+    '''
+    statements = []
+
+    def record_statement(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', record_statement)
+    session = db_svc.session_factory()
+    try:
+        query_func(session, db_svc)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record_statement)
+        session.rollback()
+        session.close()
+
+    return statements
+
+
+def find_seq_scans(plan_node):
+    relations = []
+    if plan_node.get('Node Type') == 'Seq Scan':
+        relations.append(plan_node.get('Relation Name'))
+
+    for child_node in plan_node.get('Plans') or []:
+        relations.extend(find_seq_scans(child_node))
+
+    return relations
+
+
+def load_postgres_service(yaml_config):
+    init_params = {}
+    for param in yaml_config['service_objects']['postgres']['init_params']:
+        init_params[param['name']] = common.load_config_var(param['value'])
+
+    return PostgreSQLService(**init_params)
+
+
+def main(args):
+    configfile = args['<configfile>']
+    yaml_config = common.read_config_file(configfile)
+    db_svc = load_postgres_service(yaml_config)
+
+    offenders = []
+    with db_svc.connect() as connection:
+        for function_name, query_func in HOT_QUERIES:
+            statements = capture_statements(query_func, db_svc)
+            if not statements:
+                print('(none)    %s: sent no query' % function_name)
+                continue
+
+            seq_scanned_tables = []
+            txn = connection.begin()
+            try:
+                connection.execute(text('SET LOCAL search_path TO %s' % db_svc.schema))
+                connection.execute(text('SET LOCAL enable_seqscan = off'))
+                for sql, parameters in statements:
+                    # already compiled for psycopg2, so it goes to the driver as-is
+                    plan = connection.execute('EXPLAIN (FORMAT JSON) %s' % sql, parameters).scalar()
+                    seq_scanned_tables.extend(find_seq_scans(plan[0]['Plan']))
+            finally:
+                txn.rollback()
+
+            if seq_scanned_tables:
+                offenders.append((function_name, seq_scanned_tables))
+                print('SEQ SCAN  %s: %s' % (function_name, ', '.join(seq_scanned_tables)))
+            else:
+                print('ok        %s' % function_name)
+
+    if offenders:
+        print('\n%d of %d hot queries still require a sequential scan.' % (len(offenders), len(HOT_QUERIES)))
+        return 1
+
+    print('\nAll %d hot queries can be served from an index.' % len(HOT_QUERIES))
+    return 0
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    sys.exit(main(args))
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+'''Service module for load-test configs: every production service object, plus
+SMS and S3 services which talk to the harness's StandInServer instead of Twilio
+and AWS. Everything above the client (rate limiting, delivery queues, retries,
+JSON encoding) is the production code path.
+'''
+
+from bx_services import *
+from bx_services import SMSService, S3Service
+from standins import StandInTwilioClient, StandInS3Client
+
+
+class StandInSMSService(SMSService):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.client = StandInTwilioClient(kwargs['standin_url'])
+
+
+class StandInS3Service(S3Service):
+    def __init__(self, **kwargs):
+        # no credentials are needed to reach the stand-in
+        kwargs['auth_via_iam'] = True
+        super().__init__(**kwargs)
+        self.s3client = StandInS3Client(kwargs['standin_url'])
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+
+'''
+Usage:
+    run-loadtest [--couriers <n>] [--jobs <n>] [--job-rate <r>] [--bid-probability <p>] [--think-time <s>] [--scan-interval <s>] [--standin-port <port>] [--standin-latency-ms <ms>] [--timeout <s>] [--results-dir <dir>] [--seed <n>]
+
+Options:
+    --couriers <n>              number of simulated couriers [default: 50]
+    --jobs <n>                  number of jobs to post [default: 100]
+    --job-rate <r>              jobs posted per second [default: 2]
+    --bid-probability <p>       chance that a courier bids on a job it is notified of [default: 0.5]
+    --think-time <s>            each courier reply is delayed by up to this many seconds [default: 2.0]
+    --scan-interval <s>         seconds between scan (arbitration) events [default: 1]
+    --standin-port <port>       port for the Twilio/S3 stand-in server [default: 9060]
+    --standin-latency-ms <ms>   latency added to every stand-in Twilio and S3 call [default: 50]
+    --timeout <s>               seconds to wait for every job to finish, after the last is posted [default: 180]
+    --results-dir <dir>         where to save the run report [default: loadtest/results]
+    --seed <n>                  random seed for job data and courier behaviour [default: 1123]
+'''
+
+#
+# End-to-end load test. Boots the web listener (as a subprocess) and both queue consumers
+# (in this process) against local stand-ins for Twilio, S3 and SQS, then drives simulated
+# couriers and jobs through the whole pipeline:
+#
+#   post job -> S3 notice -> broadcast SMS -> bid -> arbitration -> award SMS
+#            -> accept -> en route -> finished
+#
+# and reports throughput plus latency percentiles for every stage and every HTTP endpoint.
+# PostgreSQL is real: point PGSQL_LOADTEST_DATABASE at a disposable, initialized database.
+#
+
+import os
+import sys
+import json
+import time
+import signal
+import random
+import datetime
+import threading
+import subprocess
+
+import docopt
+import requests
+import yaml
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(LOADTEST_DIR)
+sys.path.append(PROJECT_DIR)
+sys.path.append(LOADTEST_DIR)
+
+from snap import common
+import bxmetrics
+from bx_consumer import QueueConsumer
+from standins import StandInServer, StandInQueue, StandInSQSClient
+from simulation import LatencyRecorder, JobTracker, ListenerClient, CourierSimulator
+
+
+LISTENER_URL = 'http://localhost:9050'
+BASE_WEB_CONFIG = os.path.join(PROJECT_DIR, 'config', 'bx_web.yaml')
+WEB_CONFIG_OVERRIDES = os.path.join(LOADTEST_DIR, 'config', 'bx_web_overrides.yaml')
+SQS_CONFIG = os.path.join(LOADTEST_DIR, 'config', 'bx_sqs_loadtest.yaml')
+
+JOB_BUCKET = 'bxlogic.binarymachines.io'
+JOB_NOTICE_PREFIX = 'posted/'
+JOB_QUEUE = 'bxlogic_jobs'
+EVENT_QUEUE = 'bxlogic_events'
+
+BOROUGH_ZIPS = {
+    'Brooklyn': ['11201', '11211', '11215', '11238'],
+    'Queens': ['11101', '11354', '11375'],
+    'Manhattan': ['10001', '10011', '10027', '10128'],
+    'The Bronx': ['10451', '10458', '10467'],
+    'Staten Island': ['10301', '10314']
+}
+TRANSPORT_METHODS = ['Bicycle', 'Car', 'Motorcycle', 'Walking']
+
+# courier numbers are 9BBBBBNNNN: a random run block B, then the courier's index N
+MAX_COURIERS = 10000
+MOBILE_NUMBER_BLOCKS = 100000
+MAX_REGISTRATION_ATTEMPTS = 5
+
+
+def apply_overrides(config, overrides):
+    '''Apply <overrides> (see loadtest/config/bx_web_overrides.yaml) to a web
+    listener config, in place.
+    '''
+    config['globals'].update(overrides.get('globals') or {})
+
+    for service_name, service_overrides in (overrides.get('service_objects') or {}).items():
+        service_config = config['service_objects'][service_name]
+        if service_overrides.get('class'):
+            service_config['class'] = service_overrides['class']
+
+        params = service_config.setdefault('init_params', [])
+        for param_name, value in (service_overrides.get('init_params') or {}).items():
+            params[:] = [p for p in params if p['name'] != param_name]
+            if value is not None:
+                params.append({'name': param_name, 'value': value})
+    return config
+
+
+def write_web_config(results_dir):
+    '''Generate the listener's config from config/bx_web.yaml, so that the load test
+    always runs the routes, transforms and settings that production does.
+    '''
+    with open(BASE_WEB_CONFIG) as f:
+        config = yaml.safe_load(f)
+    with open(WEB_CONFIG_OVERRIDES) as f:
+        overrides = yaml.safe_load(f)
+
+    config_filename = os.path.join(results_dir, 'bx_web_loadtest.yaml')
+    with open(config_filename, 'w') as f:
+        f.write('# generated by loadtest/run-loadtest.py from %s and %s; do not edit\n'
+                % (os.path.relpath(BASE_WEB_CONFIG, PROJECT_DIR), os.path.relpath(WEB_CONFIG_OVERRIDES, PROJECT_DIR)))
+        yaml.safe_dump(apply_overrides(config, overrides), f, default_flow_style=False, sort_keys=False)
+    return config_filename
+
+
+def start_listener(config_filename, results_dir):
+    env = dict(os.environ)
+    env['BXLOGIC_HOME'] = PROJECT_DIR
+    env['PYTHONPATH'] = os.pathsep.join([PROJECT_DIR, LOADTEST_DIR])
+
+    log_file = open(os.path.join(results_dir, 'listener.log'), 'w')
+    # its own process group, so that stop_listener() takes down anything it has started
+    process = subprocess.Popen([sys.executable, os.path.join(PROJECT_DIR, 'bxlistener.py'), '--configfile', config_filename],
+                               cwd=PROJECT_DIR,
+                               env=env,
+                               stdout=log_file,
+                               stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    return process, log_file
+
+
+def stop_listener(process, timeout_seconds=10):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=timeout_seconds)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+def wait_for_listener(process, timeout_seconds=60):
+    deadline = time.time() + timeout_seconds
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise Exception('web listener exited with status %s during startup; see listener.log' % process.returncode)
+        try:
+            if requests.get('%s/ping' % LISTENER_URL, timeout=1).status_code == 200:
+                return
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.5)
+    raise Exception('web listener did not answer /ping within %d seconds' % timeout_seconds)
+
+
+def start_consumers(queues):
+    '''Runs a QueueConsumer for each source in the load-test SQS config, each on its
+    own daemon thread, reading from the stand-in queues.
+    '''
+    yaml_config = common.read_config_file(SQS_CONFIG)
+    handler_module = yaml_config['globals']['consumer_module']
+    sqs_client = StandInSQSClient(queues)
+
+    threads = []
+    for source_name, source_config in yaml_config['sources'].items():
+        handler_func = common.load_class(source_config['handler'], handler_module)
+        worker_init_func = None
+        if source_config.get('worker_init'):
+            worker_init_func = common.load_class(source_config['worker_init'], handler_module)
+        consumer = QueueConsumer(sqs_client,
+                                 source_config['queue_url'],
+                                 handler_func,
+                                 yaml_config,
+                                 worker_mode=source_config.get('worker_mode'),
+                                 num_workers=source_config.get('num_workers'),
+                                 max_msgs_per_cycle=source_config.get('max_msgs_per_cycle'),
+                                 wait_time_seconds=source_config.get('wait_time_seconds'),
+                                 visibility_timeout_seconds=source_config.get('visibility_timeout_seconds'),
+                                 heartbeat_interval_seconds=source_config.get('heartbeat_interval_seconds'),
+                                 worker_init_func=worker_init_func)
+
+        thread = threading.Thread(target=consumer.run, name='consumer-%s' % source_name, daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def start_scan_driver(event_queue, interval_seconds, stop_event):
+    # stands in for whatever periodically drops scan events on the event queue in production
+    def drive():
+        while not stop_event.wait(interval_seconds):
+            event_queue.send('arbitration event', {'eventtype': {'StringValue': 'arbitration', 'DataType': 'String'}})
+
+    thread = threading.Thread(target=drive, name='scan-driver', daemon=True)
+    thread.start()
+    return thread
+
+
+def create_client(listener_client):
+    response = listener_client.call('POST', '/client', json={
+        'first_name': 'Load',
+        'last_name': 'Test',
+        'phone': '9175550000',
+        'email': 'loadtest@example.com'
+    })
+    response.raise_for_status()
+    return response.json()['data']['data']['id']
+
+
+def create_couriers(listener_client, count, run_block, rng):
+    # returns the new couriers' numbers, or None if any number in the block is taken
+    mobile_numbers = []
+    for i in range(count):
+        mobile_number = '9%05d%04d' % (run_block, i)
+        response = listener_client.call('POST', '/courier', json={
+            'first_name': 'Courier',
+            'last_name': 'LT%04d' % i,
+            'mobile_number': mobile_number,
+            'email': 'courier%05d%04d@example.com' % (run_block, i),
+            'boroughs': ','.join(rng.sample(list(BOROUGH_ZIPS.keys()), 2)),
+            'transport_methods': rng.choice(TRANSPORT_METHODS)
+        })
+        if response.status_code != 200:
+            print('!!! unable to register courier %s (status %s)' % (mobile_number, response.status_code), file=sys.stderr)
+            return None
+        mobile_numbers.append(mobile_number)
+    return mobile_numbers
+
+
+def register_couriers(listener_client, count, rng):
+    '''Creates <count> couriers and brings each of them on duty. Each run takes a
+    random block of mobile numbers; mobile numbers are unique in the couriers table,
+    so if a block turns out to be (partly) taken by an earlier run, it moves on to
+    another. Couriers left behind by an abandoned block stay off duty.
+    '''
+    if count > MAX_COURIERS:
+        raise Exception('at most %d couriers can be simulated.' % MAX_COURIERS)
+
+    # independent of --seed, which repeated runs are likely to share
+    block_rng = random.SystemRandom()
+    mobile_numbers = None
+    for attempt in range(MAX_REGISTRATION_ATTEMPTS):
+        mobile_numbers = create_couriers(listener_client, count, block_rng.randrange(MOBILE_NUMBER_BLOCKS), rng)
+        if mobile_numbers is not None:
+            break
+    else:
+        raise Exception('unable to register %d couriers in %d attempts; see listener.log' % (count, MAX_REGISTRATION_ATTEMPTS))
+
+    for mobile_number in mobile_numbers:
+        listener_client.send_sms(mobile_number, 'on').raise_for_status()
+
+    return mobile_numbers
+
+
+def make_job(client_id, rng, index):
+    pickup_borough = rng.choice(list(BOROUGH_ZIPS.keys()))
+    delivery_borough = rng.choice(list(BOROUGH_ZIPS.keys()))
+    return {
+        'client_id': client_id,
+        'pickup_address': '%d Pickup Street' % rng.randint(1, 999),
+        'pickup_borough': pickup_borough,
+        'pickup_zip': rng.choice(BOROUGH_ZIPS[pickup_borough]),
+        'delivery_address': '%d Delivery Avenue' % rng.randint(1, 999),
+        'delivery_borough': delivery_borough,
+        'delivery_zip': rng.choice(BOROUGH_ZIPS[delivery_borough]),
+        'payment_method': 'Cash',
+        'items': 'load test parcel %d' % index
+    }
+
+
+def post_jobs(listener_client, tracker, client_id, count, jobs_per_second, rng):
+    interval = 1.0 / jobs_per_second if jobs_per_second > 0 else 0
+    start_time = time.time()
+    posted = 0
+    for i in range(count):
+        # keep to the schedule, rather than drifting by the duration of each request
+        delay = start_time + i * interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        request_time = time.time()
+        response = listener_client.call('POST', '/job', json=make_job(client_id, rng, i))
+        if response.status_code != 200:
+            print('!!! job %d was rejected with status %s' % (i, response.status_code), file=sys.stderr)
+            continue
+
+        tracker.mark(response.json()['data']['data']['job_tag'], 'posted', request_time)
+        posted += 1
+    return posted
+
+
+def scrape_listener_metrics():
+    try:
+        return requests.get('%s/metrics' % LISTENER_URL, timeout=5).text
+    except requests.exceptions.RequestException as err:
+        return 'unavailable: %s' % err
+
+
+def print_table(title, rows):
+    print('\n%s' % title)
+    print('%-32s %7s %9s %9s %9s %9s %9s' % ('', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+    for name, stats in rows.items():
+        if not stats['count']:
+            print('%-32s %7d' % (name, 0))
+            continue
+        print('%-32s %7d %9.3f %9.3f %9.3f %9.3f %9.3f' % (name,
+                                                          stats['count'],
+                                                          stats['mean'],
+                                                          stats['p50'],
+                                                          stats['p90'],
+                                                          stats['p99'],
+                                                          stats['max']))
+
+
+def main(args):
+    num_couriers = int(args['--couriers'])
+    num_jobs = int(args['--jobs'])
+    results_dir = args['--results-dir']
+    os.makedirs(results_dir, exist_ok=True)
+    rng = random.Random(int(args['--seed']))
+
+    server = StandInServer(args['--standin-port'], latency_seconds=float(args['--standin-latency-ms']) / 1000.0)
+    os.environ['BXLOGIC_STANDIN_URL'] = server.url
+    os.environ.setdefault('BXLOGIC_HOME', PROJECT_DIR)
+
+    queues = {JOB_QUEUE: StandInQueue(JOB_QUEUE), EVENT_QUEUE: StandInQueue(EVENT_QUEUE)}
+    server.add_s3_notification(JOB_BUCKET, JOB_NOTICE_PREFIX, queues[JOB_QUEUE])
+
+    recorder = LatencyRecorder()
+    tracker = JobTracker()
+    listener_client = ListenerClient(LISTENER_URL, recorder)
+
+    def on_object_written(bucket_name, object_key):
+        # posted/<job_tag>.json
+        if bucket_name == JOB_BUCKET and object_key.startswith(JOB_NOTICE_PREFIX):
+            tracker.mark(object_key[len(JOB_NOTICE_PREFIX):].rsplit('.', 1)[0], 'noticed')
+
+    server.add_object_listener(on_object_written)
+    server.start()
+    print('### stand-in server listening at %s' % server.url, file=sys.stderr)
+
+    listener_process, listener_log = start_listener(write_web_config(results_dir), results_dir)
+    stop_event = threading.Event()
+    couriers = None
+    mobile_numbers = []
+    try:
+        wait_for_listener(listener_process)
+        print('### web listener is up', file=sys.stderr)
+
+        start_consumers(queues)
+        start_scan_driver(queues[EVENT_QUEUE], float(args['--scan-interval']), stop_event)
+
+        client_id = create_client(listener_client)
+        mobile_numbers = register_couriers(listener_client, num_couriers, rng)
+        print('### %d couriers on duty' % len(mobile_numbers), file=sys.stderr)
+
+        couriers = CourierSimulator(listener_client,
+                                    tracker,
+                                    mobile_numbers,
+                                    bid_probability=args['--bid-probability'],
+                                    think_time_seconds=args['--think-time'],
+                                    seed=rng.random())
+        server.add_sms_listener(couriers.on_sms)
+
+        run_start = time.time()
+        posted = post_jobs(listener_client, tracker, client_id, num_jobs, float(args['--job-rate']), rng)
+        print('### %d jobs posted; waiting for them to finish' % posted, file=sys.stderr)
+
+        all_finished = tracker.wait_for_finished(posted, float(args['--timeout']))
+        elapsed = time.time() - run_start
+        if not all_finished:
+            print('!!! timed out with %d of %d jobs finished' % (tracker.finished_count(), posted), file=sys.stderr)
+
+        report = {
+            'timestamp': datetime.datetime.utcnow().isoformat(),
+            'parameters': {name.lstrip('-'): value for name, value in args.items()},
+            'jobs_posted': posted,
+            'jobs_finished': tracker.finished_count(),
+            'elapsed_seconds': elapsed,
+            'throughput_jobs_per_second': tracker.throughput(),
+            'sms_sent': server.sms_count,
+            'stage_counts': tracker.stage_counts(),
+            'stage_latency_seconds': tracker.stage_latencies(),
+            'endpoint_latency_seconds': recorder.summary(),
+            'courier_reply_errors': couriers.unhandled_errors,
+            'queue_depth': {name: queue.depth() for name, queue in queues.items()},
+            'incomplete_jobs': sorted(tag for tag, stages in tracker.jobs.items()
+                                      if 'posted' in stages and 'finished' not in stages)
+        }
+
+        stamp = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        report_filename = os.path.join(results_dir, 'loadtest-%s.json' % stamp)
+        with open(report_filename, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+
+        # the listener's own view (per-transform timings, pool stats) and the consumers'
+        with open(os.path.join(results_dir, 'listener-metrics-%s.txt' % stamp), 'w') as f:
+            f.write(scrape_listener_metrics())
+        with open(os.path.join(results_dir, 'consumer-metrics-%s.txt' % stamp), 'w') as f:
+            f.write(bxmetrics.REGISTRY.render())
+
+        print_table('stage latency (seconds)', report['stage_latency_seconds'])
+        print_table('endpoint latency (seconds)', report['endpoint_latency_seconds'])
+        print('\n%d of %d jobs finished in %.1f seconds: %.2f jobs/second; %d SMS sent'
+              % (report['jobs_finished'], posted, elapsed, report['throughput_jobs_per_second'], server.sms_count))
+        print('report saved to %s' % report_filename)
+        return 0 if all_finished else 1
+
+    finally:
+        stop_event.set()
+        if couriers:
+            couriers.shutdown()
+        for mobile_number in mobile_numbers:
+            try:
+                listener_client.send_sms(mobile_number, 'off')
+            except requests.exceptions.RequestException:
+                break
+        stop_listener(listener_process)
+        listener_log.close()
+        server.stop()
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    sys.exit(main(args))
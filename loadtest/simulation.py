@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+'''Simulated couriers and the bookkeeping for a load-test run: per-job stage
+timestamps, request latencies, and percentile summaries.
+'''
+
+import re
+import math
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+# a job moves through these stages in order; each is stamped the first time it is seen
+JOB_STAGES = ['posted', 'noticed', 'broadcast', 'bid', 'awarded', 'accepted', 'en_route', 'finished']
+
+# replies from the web listener, as the simulated couriers receive them
+AWARD_RX = re.compile(r"awarded the job with tag: (\S+)\.")
+ACCEPTED_RX = re.compile(r"You have accepted job (\S+)\.")
+EN_ROUTE_RX = re.compile(r"en route for job: (\S+)\. Godspeed")
+FINISHED_RX = re.compile(r"Recording job completion for job tag: (\S+)\. Thank you")
+
+JOB_TAG_PREFIX = 'bxlog-'
+
+
+def percentile(sorted_values, pct):
+    # nearest-rank percentile of an already-sorted list
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': values[-1]
+    }
+
+
+class LatencyRecorder(object):
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, ok=True):
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            result = {}
+            for name, values in self.samples.items():
+                result[name] = summarize(values)
+                result[name]['errors'] = self.errors.get(name, 0)
+            return result
+
+
+class JobTracker(object):
+    '''First-seen timestamps (time.time()) for every stage of every job.'''
+
+    def __init__(self):
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+
+    def mark(self, job_tag, stage, timestamp=None):
+        with self._lock:
+            stages = self.jobs.setdefault(job_tag, {})
+            if stage not in stages:
+                stages[stage] = timestamp or time.time()
+                if stage == 'finished':
+                    self._finished.notify_all()
+
+    def has_stage(self, job_tag, stage):
+        with self._lock:
+            return stage in self.jobs.get(job_tag, {})
+
+    def finished_count(self):
+        with self._lock:
+            return len([s for s in self.jobs.values() if 'finished' in s])
+
+    def wait_for_finished(self, count, timeout_seconds):
+        deadline = time.time() + timeout_seconds
+        with self._lock:
+            while len([s for s in self.jobs.values() if 'finished' in s]) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._finished.wait(min(remaining, 1))
+            return True
+
+    def stage_latencies(self):
+        '''Seconds spent between consecutive stages, and end to end, over every
+        job which reached both ends of the interval.
+        '''
+        with self._lock:
+            jobs = [dict(stages) for stages in self.jobs.values() if 'posted' in stages]
+
+        intervals = list(zip(JOB_STAGES, JOB_STAGES[1:])) + [('posted', 'finished')]
+        result = {}
+        for start_stage, end_stage in intervals:
+            values = [stages[end_stage] - stages[start_stage]
+                      for stages in jobs if start_stage in stages and end_stage in stages]
+            result['%s -> %s' % (start_stage, end_stage)] = summarize(values)
+        return result
+
+    def stage_counts(self):
+        with self._lock:
+            jobs = list(self.jobs.values())
+        return {stage: len([s for s in jobs if stage in s]) for stage in JOB_STAGES}
+
+    def throughput(self):
+        '''Finished jobs per second, from the first job posted to the last one finished.'''
+        with self._lock:
+            posted = [s['posted'] for s in self.jobs.values() if 'posted' in s]
+            finished = [s['finished'] for s in self.jobs.values() if 'finished' in s]
+        if not posted or not finished:
+            return 0.0
+        elapsed = max(finished) - min(posted)
+        return len(finished) / elapsed if elapsed > 0 else 0.0
+
+
+class ListenerClient(object):
+    '''HTTP client for the web listener which records the latency of every call,
+    keyed by method and route.
+    '''
+
+    def __init__(self, base_url, recorder, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=64))
+
+    def call(self, method, route, **kwargs):
+        start_time = time.monotonic()
+        ok = False
+        try:
+            response = self.session.request(method, self.base_url + route, timeout=self.timeout, **kwargs)
+            ok = response.status_code == 200
+            return response
+        finally:
+            self.recorder.record('%s %s' % (method, route), time.monotonic() - start_time, ok)
+
+    def send_sms(self, mobile_number, body):
+        # Twilio posts inbound messages as a form
+        return self.call('POST', '/sms', data={'From': '+1%s' % mobile_number, 'Body': body})
+
+
+class CourierSimulator(object):
+    '''A pool of simulated couriers. Each one reacts to the SMS traffic the
+    stand-in server delivers to its number: it bids on broadcast job tags (with
+    probability <bid_probability>), accepts the jobs it is awarded, reports en
+    route, then finishes -- pausing for up to <think_time_seconds> before each reply.
+    '''
+
+    def __init__(self, listener_client, tracker, mobile_numbers, **kwargs):
+        self.client = listener_client
+        self.tracker = tracker
+        self.mobile_numbers = set(mobile_numbers)
+        self.bid_probability = float(kwargs.get('bid_probability', 1.0))
+        self.think_time_seconds = float(kwargs.get('think_time_seconds', 0))
+        self.rng = random.Random(kwargs.get('seed'))
+        self.executor = ThreadPoolExecutor(max_workers=int(kwargs.get('reply_threads') or 32))
+        self.unhandled_errors = 0
+        self._lock = threading.Lock()
+
+    def think_time(self):
+        with self._lock:
+            return self.rng.uniform(0, self.think_time_seconds)
+
+    def should_bid(self):
+        with self._lock:
+            return self.rng.random() < self.bid_probability
+
+    def reply(self, mobile_number, body, stage=None, job_tag=None):
+        def send():
+            time.sleep(self.think_time())
+            try:
+                response = self.client.send_sms(mobile_number, body)
+                if stage and response.status_code == 200:
+                    self.tracker.mark(job_tag, stage)
+            except Exception:
+                with self._lock:
+                    self.unhandled_errors += 1
+
+        self.executor.submit(send)
+
+    def on_sms(self, mobile_number, body):
+        if mobile_number not in self.mobile_numbers:
+            return
+
+        if body.startswith(JOB_TAG_PREFIX) and ' ' not in body:
+            # a broadcast job notice is the bare job tag
+            job_tag = body
+            self.tracker.mark(job_tag, 'broadcast')
+            if self.should_bid():
+                self.reply(mobile_number, '%s bid' % job_tag, stage='bid', job_tag=job_tag)
+            return
+
+        match = AWARD_RX.search(body)
+        if match:
+            job_tag = match.group(1)
+            self.tracker.mark(job_tag, 'awarded')
+            self.reply(mobile_number, '%s acc' % job_tag)
+            return
+
+        match = ACCEPTED_RX.search(body)
+        if match:
+            job_tag = match.group(1)
+            self.tracker.mark(job_tag, 'accepted')
+            self.reply(mobile_number, '%s ert' % job_tag)
+            return
+
+        match = EN_ROUTE_RX.search(body)
+        if match:
+            job_tag = match.group(1)
+            self.tracker.mark(job_tag, 'en_route')
+            self.reply(mobile_number, '%s fin' % job_tag)
+            return
+
+        match = FINISHED_RX.search(body)
+        if match:
+            self.tracker.mark(match.group(1), 'finished')
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+'''Local stand-ins for the cloud services BXLOGIC depends on, for load testing.
+
+StandInServer is a small HTTP server, run inside the load-test harness, which
+plays the part of Twilio (outbound SMS) and S3 (job notices). Writes to S3
+prefixes with a registered notification are turned into S3 event records on a
+StandInQueue, the same way the bxlogic bucket notifies its SQS queue.
+
+StandInQueue and StandInSQSClient stand in for SQS. They live in the harness
+process, which also runs the queue consumers.
+
+StandInTwilioClient and StandInS3Client are the client halves, which the
+service objects in lt_services.py use in place of the Twilio and boto3 clients,
+from whichever process (web listener or consumer) they run in.
+'''
+
+import io
+import json
+import time
+import uuid
+import threading
+import collections
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import quote, unquote
+
+import requests
+
+
+def normalize_number(number):
+    # Twilio takes E.164 numbers; the rest of the system uses bare 10-digit ones
+    number = number.strip()
+    if number.startswith('+1'):
+        return number[2:]
+    return number.lstrip('+')
+
+
+class StandInQueue(object):
+    '''An SQS queue, minus the network: messages received but not deleted become
+    visible again once their visibility timeout has passed.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.available = collections.deque()
+        self.in_flight = {}
+        self.sent_count = 0
+        self.deleted_count = 0
+        self._cond = threading.Condition()
+
+    def send(self, body, attributes=None):
+        message = {
+            'MessageId': str(uuid.uuid4()),
+            'Body': body,
+            'Attributes': {'SentTimestamp': str(int(time.time() * 1000))},
+            'MessageAttributes': attributes or {}
+        }
+        with self._cond:
+            self.available.append(message)
+            self.sent_count += 1
+            self._cond.notify()
+        return message['MessageId']
+
+    def _requeue_expired(self, now):
+        for receipt_handle, (message, visible_at) in list(self.in_flight.items()):
+            if visible_at <= now:
+                del self.in_flight[receipt_handle]
+                self.available.append(message)
+
+    def receive(self, max_messages, visibility_timeout_seconds, wait_time_seconds):
+        deadline = time.monotonic() + wait_time_seconds
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._requeue_expired(now)
+                if self.available or now >= deadline:
+                    break
+                self._cond.wait(min(deadline - now, 0.25))
+
+            messages = []
+            while self.available and len(messages) < max_messages:
+                message = dict(self.available.popleft())
+                message['ReceiptHandle'] = str(uuid.uuid4())
+                self.in_flight[message['ReceiptHandle']] = (message, time.monotonic() + visibility_timeout_seconds)
+                messages.append(message)
+            return messages
+
+    def change_visibility(self, receipt_handle, visibility_timeout_seconds):
+        with self._cond:
+            entry = self.in_flight.get(receipt_handle)
+            if entry is None:
+                return False
+            self.in_flight[receipt_handle] = (entry[0], time.monotonic() + visibility_timeout_seconds)
+            return True
+
+    def delete(self, receipt_handle):
+        with self._cond:
+            if self.in_flight.pop(receipt_handle, None) is None:
+                return False
+            self.deleted_count += 1
+            return True
+
+    def depth(self):
+        with self._cond:
+            return len(self.available) + len(self.in_flight)
+
+
+class StandInSQSClient(object):
+    '''The subset of the boto3 SQS client used by QueueConsumer and sqssend.py.
+    Queue URLs are the names of StandInQueues.
+    '''
+
+    def __init__(self, queues):
+        self.queues = queues
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=30, WaitTimeSeconds=0, **kwargs):
+        messages = self.queues[QueueUrl].receive(MaxNumberOfMessages, VisibilityTimeout, WaitTimeSeconds)
+        return {'Messages': messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        successful = []
+        failed = []
+        for entry in Entries:
+            if self.queues[QueueUrl].delete(entry['ReceiptHandle']):
+                successful.append({'Id': entry['Id']})
+            else:
+                failed.append({'Id': entry['Id'], 'Message': 'unknown receipt handle'})
+        return {'Successful': successful, 'Failed': failed}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        successful = []
+        failed = []
+        for entry in Entries:
+            if self.queues[QueueUrl].change_visibility(entry['ReceiptHandle'], entry['VisibilityTimeout']):
+                successful.append({'Id': entry['Id']})
+            else:
+                failed.append({'Id': entry['Id'], 'Message': 'unknown receipt handle'})
+        return {'Successful': successful, 'Failed': failed}
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, **kwargs):
+        return {'MessageId': self.queues[QueueUrl].send(MessageBody, MessageAttributes)}
+
+
+def s3_event_body(bucket_name, object_key):
+    return json.dumps({
+        'Records': [{
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            's3': {
+                'bucket': {'name': bucket_name},
+                'object': {'key': object_key}
+            }
+        }]
+    })
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    # the server object carries all state; see StandInServer
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _reply(self, status, body=b'', content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _s3_location(self):
+        # /s3/<bucket>/<key...>
+        tokens = self.path.split('/', 3)
+        if len(tokens) < 4 or tokens[1] != 's3':
+            return None, None
+        return unquote(tokens[2]), unquote(tokens[3])
+
+    def do_POST(self):
+        if self.path != '/twilio/messages':
+            self._reply(404)
+            return
+
+        self.server.simulate_latency()
+        message = json.loads(self._read_body().decode('utf-8'))
+        sid = self.server.record_sms(normalize_number(message['to']), message['body'])
+        self._reply(201, json.dumps({'sid': sid}).encode('utf-8'))
+
+    def do_PUT(self):
+        bucket_name, object_key = self._s3_location()
+        if bucket_name is None:
+            self._reply(404)
+            return
+
+        self.server.simulate_latency()
+        self.server.put_object(bucket_name, object_key, self._read_body())
+        self._reply(200)
+
+    def do_GET(self):
+        bucket_name, object_key = self._s3_location()
+        if bucket_name is None:
+            self._reply(404)
+            return
+
+        self.server.simulate_latency()
+        data = self.server.get_object(bucket_name, object_key)
+        if data is None:
+            self._reply(404)
+            return
+        self._reply(200, data, 'application/octet-stream')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, bind_host='127.0.0.1', latency_seconds=0.0):
+        super().__init__((bind_host, int(port)), StandInRequestHandler)
+        self.latency_seconds = latency_seconds
+        self.objects = {}
+        self.notifications = []
+        self.sms_listeners = []
+        self.object_listeners = []
+        self.sms_count = 0
+        self.thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def simulate_latency(self):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+    def add_s3_notification(self, bucket_name, key_prefix, queue):
+        self.notifications.append((bucket_name, key_prefix, queue))
+
+    def add_sms_listener(self, listener_func):
+        '''<listener_func>(mobile_number, body) is called for every outbound SMS,
+        on the server thread which received it; it should return promptly.
+        '''
+        self.sms_listeners.append(listener_func)
+
+    def add_object_listener(self, listener_func):
+        '''<listener_func>(bucket_name, object_key) is called for every object written.'''
+        self.object_listeners.append(listener_func)
+
+    def record_sms(self, mobile_number, body):
+        with self._lock:
+            self.sms_count += 1
+        for listener_func in self.sms_listeners:
+            listener_func(mobile_number, body)
+        return 'SM%s' % uuid.uuid4().hex
+
+    def put_object(self, bucket_name, object_key, data):
+        with self._lock:
+            self.objects[(bucket_name, object_key)] = data
+
+        for listener_func in self.object_listeners:
+            listener_func(bucket_name, object_key)
+
+        for notify_bucket, key_prefix, queue in self.notifications:
+            if notify_bucket == bucket_name and object_key.startswith(key_prefix):
+                queue.send(s3_event_body(bucket_name, object_key))
+
+    def get_object(self, bucket_name, object_key):
+        with self._lock:
+            return self.objects.get((bucket_name, object_key))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='standin-server', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+StandInMessage = collections.namedtuple('StandInMessage', 'sid')
+
+
+class StandInTwilioMessages(object):
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, to, from_, body):
+        response = self.client.http_session.post('%s/twilio/messages' % self.client.base_url,
+                                                 json={'to': to, 'from': from_, 'body': body},
+                                                 timeout=self.client.timeout)
+        response.raise_for_status()
+        return StandInMessage(sid=response.json()['sid'])
+
+
+class StandInTwilioClient(object):
+    '''Exposes client.messages.create() the way twilio.rest.Client does.'''
+
+    def __init__(self, base_url, timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.http_session = requests.Session()
+        self.messages = StandInTwilioMessages(self)
+
+
+class StandInS3Client(object):
+    '''The subset of the boto3 S3 client used by S3Service.'''
+
+    def __init__(self, base_url, timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.http_session = requests.Session()
+
+    def _object_url(self, bucket_name, object_key):
+        return '%s/s3/%s/%s' % (self.base_url, quote(bucket_name, safe=''), quote(object_key))
+
+    def put_object(self, Body, Bucket, Key, **kwargs):
+        response = self.http_session.put(self._object_url(Bucket, Key), data=Body, timeout=self.timeout)
+        response.raise_for_status()
+        return {}
+
+    def upload_fileobj(self, data, bucket_name, object_key):
+        self.put_object(Body=data.read(), Bucket=bucket_name, Key=object_key)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        response = self.http_session.get(self._object_url(Bucket, Key), timeout=self.timeout)
+        response.raise_for_status()
+        return {'Body': io.BytesIO(response.content)}
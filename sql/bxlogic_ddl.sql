@@ -74,6 +74,13 @@ CREATE TABLE "job_data" (
   PRIMARY KEY ("id")
 );
 
+CREATE TABLE "job_current_status" (
+  "job_tag" varchar(128) NOT NULL,
+  "status" int2 NOT NULL,
+  "write_ts" timestamp(255) NOT NULL,
+  PRIMARY KEY ("job_tag")
+);
+
 CREATE TABLE "job_logs" (
   "id" uuid NOT NULL DEFAULT public.uuid_generate_v4(),
   "job_tag" varchar(255) NOT NULL,
@@ -91,6 +98,28 @@ CREATE TABLE "job_status" (
   PRIMARY KEY ("id")
 );
 
+CREATE TABLE "list_cursors" (
+  "courier_id" uuid NOT NULL,
+  "command_string" text NOT NULL,
+  "next_offset" int4 NOT NULL,
+  "write_ts" timestamp(255) NOT NULL,
+  PRIMARY KEY ("courier_id")
+);
+
+CREATE TABLE "job_broadcasts" (
+  "job_tag" varchar(64) NOT NULL,
+  "claimed_ts" timestamp NOT NULL,
+  "lease_expires_ts" timestamp NOT NULL,
+  "completed_ts" timestamp,
+  PRIMARY KEY ("job_tag")
+);
+
+CREATE TABLE "schema_migrations" (
+  "version" varchar(64) NOT NULL,
+  "applied_ts" timestamp NOT NULL DEFAULT now(),
+  PRIMARY KEY ("version")
+);
+
 CREATE TABLE "lookup_duty_status" (
   "id" int4 NOT NULL,
   "value" varchar(16) NOT NULL,
@@ -130,3 +159,16 @@ ALTER TABLE "job_assignments" ADD CONSTRAINT "fk_job_assignments_job_data_1" FOR
 ALTER TABLE "job_bids" ADD CONSTRAINT "fk_job_bids_couriers_1" FOREIGN KEY ("courier_id") REFERENCES "couriers" ("id");
 ALTER TABLE "job_data" ADD CONSTRAINT "fk_job_data_clients_1" FOREIGN KEY ("client_id") REFERENCES "clients" ("id");
 
+ALTER TABLE "couriers" ADD CONSTRAINT "ck_couriers_mobile_number_normalized" CHECK ("mobile_number" ~ '^[0-9]+$');
+
+-- hot-path indexes (see sql/migrations/0002_hot_path_indexes.sql). The ones on tables and
+-- columns this file does not define (bidding_windows, user_handle_maps, messages,
+-- user_macros, job_bids.bidding_window_id) come from running the migration itself.
+CREATE UNIQUE INDEX "idx_couriers_mobile_number" ON "couriers" ("mobile_number") WHERE "deleted_ts" IS NULL;
+CREATE INDEX "idx_job_status_job_tag" ON "job_status" ("job_tag", "write_ts");
+CREATE INDEX "idx_job_current_status_status" ON "job_current_status" ("status", "write_ts");
+CREATE INDEX "idx_job_bids_live_job_courier" ON "job_bids" ("job_tag", "courier_id") WHERE "expired_ts" IS NULL;
+CREATE INDEX "idx_job_bids_live_courier" ON "job_bids" ("courier_id") WHERE "expired_ts" IS NULL;
+CREATE INDEX "idx_job_data_live_job_tag" ON "job_data" ("job_tag") WHERE "deleted_ts" IS NULL;
+CREATE INDEX "idx_job_assignments_courier_job_tag" ON "job_assignments" ("courier_id", "job_tag");
+CREATE INDEX "idx_job_assignments_job_tag" ON "job_assignments" ("job_tag");
@@ -0,0 +1,34 @@
+
+-- 0001: one-row-per-job current status table.
+--
+-- job_current_status answers "what state is this job in" with a primary-key lookup;
+-- job_status becomes an append-only audit log of status transitions, and its
+-- expired_ts column is no longer written.
+
+CREATE TABLE IF NOT EXISTS "schema_migrations" (
+  "version" varchar(64) NOT NULL,
+  "applied_ts" timestamp NOT NULL DEFAULT now(),
+  PRIMARY KEY ("version")
+);
+
+CREATE TABLE IF NOT EXISTS "job_current_status" (
+  "job_tag" varchar(128) NOT NULL,
+  "status" int2 NOT NULL,
+  "write_ts" timestamp(255) NOT NULL,
+  PRIMARY KEY ("job_tag")
+);
+
+-- seed the current state from the unexpired history rows
+INSERT INTO job_current_status
+(job_tag, status, write_ts)
+SELECT DISTINCT ON (job_tag) job_tag, status, write_ts
+FROM job_status
+WHERE expired_ts IS NULL
+ORDER BY job_tag, write_ts DESC
+ON CONFLICT (job_tag) DO NOTHING;
+
+INSERT INTO schema_migrations
+(version)
+VALUES
+('0001_job_current_status')
+ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,90 @@
+
+-- 0002: indexes supporting the hot queries in bx_transforms.py.
+--
+-- Partial indexes cover only the live rows (expired_ts / deleted_ts IS NULL),
+-- which are the only rows the SMS and arbitration paths ever read.
+--
+-- Every index is built CONCURRENTLY, so that the tables stay writable while it
+-- builds. That cannot happen inside a transaction block, so run this file one
+-- statement at a time (as "make migrate" does), not wrapped in BEGIN/COMMIT. A
+-- concurrent build which fails leaves an INVALID index behind, which IF NOT EXISTS
+-- would then skip: drop it before running the migration again.
+
+-- inbound SMS resolves the sender by mobile number; numbers are stored normalized
+-- (digits only, no country code), so a plain unique index serves the lookup
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_couriers_mobile_number
+  ON couriers (mobile_number) WHERE deleted_ts IS NULL;
+
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'ck_couriers_mobile_number_normalized') THEN
+    -- NOT VALID: enforced for new and updated rows without scanning existing ones
+    ALTER TABLE couriers ADD CONSTRAINT ck_couriers_mobile_number_normalized
+      CHECK (mobile_number ~ '^[0-9]+$') NOT VALID;
+  END IF;
+END
+$$;
+
+-- status history (audit reads) and current status (open-job listing); job_status is
+-- append-only and expired_ts is never set, so there is no "live" subset to index
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_status_job_tag
+  ON job_status (job_tag, write_ts);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_current_status_status
+  ON job_current_status (status, write_ts);
+
+-- bids: per-job bidder lists, "has this courier bid", and per-courier bid listings
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_bids_live_job_courier
+  ON job_bids (job_tag, courier_id) WHERE expired_ts IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_bids_live_courier
+  ON job_bids (courier_id) WHERE expired_ts IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_bids_live_bidding_window
+  ON job_bids (bidding_window_id) WHERE expired_ts IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_data_live_job_tag
+  ON job_data (job_tag) WHERE deleted_ts IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_assignments_courier_job_tag
+  ON job_assignments (courier_id, job_tag);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_job_assignments_job_tag
+  ON job_assignments (job_tag);
+
+-- bidding windows: lookup by job, and the scan over open windows
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_bidding_windows_job_tag
+  ON bidding_windows (job_tag, close_ts);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_bidding_windows_open
+  ON bidding_windows (open_ts) WHERE close_ts IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_bidding_windows_close_ts
+  ON bidding_windows (close_ts);
+
+-- handles, messages and macros
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_handle_maps_live_handle
+  ON user_handle_maps (handle) WHERE expired_ts IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_handle_maps_live_user
+  ON user_handle_maps (user_id) WHERE expired_ts IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_live_to_user
+  ON messages (to_user) WHERE deleted_ts IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_macros_user_name
+  ON user_macros (user_id, name);
+
+ANALYZE couriers;
+ANALYZE job_status;
+ANALYZE job_current_status;
+ANALYZE job_bids;
+ANALYZE job_data;
+ANALYZE job_assignments;
+ANALYZE bidding_windows;
+
+INSERT INTO schema_migrations
+(version)
+VALUES
+('0002_hot_path_indexes')
+ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,19 @@
+
+-- 0003: per-courier cursor for paginated SMS list output.
+--
+-- When a list reply does not fit on one page, the listing command and the offset
+-- of the next page are stored here; texting "nxt" resumes the listing from there.
+
+CREATE TABLE IF NOT EXISTS "list_cursors" (
+  "courier_id" uuid NOT NULL,
+  "command_string" text NOT NULL,
+  "next_offset" int4 NOT NULL,
+  "write_ts" timestamp(255) NOT NULL,
+  PRIMARY KEY ("courier_id")
+);
+
+INSERT INTO schema_migrations
+(version)
+VALUES
+('0003_list_cursors')
+ON CONFLICT (version) DO NOTHING;
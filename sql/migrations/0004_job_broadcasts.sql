@@ -0,0 +1,20 @@
+-- 0004: record of which jobs have been broadcast to the courier roster.
+--
+-- The queue consumer claims a job's row before texting the roster and marks it
+-- completed afterwards, so a redelivered "posted" message cannot text every
+-- courier a second time. A claim which is never completed (its worker died
+-- mid-broadcast) can be taken over once lease_expires_ts has passed.
+
+CREATE TABLE IF NOT EXISTS "job_broadcasts" (
+  "job_tag" varchar(64) NOT NULL,
+  "claimed_ts" timestamp NOT NULL,
+  "lease_expires_ts" timestamp NOT NULL,
+  "completed_ts" timestamp,
+  PRIMARY KEY ("job_tag")
+);
+
+INSERT INTO schema_migrations
+(version)
+VALUES
+('0004_job_broadcasts')
+ON CONFLICT (version) DO NOTHING;
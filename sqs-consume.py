@@ -7,13 +7,11 @@ Usage:
 '''
 
 import sys
-import time
-import datetime
-from multiprocessing import Process
 import boto3
 import docopt
-from snap import snap, common
+from snap import common
 from sh import git
+from bx_consumer import QueueConsumer
 
 VERSION_NUM = '0.5.2'
 
@@ -37,15 +35,12 @@ def main(args):
 
     source_name = args['<source_name>']
     if not yaml_config['sources'].get(source_name):
-        raise Exception('No queue source "%s" defined. Please check your config file.')
+        raise Exception('No queue source "%s" defined. Please check your config file.' % source_name)
 
-    service_tbl = snap.initialize_services(yaml_config)
-    service_registry = common.ServiceObjectRegistry(service_tbl)
     source_config = yaml_config['sources'][source_name]
 
     # Create SQS client
     region = source_config['region']
-    polling_interval = int(source_config['polling_interval_seconds'])
 
     sqs = boto3.client('sqs', region_name=region)
     queue_url = common.load_config_var(source_config['queue_url'])
@@ -55,66 +50,24 @@ def main(args):
 
     msg_handler_module = yaml_config['globals']['consumer_module']
     msg_handler_func = common.load_class(msg_handler_name, msg_handler_module)
-
-    child_procs = []
-
-    print('### initiating polling loop.')
-
-    # loop forever
-    while True:
-        current_time = datetime.datetime.now().isoformat()
-        if verbose_mode:
-            print('### checking SQS queue %s for messages at %s...' % (queue_url, current_time), file=sys.stderr)
-
-        # Receive message from SQS queue
-        response = sqs.receive_message(
-            QueueUrl=queue_url,
-            AttributeNames=[
-                'SentTimestamp'
-            ],
-            MaxNumberOfMessages=1,
-            MessageAttributeNames=[
-                'All'
-            ],
-            VisibilityTimeout=30,
-            # VisibilityTimeout (integer) -- The duration (in seconds) that the received messages
-            # are hidden from subsequent retrieve requests after being retrieved by a ReceiveMessage request.
-            WaitTimeSeconds=3
-            # WaitTimeSeconds (integer) -- The duration (in seconds) for which the call waits for a message 
-            # to arrive in the queue before returning.
-            # If a message is available, the call returns sooner than WaitTimeSeconds . If no messages are available
-            # and the wait time expires, the call returns successfully with an empty list of messages.
-        )
-
-        inbound_msgs = response.get('Messages') or []
-        if not len(inbound_msgs):
-            if verbose_mode:
-                print('### No messages pending, sleeping %d seconds before re-try...' % polling_interval)
-
-            time.sleep(polling_interval)
-            continue
-
-        for message in inbound_msgs:
-            receipt_handle = message['ReceiptHandle']
-            current_time = datetime.datetime.now().isoformat()
-            print('### spawning message processor at %s...' % current_time, file=sys.stderr)
-
-            try:
-                # TODO: can we pickle a ServiceObjectRegistry?
-                p = Process(target=msg_handler_func, args=(message, receipt_handle, service_registry))
-                p.start()
-                child_procs.append(p)
-                print('### Queued message-handling subprocess with PID %s.' % p.pid, file=sys.stderr)
-
-                # Delete received message from queue
-                sqs.delete_message(
-                    QueueUrl=queue_url,
-                    ReceiptHandle=receipt_handle
-                )
-
-            except Exception as err:
-                print('!!! Error processing message with receipt: %s' % receipt_handle, file=sys.stderr)
-                print(err)
+    worker_init_func = None
+    if source_config.get('worker_init'):
+        worker_init_func = common.load_class(source_config['worker_init'], msg_handler_module)
+
+    consumer = QueueConsumer(sqs,
+                             queue_url,
+                             msg_handler_func,
+                             yaml_config,
+                             worker_mode=source_config.get('worker_mode'),
+                             num_workers=source_config.get('num_workers'),
+                             max_msgs_per_cycle=source_config.get('max_msgs_per_cycle'),
+                             wait_time_seconds=source_config.get('wait_time_seconds'),
+                             visibility_timeout_seconds=source_config.get('visibility_timeout_seconds'),
+                             heartbeat_interval_seconds=source_config.get('heartbeat_interval_seconds'),
+                             worker_init_func=worker_init_func,
+                             metrics_port=source_config.get('metrics_port'),
+                             verbose=verbose_mode)
+    consumer.run()
 
 
 if __name__ == '__main__':